@@ -0,0 +1,107 @@
+"""
+Echo agent throughput benchmark.
+
+Starts luna_agent/agents/echo.py in a subprocess and drives it with concurrent websocket clients,
+each sending a 20ms PCM chunk and waiting for the echoed JSON message. Reports messages per second
+and messages per CPU second of the agent process (messages / second / core).
+
+    python benchmarks/bench_echo.py                                  # compare json backends and loops
+    python benchmarks/bench_echo.py --json-backend orjson --fast-loop
+"""
+
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+import httpx
+import websockets
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CHUNK = b"\x01\x00" * 320  # 20ms of 16kHz mono pcm
+
+
+def cpu_seconds(pid: int) -> float:
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+async def wait_ready(url: str, timeout: float = 20.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.2)
+    raise TimeoutError(f"agent at {url} did not start")
+
+
+async def client(port: int, duration: float) -> int:
+    async with httpx.AsyncClient() as http:
+        response = await http.post(f"http://localhost:{port}/start_session", json={"sample_rate": 16000})
+    session_id = response.json()["session_id"]
+    num_messages = 0
+    async with websockets.connect(f"ws://localhost:{port}/ws/agent/audio/{session_id}") as ws:
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            await ws.send(CHUNK)
+            await ws.recv()
+            num_messages += 1
+    return num_messages
+
+
+async def run(port: int, num_clients: int, duration: float, pid: int) -> dict:
+    cpu_start, wall_start = cpu_seconds(pid), time.monotonic()
+    counts = await asyncio.gather(*[client(port, duration) for _ in range(num_clients)])
+    cpu, wall = cpu_seconds(pid) - cpu_start, time.monotonic() - wall_start
+    total = sum(counts)
+    return {"messages": total, "msg/s": total / wall, "msg/s/core": total / max(cpu, 1e-6), "cpu_s": cpu}
+
+
+def bench(json_backend: str, fast_loop: bool, port: int, num_clients: int, duration: float) -> dict:
+    env = dict(os.environ, LUNA_JSON_BACKEND=json_backend, PYTHONPATH=ROOT)
+    cmd = [sys.executable, "luna_agent/agents/echo.py", "--port", str(port)] + (["--fast-loop"] if fast_loop else [])
+    proc = subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        asyncio.run(wait_ready(f"http://localhost:{port}/docs"))
+        return asyncio.run(run(port, num_clients, duration, proc.pid))
+    finally:
+        # open websocket handlers keep uvicorn from shutting down gracefully
+        proc.terminate()
+        try:
+            proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--json-backend", type=str, default=None, help="json, orjson or msgspec, default: compare all")
+    parser.add_argument("--fast-loop", action="store_true", help="only run with uvloop + httptools required")
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--port", type=int, default=29003)
+    args = parser.parse_args()
+
+    if args.json_backend:
+        configs = [(args.json_backend, args.fast_loop)]
+    else:
+        configs = [("json", False), ("orjson", False), ("orjson", True)]
+
+    print(f"{'json':>8} {'loop':>8} {'messages':>10} {'msg/s':>10} {'msg/s/core':>12}")
+    for json_backend, fast_loop in configs:
+        result = bench(json_backend, fast_loop, args.port, args.clients, args.duration)
+        loop = "uvloop" if fast_loop else "auto"
+        print(
+            f"{json_backend:>8} {loop:>8} {result['messages']:>10} {result['msg/s']:>10.0f} {result['msg/s/core']:>12.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
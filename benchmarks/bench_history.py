@@ -0,0 +1,105 @@
+"""
+Memory of a long session's conversation history: openai message dicts holding base64 wavs (what the chat agent
+kept), luna_agent.history.History with all the audio in memory, and History spilling past 8 MiB. Also the time
+per turn of the snapshot the response takes (a list copy vs a view) and of building the slm request from the last
+20 messages with use_text_history.
+
+    python benchmarks/bench_history.py --turns 200 --utterance-s 4
+"""
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from luna_agent.components.slm import add_agent_message, add_user_message  # noqa: E402
+from luna_agent.history import History, Turn  # noqa: E402
+
+REPLY = "今天天气不错，适合出去走走。" * 4
+
+
+def utterances(turns: int, seconds: float):
+    rng = np.random.default_rng(0)
+    for _ in range(turns):
+        yield (rng.normal(0, 3000, int(16000 * seconds))).astype(np.int16).tobytes()
+
+
+def dict_history(turns: int, seconds: float):
+    history = []
+    for pcm in utterances(turns, seconds):
+        add_user_message(history, audio=pcm, transcript=REPLY)
+        add_agent_message(history, REPLY)
+    return history
+
+
+def compact_history(turns: int, seconds: float, spill_bytes: int):
+    history = History(spill_bytes=spill_bytes)
+    for pcm in utterances(turns, seconds):
+        history.append_user(audio=pcm, transcript=REPLY)
+        history.append_agent(REPLY)
+    return history
+
+
+def text_messages(history, max_messages: int = 20):
+    """
+    what SLM.__call__ does to the history with use_text_history
+    """
+    messages = []
+    for message in history[-max_messages:]:
+        if isinstance(message, Turn):
+            message = message.message(audio=False)
+        if message["role"] == "user":
+            content = [{"type": "text", "text": item["transcript"]} for item in message["content"]]
+        else:
+            content = message["content"]
+        messages.append({"role": message["role"], "content": content})
+    return messages
+
+
+def measure(name: str, build, snapshot, repeat: int = 1000):
+    tracemalloc.start()
+    history = build()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        snapshot(history)
+    snapshot_us = (time.perf_counter() - start) / repeat * 1e6
+    start = time.perf_counter()
+    for _ in range(repeat):
+        text_messages(snapshot(history))
+    request_us = (time.perf_counter() - start) / repeat * 1e6
+    print(f"{name:>16}: {current / 2**20:8.1f} MiB, snapshot {snapshot_us:7.2f} us, request {request_us:7.1f} us")
+    if isinstance(history, History):
+        history.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=200, help="user / agent message pairs")
+    parser.add_argument("--utterance-s", type=float, default=4, help="seconds of audio per user message")
+    args = parser.parse_args()
+    pcm_mib = args.turns * int(16000 * args.utterance_s) * 2 / 2**20
+    print(f"{args.turns} turns, {pcm_mib:.1f} MiB of pcm")
+    measure("dicts", lambda: dict_history(args.turns, args.utterance_s), lambda history: history[:])
+    measure(
+        "History",
+        lambda: compact_history(args.turns, args.utterance_s, spill_bytes=2**40),
+        lambda history: history.view(),
+    )
+    measure(
+        "History, spilled",
+        lambda: compact_history(args.turns, args.utterance_s, spill_bytes=8 * 2**20),
+        lambda history: history.view(),
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+Time the event loop spends in logging, per call, with the logging of luna_agent/log.py against the previous
+style: f-strings built whether the level is on or not, basicConfig's handler writing on the calling thread.
+
+    python benchmarks/bench_logging.py --calls 100000
+"""
+
+import argparse
+import logging
+import os
+import queue
+import sys
+import tempfile
+import time
+from logging.handlers import QueueListener
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from luna_agent.log import (  # noqa: E402
+    DATEFMT,
+    FORMAT,
+    ContextFormatter,
+    ContextQueueHandler,
+    Sampled,
+    lazy,
+    lean_records,
+)
+from luna_agent.utils import format_msg  # noqa: E402
+
+# a turn's history as SLM logs it, 20 messages
+AUDIO = {"type": "input_audio", "input_audio": {"data": "", "format": "wav"}, "id": "0" * 32, "transcript": ""}
+HISTORY = [[{"type": "text", "text": "[说话人 0] "}, AUDIO], [{"type": "text", "text": "今天天气晴朗" * 4}]] * 10
+
+
+def bench(name: str, calls: int, fn) -> float:
+    start = time.perf_counter()
+    for i in range(calls):
+        fn(i)
+    us = (time.perf_counter() - start) / calls * 1e6
+    print(f"  {name:44s} {us:8.2f} us/call")
+    return us
+
+
+class SlowStream:
+    """
+    a log pipe that stalls for 1ms every 100 writes, like stdout to a busy log collector
+    """
+
+    def __init__(self):
+        self.writes = 0
+
+    def write(self, text):
+        self.writes += 1
+        if self.writes % 100 == 0:
+            time.sleep(0.001)
+
+    def flush(self):
+        pass
+
+
+def file_logger(name: str, path: str, use_queue: bool):
+    handler = logging.FileHandler(path) if path else logging.StreamHandler(SlowStream())
+    handler.setFormatter(ContextFormatter(FORMAT, DATEFMT))
+    logger = logging.getLogger(name)
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    if not use_queue:
+        logger.addHandler(handler)
+        return logger, None
+    records = queue.SimpleQueue()
+    listener = QueueListener(records, handler)
+    listener.start()
+    logger.addHandler(ContextQueueHandler(records))
+    return logger, listener
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=100000)
+    args = parser.parse_args()
+    calls = args.calls
+    chunk = b"\0" * 4800
+
+    with tempfile.TemporaryDirectory() as tmp:
+        sync, _ = file_logger("bench.sync", os.path.join(tmp, "sync.log"), use_queue=False)
+        queued, listener = file_logger("bench.queued", os.path.join(tmp, "queued.log"), use_queue=True)
+
+        print("per chunk record, DEBUG off")
+        before = bench("f-string", calls, lambda i: sync.debug(f"Sending chunk of size {len(chunk)}"))
+        bench("%-args", calls, lambda i: sync.debug("Sending chunk of size %d", len(chunk)))
+        chunk_log = Sampled(sync, every=100)
+        after = bench("Sampled", calls, lambda i: chunk_log.debug("Sending chunk of size %d", len(chunk)))
+        print(f"  {before / after:.1f}x less")
+
+        print("per chunk record, DEBUG on, written to a file")
+        sync.setLevel(logging.DEBUG)
+        queued.setLevel(logging.DEBUG)
+        before = bench("f-string, handler on the loop", calls, lambda i: sync.debug(f"Sending chunk {len(chunk)}"))
+        chunk_log = Sampled(queued, every=100)
+        after = bench("Sampled, queue handler", calls, lambda i: chunk_log.debug("Sending chunk %d", len(chunk)))
+        print(f"  {before / after:.1f}x less")
+
+        print("SLM history of a turn (20 messages)")
+        sync.setLevel(logging.INFO)
+        queued.setLevel(logging.INFO)
+        turns = calls // 100
+
+        def history_before(i):
+            for content in HISTORY:
+                sync.info(f">>> {format_msg(content).strip()}")
+
+        def history_after(i):
+            for content in HISTORY:
+                queued.debug(">>> %s", lazy(format_msg, content))
+
+        before = bench("info f-strings, handler on the loop", turns, history_before)
+        after = bench("debug lazy, queue handler", turns, history_after)
+        print(f"  {before / after:.1f}x less")
+
+        print("INFO record written to a file")
+        before = bench("handler on the loop", calls, lambda i: sync.info("User transcript: %s", "今天天气怎么样"))
+        lean_records()
+        after = bench("lean records, queue handler", calls, lambda i: queued.info("User transcript: %s", "今天天气"))
+        print(f"  {before / after:.1f}x less")
+        listener.stop()
+
+    print("INFO record to a stalling log pipe")
+    sync, _ = file_logger("bench.slow_sync", None, use_queue=False)
+    queued, listener = file_logger("bench.slow_queued", None, use_queue=True)
+    before = bench("handler on the loop", calls // 10, lambda i: sync.info("User transcript: %s", "今天天气"))
+    after = bench("queue handler", calls // 10, lambda i: queued.info("User transcript: %s", "今天天气"))
+    print(f"  {before / after:.1f}x less")
+    listener.stop()
+
+
+if __name__ == "__main__":
+    main()
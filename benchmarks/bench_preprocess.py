@@ -0,0 +1,73 @@
+"""
+Throughput of the user audio preprocessing (luna_agent/components/preprocess.py) per session, and how much of
+a session's audio its silence gate keeps away from the vad server.
+
+The input alternates speech-like noise, room noise and digital silence (a muted microphone), chunked like a
+client sends it.
+
+    python benchmarks/bench_preprocess.py --seconds 600 --chunk-ms 20
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from luna_agent.components.preprocess import AudioPreprocessor  # noqa: E402
+
+
+def session_audio(seconds: int, sample_rate: int) -> bytes:
+    """
+    repeating 10s: 4s of speech-like noise at -35 dBFS with a dc offset, 2s of room noise, 4s of zeros
+    """
+    rng = np.random.default_rng(0)
+    period = []
+    speech = rng.normal(0, 32768 * 10 ** (-35 / 20), 4 * sample_rate) * np.sin(np.linspace(0, 40, 4 * sample_rate))
+    period.append(speech + 300)
+    period.append(rng.normal(0, 32768 * 10 ** (-60 / 20), 2 * sample_rate) + 300)
+    period.append(np.zeros(4 * sample_rate))
+    period = np.concatenate(period)
+    audio = np.tile(period, seconds // 10 + 1)[: seconds * sample_rate]
+    return np.clip(audio, -32768, 32767).astype(np.int16).tobytes()
+
+
+def run(preprocess: AudioPreprocessor, chunks) -> float:
+    start = time.perf_counter()
+    for chunk in chunks:
+        preprocess(chunk)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=int, default=600)
+    parser.add_argument("--chunk-ms", type=int, default=20)
+    parser.add_argument("--sample-rate", type=int, default=16000)
+    args = parser.parse_args()
+
+    audio = session_audio(args.seconds, args.sample_rate)
+    chunk_bytes = args.sample_rate * 2 * args.chunk_ms // 1000
+    chunks = [audio[i : i + chunk_bytes] for i in range(0, len(audio), chunk_bytes)]
+    print(f"{args.seconds}s of audio in {len(chunks)} chunks of {args.chunk_ms}ms")
+
+    for name, options in [
+        ("dc", {"agc": False, "gate_after_ms": 0}),
+        ("dc + agc", {"gate_after_ms": 0}),
+        ("dc + agc + gate", {}),
+    ]:
+        preprocess = AudioPreprocessor(**options)
+        preprocess.setup(args.sample_rate)
+        elapsed = run(preprocess, chunks)
+        print(
+            f"{name:16s} {elapsed / len(chunks) * 1e6:6.1f} us/chunk, {args.seconds / elapsed:6.0f}x realtime "
+            f"(sessions per core), {preprocess.stats()}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Per frame overhead of the debug middleware, parse mode (json + base64 decode) vs relay mode (pass-through).
+
+Drives debug/middleware.py forward / relay with in-memory sockets, so the numbers are the middleware's
+own cost per frame without any network I/O.
+
+    python benchmarks/bench_relay.py --frames 20000 --chunk-ms 100
+"""
+
+import argparse
+import asyncio
+import base64
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "debug")]
+
+import middleware  # noqa: E402
+from luna_agent.utils import json_codec  # noqa: E402
+
+
+class EndOfFrames(Exception):
+    pass
+
+
+class AgentSocket:
+    """websockets client side, frames come from recv()"""
+
+    def __init__(self, frames):
+        self.frames = iter(frames)
+
+    async def recv(self):
+        try:
+            return next(self.frames)
+        except StopIteration:
+            raise EndOfFrames
+
+
+class UserSocket:
+    """starlette side, only counts what is sent"""
+
+    def __init__(self):
+        self.sent = 0
+
+    async def send_bytes(self, data):
+        self.sent += 1
+
+    async def send_text(self, data):
+        self.sent += 1
+
+
+async def run(pipe, frames) -> float:
+    user = UserSocket()
+    stats = middleware.FrameStats("agent_audio -> user_audio")
+    start = time.perf_counter()
+    try:
+        await pipe(AgentSocket(frames), user, stats)
+    except EndOfFrames:
+        pass
+    elapsed = time.perf_counter() - start
+    assert user.sent == len(frames)
+    return elapsed / len(frames) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--frames", type=int, default=20000)
+    parser.add_argument("--chunk-ms", type=int, default=100)
+    parser.add_argument("--sample-rate", type=int, default=24000)
+    args = parser.parse_args()
+
+    middleware.LOG_INTERVAL = float("inf")
+    pcm = os.urandom(args.sample_rate * 2 * args.chunk_ms // 1000)
+    json_frames = [json_codec.dumps({"data": base64.b64encode(pcm).decode(), "data_type": "bytes"})] * args.frames
+    binary_frames = [pcm] * args.frames
+
+    print(f"{len(pcm)} byte frames, json backend: {json_codec.backend}")
+    parse_us = asyncio.run(run(middleware.forward, json_frames))
+    relay_us = asyncio.run(run(middleware.relay, binary_frames))
+    print(f"parse: {parse_us:8.2f} us/frame")
+    print(f"relay: {relay_us:8.2f} us/frame ({parse_us / relay_us:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Event loop time and memory of fanning the slm's reply out to the tts and the history, per token: asyncstdlib's
+tee (what the chat agent used), a generator recording the tokens into a list (what replaced it) and
+luna_agent.utils.TokenStream. The tts reads every token, the history takes the text once at the end.
+
+    python benchmarks/bench_token_stream.py --tokens 2000 --replies 50
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from luna_agent.utils import TokenStream  # noqa: E402
+
+
+async def slm(tokens: int):
+    for i in range(tokens):
+        # a server sends a token every few ms, one loop iteration between tokens
+        await asyncio.sleep(0)
+        yield "今天"
+
+
+async def tee_reply(tokens: int) -> str:
+    from asyncstdlib.itertools import tee
+
+    tts, history = tee(slm(tokens), 2)
+    async for _ in tts:
+        pass
+    return "".join([token async for token in history])
+
+
+async def record_reply(tokens: int) -> str:
+    chunks = []
+
+    async def record(generator):
+        async for chunk in generator:
+            chunks.append(chunk)
+            yield chunk
+
+    async for _ in record(slm(tokens)):
+        pass
+    return "".join(chunks)
+
+
+async def stream_reply(tokens: int) -> str:
+    stream = TokenStream(slm(tokens))
+    async for _ in stream.reader():
+        pass
+    await stream.aclose()
+    return stream.text()
+
+
+async def bench(name: str, reply, tokens: int, replies: int):
+    start = time.perf_counter()
+    for _ in range(replies):
+        async for _ in slm(tokens):
+            pass
+    baseline = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(replies):
+        assert len(await reply(tokens)) == 2 * tokens
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    await reply(tokens)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    per_token_us = (elapsed - baseline) / replies / tokens * 1e6
+    print(f"{name:>8}: {per_token_us:6.2f} us per token over the bare stream, peak {peak / 1024:7.1f} KiB per reply")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokens", type=int, default=2000, help="tokens per reply")
+    parser.add_argument("--replies", type=int, default=50)
+    args = parser.parse_args()
+
+    async def run():
+        try:
+            await bench("tee", tee_reply, args.tokens, args.replies)
+        except ImportError:
+            print("     tee: asyncstdlib is not installed")
+        await bench("record", record_reply, args.tokens, args.replies)
+        await bench("stream", stream_reply, args.tokens, args.replies)
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+Replay recorded sessions through the endpointers and report response latency against false-cut rate.
+
+Each input is one session, either a wav file (16kHz mono) or a .jsonl of recorded vad messages
+({"chunk": i, "start": .., "end": .., "current": ..}, as written by --save-messages). Wav files are
+segmented by the vad server (--vad-url) or, without one, by the energy vad of luna_agent/standin.py.
+
+Latency is the time from the end of the user's speech to the end-of-turn decision, including the vad
+server's own silence detection. A false cut is a turn after which the user went on speaking within
+--resume-window-ms.
+
+    python benchmarks/replay_endpointing.py tests/test.wav
+    python benchmarks/replay_endpointing.py sessions/*.wav --vad-url ws://localhost:27002/vad --save-messages out
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+from typing import List, Tuple
+
+import soundfile as sf
+import websockets
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from luna_agent.components.endpointing import SAMPLES_PER_MS, AdaptiveEndpointer, Endpointer  # noqa: E402
+from luna_agent.standin import EnergyVAD  # noqa: E402
+from luna_agent.utils import json_codec  # noqa: E402
+
+CHUNK_SAMPLES = 100 * SAMPLES_PER_MS
+
+# (chunk index, message) with the chunks sent when the message arrived
+Messages = List[Tuple[int, dict]]
+
+
+def load_pcm(path: str) -> bytes:
+    audio, sr = sf.read(path, dtype="int16")
+    if audio.ndim > 1:
+        audio = audio[:, 0]
+    if sr != 16000:
+        raise ValueError(f"{path}: expected 16kHz audio, got {sr}")
+    return audio.tobytes()
+
+
+def energy_vad(pcm: bytes, threshold_db: float, silence_ms: int) -> Messages:
+    vad = EnergyVAD(threshold_db, silence_ms)
+    chunk_bytes = CHUNK_SAMPLES * 2
+    return [(i // chunk_bytes, vad(pcm[i : i + chunk_bytes])) for i in range(0, len(pcm), chunk_bytes)]
+
+
+async def server_vad(pcm: bytes, url: str) -> Messages:
+    messages = []
+    sent = 0
+    async with websockets.connect(url) as ws:
+
+        async def receive():
+            async for message in ws:
+                messages.append((sent - 1, json_codec.loads(message)))
+
+        receiver = asyncio.create_task(receive())
+        for i in range(0, len(pcm), CHUNK_SAMPLES * 2):
+            await ws.send(pcm[i : i + CHUNK_SAMPLES * 2])
+            sent += 1
+            await asyncio.sleep(0.1)  # real time, the server may rely on it
+        await asyncio.sleep(1)
+        await ws.close()
+        await receiver
+    return messages
+
+
+def replay(pcm: bytes, messages: Messages, endpointer: Endpointer) -> Endpointer:
+    chunks = [pcm[i : i + CHUNK_SAMPLES * 2] for i in range(0, len(pcm), CHUNK_SAMPLES * 2)]
+    observed = 0
+    current = -1
+    for index, message in messages:
+        while observed <= index and observed < len(chunks):
+            endpointer.observe(chunks[observed])
+            observed += 1
+        current = message.get("current", current)
+        endpointer.step(message.get("start", endpointer.start), message.get("end", endpointer.end), current)
+    return endpointer
+
+
+def endpointers(args) -> dict:
+    configs = {f"fixed hold={hold}ms": (Endpointer, {"hold_ms": hold}) for hold in args.holds}
+    configs["adaptive"] = (AdaptiveEndpointer, {"max_hold_ms": max(args.holds)})
+    return {
+        name: lambda cls=cls, kwargs=kwargs: cls(resume_window_ms=args.resume_window_ms, **kwargs)
+        for name, (cls, kwargs) in configs.items()
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("sessions", nargs="+", help="wav files or recorded vad messages (.jsonl)")
+    parser.add_argument("--vad-url", type=str, default=None)
+    parser.add_argument("--energy-db", type=float, default=-40.0, help="energy vad speech threshold")
+    parser.add_argument("--server-silence-ms", type=int, default=200, help="energy vad silence to close a span")
+    parser.add_argument("--holds", type=int, nargs="+", default=[0, 200, 400, 600, 800])
+    parser.add_argument("--resume-window-ms", type=int, default=1500)
+    parser.add_argument("--save-messages", type=str, default=None, help="directory to save vad messages to")
+    args = parser.parse_args()
+
+    sessions = []
+    for path in args.sessions:
+        if path.endswith(".jsonl"):
+            with open(path) as f:
+                records = [json_codec.loads(line) for line in f if line.strip()]
+            wav = path[: -len(".jsonl")] + ".wav"
+            pcm = load_pcm(wav) if os.path.exists(wav) else b""
+            messages = [(record.pop("chunk"), record) for record in records]
+        else:
+            pcm = load_pcm(path)
+            if args.vad_url:
+                messages = asyncio.run(server_vad(pcm, args.vad_url))
+            else:
+                messages = energy_vad(pcm, args.energy_db, args.server_silence_ms)
+            if args.save_messages:
+                os.makedirs(args.save_messages, exist_ok=True)
+                name = os.path.splitext(os.path.basename(path))[0]
+                with open(os.path.join(args.save_messages, f"{name}.jsonl"), "w") as f:
+                    for index, message in messages:
+                        f.write(json_codec.dumps({"chunk": index, **message}) + "\n")
+        sessions.append((pcm, messages))
+
+    print(f"{len(sessions)} sessions, vad: {args.vad_url or 'energy'}")
+    print(f"{'endpointer':<20} {'turns':>6} {'false cuts':>10} {'false cut rate':>15} {'mean latency ms':>16}")
+    for name, make in endpointers(args).items():
+        turns = false_cuts = latency_ms = 0
+        for pcm, messages in sessions:
+            stats = replay(pcm, messages, make()).stats()
+            turns += stats["turns"]
+            false_cuts += stats["false_cuts"]
+            latency_ms += stats["mean_latency_ms"] * stats["turns"]
+        rate = false_cuts / turns if turns else 0.0
+        mean_latency = latency_ms / turns if turns else 0.0
+        print(f"{name:<20} {turns:>6} {false_cuts:>10} {rate:>15.1%} {mean_latency:>16.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+"""
+Replay a captured session (capture_dir in config/chat.yaml) through LunaAgent.listen against the stand-in
+servers of luna_agent/standin.py, and diff the per turn timing and output against the capture.
+
+The captured user audio is fed at its recorded timing divided by --speed, the stand-in latencies are divided
+by --speed as well. The agent's playback pacing is not accelerated, so use --speed 1 when the interplay of
+interrupts and playback matters. The replay is captured too (--output), so two replays of the same session,
+e.g. before and after a change, can be diffed with --diff to bisect a latency regression.
+
+    python benchmarks/replay_session.py --from-wav tests/test.wav --output captures/test.capture
+    python benchmarks/replay_session.py captures/test.capture --output captures/replay.capture
+    python benchmarks/replay_session.py --diff captures/replay.capture captures/replay2.capture
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+from typing import List, Tuple
+
+import numpy as np
+import soundfile as sf
+from fastapi import WebSocketDisconnect
+from hyperpyyaml import load_hyperpyyaml
+from starlette.websockets import WebSocketState
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from luna_agent.agents.chat import LunaAgent  # noqa: E402
+from luna_agent.capture import AUDIO_IN, SESSION, CaptureWriter, capture_turns, read_capture  # noqa: E402
+from luna_agent.standin import create_app, serve  # noqa: E402
+
+
+class ReplaySocket:
+    """
+    stands in for the client's websocket, plays the captured user audio into the agent
+    """
+
+    def __init__(self, frames: List[Tuple[float, bytes]] = (), speed: float = 1.0, tail_s: float = 5.0):
+        self.frames = frames
+        self.speed = speed
+        self.tail_s = tail_s
+        self.index = 0
+        self.client_state = WebSocketState.CONNECTING
+        self.sent = 0
+
+    async def accept(self):
+        self.client_state = WebSocketState.CONNECTED
+        self.started = time.monotonic()
+
+    async def receive_bytes(self) -> bytes:
+        if self.index >= len(self.frames):
+            # let the last reply play out
+            await asyncio.sleep(self.tail_s)
+            self.client_state = WebSocketState.DISCONNECTED
+            raise WebSocketDisconnect()
+        t, chunk = self.frames[self.index]
+        self.index += 1
+        await asyncio.sleep(max(0.0, self.started + (t - self.frames[0][0]) / 1000 / self.speed - time.monotonic()))
+        return chunk
+
+    async def send_text(self, data: str):
+        self.sent += 1
+
+    async def send_bytes(self, data: bytes):
+        self.sent += 1
+
+    async def close(self):
+        self.client_state = WebSocketState.DISCONNECTED
+
+
+def first_session(path: str):
+    """
+    header and user audio frames of the first session in a capture (a resumed session appends a second one)
+    """
+    header, frames = None, []
+    for t, kind, payload in read_capture(path):
+        if kind == SESSION:
+            if header is not None:
+                break
+            header = payload
+        elif kind == AUDIO_IN:
+            frames.append((t, payload))
+    return header or {}, frames
+
+
+def capture_from_wav(wav: str, output: str, chunk_ms: int = 100):
+    if os.path.exists(output):
+        os.remove(output)
+    audio, sr = sf.read(wav, dtype="int16")
+    if audio.ndim > 1:
+        audio = audio[:, 0]
+    pcm = audio.tobytes()
+    chunk_bytes = sr * chunk_ms // 1000 * 2
+    writer = CaptureWriter(output)
+    writer.header(read_sample_rate=sr, read_num_channels=1)
+    for i in range(0, len(pcm), chunk_bytes):
+        writer.record(AUDIO_IN, pcm[i : i + chunk_bytes], t=i // chunk_bytes * chunk_ms)
+    writer.close()
+    print(f"wrote {len(pcm) // chunk_bytes + 1} frames to {output}")
+
+
+async def replay(args) -> str:
+    header, frames = first_session(args.capture)
+    app = create_app(speed=args.speed)
+    async with serve(app, args.port):
+        with open(args.config, "r") as f:
+            config = load_hyperpyyaml(f, {"standin_url": f"localhost:{args.port}"})
+        session = await LunaAgent.create(
+            config,
+            user_audio_sample_rate=header.get("read_sample_rate", 16000),
+            user_audio_num_channels=header.get("read_num_channels", 1),
+        )
+        session.capture = session.data.capture = session.event.capture = CaptureWriter(args.output)
+        session.capture.header(
+            session_id=session.session_id,
+            started_at=time.time(),
+            read_sample_rate=session.user_audio_sample_rate,
+            read_num_channels=session.user_audio_num_channels,
+            write_sample_rate=session.tts.sample_rate,
+            replay_of=args.capture,
+            speed=args.speed,
+        )
+        await session.event.connect(ReplaySocket())
+        await session.data.connect(ReplaySocket(frames, speed=args.speed, tail_s=args.tail_s))
+        start = time.monotonic()
+        try:
+            await session.listen()
+        except asyncio.CancelledError:
+            # destroy() cancels the listen subtasks once the replayed client disconnects
+            pass
+        print(f"replayed {len(frames)} frames in {time.monotonic() - start:.1f}s, requests: {app.state.requests}")
+    return args.output
+
+
+def diff(recorded: str, replayed: str):
+    a = capture_turns(list(read_capture(recorded)))
+    b = capture_turns(list(read_capture(replayed)))
+
+    def ms(value):
+        return "-" if value is None else f"{value:.0f}"
+
+    print(f"{'turn':>4} {'first audio ms':>22} {'delta':>7} {'audio ms':>17} {'events':>7}")
+    print(f"{'':>4} {'a':>10} {'b':>11} {'':>7} {'a':>8} {'b':>8}")
+    for i in range(max(len(a), len(b))):
+        ta = a[i] if i < len(a) else {"first_audio_ms": None, "audio_ms": None, "events": None}
+        tb = b[i] if i < len(b) else {"first_audio_ms": None, "audio_ms": None, "events": None}
+        delta = None
+        if ta["first_audio_ms"] is not None and tb["first_audio_ms"] is not None:
+            delta = tb["first_audio_ms"] - ta["first_audio_ms"]
+        same = "same" if ta["events"] == tb["events"] else "differ"
+        print(
+            f"{i:>4} {ms(ta['first_audio_ms']):>10} {ms(tb['first_audio_ms']):>11} {ms(delta):>7}"
+            f" {ms(ta['audio_ms']):>8} {ms(tb['audio_ms']):>8} {same:>7}"
+        )
+    for name, turns in [("a", a), ("b", b)]:
+        latencies = [turn["first_audio_ms"] for turn in turns if turn["first_audio_ms"] is not None]
+        if latencies:
+            p50, p95 = np.percentile(latencies, [50, 95])
+            print(f"{name}: {len(turns)} turns, first audio p50 {p50:.0f}ms p95 {p95:.0f}ms")
+        else:
+            print(f"{name}: {len(turns)} turns, no agent audio")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("capture", nargs="?", help="captured session to replay")
+    parser.add_argument("--config", type=str, default=os.path.join(ROOT, "config/replay.yaml"))
+    parser.add_argument("--output", type=str, default=None, help="capture of the replay")
+    parser.add_argument("--speed", type=float, default=1.0)
+    parser.add_argument("--tail-s", type=float, default=5.0, help="wait after the last frame before disconnecting")
+    parser.add_argument("--port", type=int, default=27900, help="port of the stand-in servers")
+    parser.add_argument("--from-wav", type=str, default=None, help="write an input only capture of a wav file")
+    parser.add_argument("--diff", type=str, nargs=2, default=None, metavar=("A", "B"))
+    args = parser.parse_args()
+
+    if args.diff:
+        return diff(*args.diff)
+    if args.from_wav:
+        return capture_from_wav(args.from_wav, args.output or "captures/input.capture")
+    if not args.capture:
+        parser.error("capture is required")
+    args.output = args.output or os.path.splitext(args.capture)[0] + ".replay.capture"
+    if os.path.exists(args.output):
+        os.remove(args.output)
+    asyncio.run(replay(args))
+    diff(args.capture, args.output)
+
+
+if __name__ == "__main__":
+    main()
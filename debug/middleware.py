@@ -1,5 +1,8 @@
 import asyncio
+import base64
 import os
+import time
+from collections import defaultdict
 
 import httpx
 import uvicorn
@@ -8,6 +11,8 @@ from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import Response
 
+from luna_agent.utils import json_codec, safe_create_task
+
 app = FastAPI()
 
 app.add_middleware(
@@ -25,52 +30,114 @@ connections = {
     "user_audio": {},
     "user_event": {},
 }
+# (kind, session_id) -> set once the connection is registered, replaces polling while waiting for the peer
+connected = defaultdict(asyncio.Event)
 
 
 AGENT_PORT = int(os.getenv("AGENT_PORT", "9002"))
+# relay mode passes frames through untouched, the agent must send binary audio (WebRTCData binary_audio: True)
+RELAY = os.getenv("MIDDLEWARE_RELAY", "0") == "1"
+PAIR_TIMEOUT = float(os.getenv("MIDDLEWARE_PAIR_TIMEOUT", "30"))
+IDLE_TIMEOUT = float(os.getenv("MIDDLEWARE_IDLE_TIMEOUT", "300"))
+CLOSE_TIMEOUT = 5.0
+LOG_INTERVAL = float(os.getenv("MIDDLEWARE_LOG_INTERVAL", "5"))
+
+
+class FrameStats:
+    """
+    per direction frame counters, printed at most once every LOG_INTERVAL seconds instead of once per frame
+    """
+
+    def __init__(self, label: str):
+        self.label = label
+        self.frames = self.bytes = 0
+        self.last_frame = self.last_log = time.monotonic()
+
+    def __call__(self, size: int):
+        self.frames += 1
+        self.bytes += size
+        self.last_frame = now = time.monotonic()
+        if now - self.last_log >= LOG_INTERVAL:
+            print(f"[{self.label}] {self.frames} frames, {self.bytes / 1024:.1f} KB in {now - self.last_log:.1f}s")
+            self.frames = self.bytes = 0
+            self.last_log = now
 
-import base64
-import json
 
+async def recv_frame(ws):
+    if hasattr(ws, "recv"):  # agent side, websockets client
+        return await ws.recv()
+    message = await ws.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000))
+    return message["bytes"] if message.get("bytes") is not None else message["text"]
 
-async def forward(src_ws: WebSocket, dst_ws: WebSocket, label: str):
+
+async def send_frame(ws, frame: bytes | str):
+    if hasattr(ws, "recv"):
+        await ws.send(frame)
+    elif isinstance(frame, bytes):
+        await ws.send_bytes(frame)
+    else:
+        await ws.send_text(frame)
+
+
+async def close_quietly(ws):
     try:
-        while True:
-            if label == "agent_audio -> user_audio":
-                # Receive JSON with base64-encoded audio
+        await asyncio.wait_for(ws.close(), CLOSE_TIMEOUT)
+    except Exception:
+        pass
+
+
+async def relay(src_ws, dst_ws, stats: FrameStats):
+    while True:
+        frame = await recv_frame(src_ws)
+        await send_frame(dst_ws, frame)
+        stats(len(frame))
+
+
+async def forward(src_ws, dst_ws, stats: FrameStats):
+    label = stats.label
+    while True:
+        if label == "agent_audio -> user_audio":
+            # Receive JSON with base64-encoded audio
+            msg = await src_ws.recv()
+            if isinstance(msg, bytes):
+                await dst_ws.send_bytes(msg)
+                stats(len(msg))
+                continue
+            try:
+                payload = json_codec.loads(msg)
+                if payload.get("data_type") != "bytes":
+                    continue
+                audio_bytes = base64.b64decode(payload["data"])
+                await dst_ws.send_bytes(audio_bytes)
+                stats(len(audio_bytes))
+            except (json_codec.DecodeError, KeyError, base64.binascii.Error) as e:
+                print(f"[{label}] Error decoding audio JSON: {e}")
+        elif label == "agent_event -> user_event" or label == "user_event -> agent_event":
+            if label == "agent_event -> user_event":
                 msg = await src_ws.recv()
-                try:
-                    payload = json.loads(msg)
-                    if payload.get("data_type") != "bytes":
-                        continue
-                    b64 = payload["data"]
-                    audio_bytes = base64.b64decode(b64)
-                    print(f"[{label}] Audio chunk: {len(audio_bytes)} bytes")
-                    await dst_ws.send_bytes(audio_bytes)
-                except (json.JSONDecodeError, KeyError, base64.binascii.Error) as e:
-                    print(f"[{label}] Error decoding audio JSON: {e}")
-            elif label == "agent_event -> user_event" or label == "user_event -> agent_event":
-                if label == "agent_event -> user_event":
-                    msg = await src_ws.recv()
-                else:
-                    msg = await src_ws.receive_text()
-                try:
-                    event = json.loads(msg)
-                    print(f"[{label}] Event: {json.dumps(event, indent=2)}")
-                except json.JSONDecodeError:
-                    print(f"[{label}] Malformed event: {msg}")
-                await dst_ws.send_text(msg)
             else:
-                assert label == "user_audio -> agent_audio"
-                audio_bytes = await src_ws.receive_bytes()
-                print(f"[{label}] Audio chunk: {len(audio_bytes)} bytes")
-                await dst_ws.send(audio_bytes)
-    except WebSocketDisconnect:
-        print(f"[{label}] disconnected")
-        await asyncio.gather(dst_ws.close(), src_ws.close())
-    except Exception as e:
-        print(f"[{label}] error: {e}")
-        raise
+                msg = await src_ws.receive_text()
+            try:
+                event = json_codec.loads(msg)
+                print(f"[{label}] Event: {event}")
+            except json_codec.DecodeError:
+                print(f"[{label}] Malformed event: {msg}")
+            await send_frame(dst_ws, msg)
+        else:
+            assert label == "user_audio -> agent_audio"
+            audio_bytes = await src_ws.receive_bytes()
+            await dst_ws.send(audio_bytes)
+            stats(len(audio_bytes))
+
+
+async def watchdog(*stats: FrameStats):
+    while True:
+        await asyncio.sleep(min(IDLE_TIMEOUT, 10))
+        if time.monotonic() - max(s.last_frame for s in stats) > IDLE_TIMEOUT:
+            print(f"[{stats[0].label}] idle for {IDLE_TIMEOUT}s, closing")
+            return
 
 
 async def pair_and_stream(kind: str, session_id: str):
@@ -81,32 +148,73 @@ async def pair_and_stream(kind: str, session_id: str):
 
     ws1 = connections[kind][session_id]
 
-    # Wait until both sides are connected
-    # FIXME: add timeout
-    while session_id not in connections[peer_kind]:
-        print(f"[{session_id}] waiting for peer connection...")
-        await asyncio.sleep(1)
+    peer = connected[(peer_kind, session_id)]
+    try:
+        await asyncio.wait_for(peer.wait(), PAIR_TIMEOUT)
+    except asyncio.TimeoutError:
+        print(f"[{session_id}] no {peer_kind} connection after {PAIR_TIMEOUT}s")
+        return
+    finally:
+        # waiting created the entry, drop it if the peer never registered
+        if not peer.is_set() and connected.get((peer_kind, session_id)) is peer:
+            connected.pop((peer_kind, session_id))
     ws2 = connections[peer_kind][session_id]
 
-    if ws1 and ws2:
-        # Launch bidirectional forwarding
-        print(f"Forwarding: {kind} -> {peer_kind}")
-        await asyncio.gather(
-            forward(ws1, ws2, f"{kind} -> {peer_kind}"),
-            forward(ws2, ws1, f"{peer_kind} -> {kind}"),
-        )
+    print(f"Forwarding: {kind} <-> {peer_kind} ({'relay' if RELAY else 'parse'})")
+    pipe = relay if RELAY else forward
+    stats1, stats2 = FrameStats(f"{kind} -> {peer_kind}"), FrameStats(f"{peer_kind} -> {kind}")
+    tasks = [
+        asyncio.create_task(pipe(ws1, ws2, stats1)),
+        asyncio.create_task(pipe(ws2, ws1, stats2)),
+        asyncio.create_task(watchdog(stats1, stats2)),
+    ]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            exc = task.exception()
+            if exc and not isinstance(exc, (WebSocketDisconnect, websockets.ConnectionClosed)):
+                print(f"[{session_id}] {kind} <-> {peer_kind} error: {exc!r}")
+    finally:
+        for task in tasks:
+            task.cancel()
+        unregister(peer_kind, session_id)
+        await asyncio.gather(close_quietly(ws1), close_quietly(ws2))
+        print(f"[{session_id}] {kind} <-> {peer_kind} disconnected")
+
+
+def register(kind: str, session_id: str, ws):
+    connections[kind][session_id] = ws
+    connected[(kind, session_id)].set()
+
+
+def unregister(kind: str, session_id: str):
+    connected.pop((kind, session_id), None)
+    return connections[kind].pop(session_id, None)
+
+
+async def expire_unpaired(session_id: str):
+    """
+    close agent connections of sessions whose user never connected
+    """
+    await asyncio.sleep(PAIR_TIMEOUT)
+    for kind in ("agent_audio", "agent_event"):
+        peer_kind = kind.replace("agent", "user")
+        peer = connected.get((peer_kind, session_id))
+        if (peer is None or not peer.is_set()) and (ws := unregister(kind, session_id)):
+            print(f"[{session_id}] {peer_kind} never connected, closing {kind}")
+            await close_quietly(ws)
 
 
 # Generic handler
 async def websocket_handler(websocket: WebSocket, kind: str, session_id: str):
     await websocket.accept()
-    connections[kind][session_id] = websocket
+    register(kind, session_id, websocket)
     print(f"{kind} connected")
     try:
         await pair_and_stream(kind, session_id)
     finally:
-        connections[kind].pop(session_id, None)
-        await websocket.close()
+        unregister(kind, session_id)
+        await close_quietly(websocket)
         print(f"{kind} connection closed")
 
 
@@ -127,12 +235,13 @@ async def start_session(request: Request):
         response = await client.post(f"http://localhost:{AGENT_PORT}/start_session", json=await request.json())
 
     session_id = response.json().get("session_id")
-    connections["agent_audio"][session_id] = await websockets.connect(
-        f"ws://localhost:{AGENT_PORT}/ws/agent/audio/{session_id}"
+    register(
+        "agent_audio", session_id, await websockets.connect(f"ws://localhost:{AGENT_PORT}/ws/agent/audio/{session_id}")
     )
-    connections["agent_event"][session_id] = await websockets.connect(
-        f"ws://localhost:{AGENT_PORT}/ws/agent/event/{session_id}"
+    register(
+        "agent_event", session_id, await websockets.connect(f"ws://localhost:{AGENT_PORT}/ws/agent/event/{session_id}")
     )
+    safe_create_task(expire_unpaired(session_id))
     print(f"Session started with ID: {session_id}")
     return Response(content=response.content, media_type=response.headers.get("Content-Type", "application/json"))
 
@@ -141,6 +250,10 @@ if __name__ == "__main__":
     import argparse
 
     parser = argparse.ArgumentParser()
+    parser.add_argument("--relay", action="store_true", help="Pass frames through without parsing")
     PORT = int(os.getenv("MIDDLEWARE_PORT", "28002"))
     args = parser.parse_args()
+    if args.relay:
+        # read again by the reloaded app process
+        os.environ["MIDDLEWARE_RELAY"] = "1"
     uvicorn.run("middleware:app", host="0.0.0.0", port=PORT, reload=True)
@@ -0,0 +1,190 @@
+import asyncio
+import math
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Callable, Dict, Iterable, Optional
+
+from luna_agent.utils import logger
+
+
+class SessionUsage:
+    """
+    resources held by one session: buffered bytes, in flight downstream requests / streams, and while profiling
+    (luna_agent.profiling) the event loop time of its tasks and the loop lag it caused (the part of its steps
+    over slow_step_ms)
+    """
+
+    def __init__(self, slow_step_ms: float = 20):
+        self.slow_step_s = slow_step_ms / 1000
+        self.busy_s = 0.0
+        self.lag_s = 0.0
+        self.slow_steps = 0
+        self.in_flight = 0
+        self.requests = 0
+        self.buffered_bytes: Callable[[], int] = lambda: 0  # set by the agent
+        self.created_at = time.monotonic()
+
+    def step(self, seconds: float):
+        self.busy_s += seconds
+        if seconds > self.slow_step_s:
+            self.slow_steps += 1
+            self.lag_s += seconds - self.slow_step_s
+
+    async def downstream(self, coro):
+        """
+        count a downstream request while it is in flight
+        """
+        self.in_flight += 1
+        self.requests += 1
+        try:
+            return await coro
+        finally:
+            self.in_flight -= 1
+
+    def stats(self) -> Dict:
+        return {
+            "age_s": round(time.monotonic() - self.created_at, 1),
+            "buffered_bytes": self.buffered_bytes(),
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "busy_ms": round(self.busy_s * 1000, 1),
+            "lag_ms": round(self.lag_s * 1000, 1),
+            "slow_steps": self.slow_steps,
+        }
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    node level admission for new sessions. when a threshold is exceeded new sessions wait in a fifo queue
+    (up to max_queue of them, for at most queue_timeout seconds) and are rejected with a retry hint after that,
+    so sessions already on the node keep their latency. thresholds <= 0 are disabled
+    """
+
+    def __init__(
+        self,
+        usages: Callable[[], Iterable[SessionUsage]],
+        max_sessions: int = 0,
+        max_loop_lag_ms: float = 200,
+        max_in_flight: int = 0,
+        max_buffered_bytes: int = 0,
+        max_queue: int = 0,
+        queue_timeout: float = 5.0,
+        retry_after: float = 5.0,
+        lag_interval: float = 0.1,
+    ):
+        self.usages = usages
+        self.max_sessions = max_sessions
+        self.max_loop_lag_ms = max_loop_lag_ms
+        self.max_in_flight = max_in_flight
+        self.max_buffered_bytes = max_buffered_bytes
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.lag_interval = lag_interval
+        self.loop_lag_ms = 0.0
+        self.starting = 0  # admitted, not created yet
+        self.queue = deque()
+        self.admitted = self.rejected = 0
+        self.monitor_task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self.monitor_task is None:
+            self.monitor_task = asyncio.create_task(self.monitor())
+
+    async def monitor(self):
+        """
+        loop lag: how late a sleep wakes up, smoothed
+        """
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.lag_interval)
+            lag_ms = max(0.0, (time.perf_counter() - start - self.lag_interval) * 1000)
+            self.loop_lag_ms += 0.2 * (lag_ms - self.loop_lag_ms)
+
+    def load(self) -> Dict:
+        usages = list(self.usages())
+        return {
+            "sessions": len(usages) + self.starting,
+            "in_flight": sum(usage.in_flight for usage in usages),
+            "buffered_bytes": sum(usage.buffered_bytes() for usage in usages),
+            "loop_lag_ms": round(self.loop_lag_ms, 1),
+        }
+
+    def overloaded(self, load: Optional[Dict] = None) -> Optional[str]:
+        """
+        the first exceeded threshold, None when there is capacity for one more session
+        """
+        load = self.load() if load is None else load
+        if self.max_sessions > 0 and load["sessions"] >= self.max_sessions:
+            return "sessions"
+        if self.max_loop_lag_ms > 0 and load["loop_lag_ms"] > self.max_loop_lag_ms:
+            return "loop_lag"
+        if self.max_in_flight > 0 and load["in_flight"] >= self.max_in_flight:
+            return "in_flight"
+        if self.max_buffered_bytes > 0 and load["buffered_bytes"] >= self.max_buffered_bytes:
+            return "buffered_bytes"
+        return None
+
+    def retry_hint(self) -> float:
+        return math.ceil(self.retry_after * (1 + len(self.queue) / max(1, self.max_queue)))
+
+    async def wait(self):
+        reason = self.overloaded()
+        if reason is None and not self.queue:
+            return
+        if reason is not None and len(self.queue) >= self.max_queue:
+            raise AdmissionRejected(reason, self.retry_hint())
+        ticket = object()
+        self.queue.append(ticket)
+        deadline = time.monotonic() + self.queue_timeout
+        try:
+            while True:
+                if self.queue[0] is ticket:
+                    reason = self.overloaded()
+                    if reason is None:
+                        return
+                if time.monotonic() >= deadline:
+                    raise AdmissionRejected(reason or "queue", self.retry_hint())
+                await asyncio.sleep(0.05)
+        finally:
+            self.queue.remove(ticket)
+
+    @asynccontextmanager
+    async def slot(self):
+        """
+        hold a slot while the session is created, raises AdmissionRejected when there is none
+        """
+        try:
+            await self.wait()
+        except AdmissionRejected as e:
+            self.rejected += 1
+            logger.warning(f"Rejected new session, {e.reason} over threshold, retry after {e.retry_after}s")
+            raise
+        self.admitted += 1
+        self.starting += 1
+        try:
+            yield
+        finally:
+            self.starting -= 1
+
+    def capacity(self) -> Dict:
+        load = self.load()
+        reason = self.overloaded(load)
+        return {
+            "accepting": reason is None,
+            "reason": reason,
+            **load,
+            "max_sessions": self.max_sessions,
+            "available_sessions": max(0, self.max_sessions - load["sessions"]) if self.max_sessions > 0 else None,
+            "queued": len(self.queue),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+        }
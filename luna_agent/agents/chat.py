@@ -1,18 +1,17 @@
 import argparse
 import asyncio
-import logging
 import os
 import time
 from enum import Enum
-from typing import Dict, List, Optional
+from typing import Dict, Optional
 from uuid import uuid4
 
 import uvicorn
-from asyncstdlib.itertools import tee
-from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
-from fastapi.middleware.cors import CORSMiddleware
-from hyperpyyaml import load_hyperpyyaml
+from fastapi import Request
+from fastapi.responses import JSONResponse
 
+from luna_agent.admission import AdmissionRejected
+from luna_agent.capture import CaptureWriter
 from luna_agent.components import (
     ASR,
     LLM,
@@ -22,15 +21,20 @@ from luna_agent.components import (
     WebRTCDataLiveStream,
     WebRTCEvent,
 )
-from luna_agent.components.slm import add_agent_message, add_user_message
-from luna_agent.utils import AsyncTaskMixin, logger, safe_create_task
-
-logging.basicConfig(
-    format="%(asctime)s.%(msecs)03d - %(name)s - %(levelname)s - %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-)
-
-logger.setLevel(logging.INFO)
+from luna_agent.components.asr import StreamingASR, Transcript
+from luna_agent.components.filler import Filler
+from luna_agent.components.tts_cache import TTSCache
+from luna_agent.history import History
+from luna_agent.lifecycle import Session
+from luna_agent.log import Sampled, setup_logging, turn_id_var
+from luna_agent.pipeline import Broadcast, Channel, Consumer, Pipeline, Source, StreamStage, VADResult
+from luna_agent.runtime import AgentHost, Runtime, rejected
+from luna_agent.session import MemorySessionStore, load_snapshot, save_snapshot
+from luna_agent.timeline import ResponseTimeline
+from luna_agent.utils import TokenStream, logger, uvicorn_options
+
+setup_logging()
+speech_log = Sampled(logger, every=50)
 
 
 class AgentStatus(Enum):
@@ -39,33 +43,65 @@ class AgentStatus(Enum):
     SPEAKING = "speaking"
 
 
-class LunaAgent(AsyncTaskMixin):
+class LunaAgent(Session):
     sessions = {}
+    store: MemorySessionStore = MemorySessionStore()
 
     def __init__(self, config):
         super().__init__()
         self.vad: VAD = config["vad"]
         self.asr: ASR = config["asr"]
+        self.streaming_asr: Optional[StreamingASR] = config.get("streaming_asr")
         self.slm: SLM = config["slm"]
         self.tts: TTS = config["tts"]
         self.data: WebRTCDataLiveStream = config["data"]
         self.event: WebRTCEvent = config["event"]
-        self.tts_control: Optional[LLM] = config["tts_control"]
-        self.diar_control: Optional[LLM] = config["diar_control"]
+        self.tts_control: Optional[LLM] = config.get("tts_control")
+        self.diar_control: Optional[LLM] = config.get("diar_control")
+        self.control: Optional[LLM] = config.get("control")  # both questions in one request, replaces the two
+        self.caption_events: bool = config.get("caption_events", False)
+        self.filler: Optional[Filler] = config.get("filler")
+        self.capture_dir: Optional[str] = config.get("capture_dir")
+        self.capture: Optional[CaptureWriter] = None
 
         self.session_id = uuid4().hex
         self.sample_rate = 16000
+        self.user_audio_sample_rate = 16000
+        self.user_audio_num_channels = 1
+        self.user_audio_codec = "pcm"
 
-        self.history: List[Dict] = []
+        self.history: History = config.get("history") or History()
         self.agent_status = AgentStatus.LISTENING
-        self.buffer = asyncio.Queue()
+        self.audio: Channel[bytes] = Channel("audio", bytes)  # user audio, from the client to the vad / asr
+        self.pipeline: Optional[Pipeline] = None
+        self.usage.buffered_bytes = lambda: (
+            (self.pipeline.buffered_bytes() if self.pipeline else self.audio.buffered_bytes)
+            + len(self.vad.data)
+            + len(getattr(self.data, "buffer", ()))
+        )
         self.prev_response_task: Optional[asyncio.Task] = None
+        self.timeline: Optional[ResponseTimeline] = None
+        self.voice = "default"  # timbre picked by tts_control, used to match the filler voice
 
     @classmethod
-    async def create(cls, config, user_audio_sample_rate: int = 16000, user_audio_num_channels: int = 1):
+    async def create(
+        cls,
+        config,
+        user_audio_sample_rate: int = 16000,
+        user_audio_num_channels: int = 1,
+        user_audio_codec: str = "pcm",
+        snapshot: Optional[Dict] = None,
+    ):
         session = cls(config)
+        session.user_audio_sample_rate = user_audio_sample_rate
+        session.user_audio_num_channels = user_audio_num_channels
+        session.user_audio_codec = user_audio_codec
+        if snapshot is not None:
+            session.session_id = snapshot["session_id"]
+            session.history.load(snapshot["history"])
         await asyncio.gather(
             session.vad.setup(),
+            session.streaming_asr.setup() if session.streaming_asr else asyncio.sleep(0),
             session.slm.setup(session_id=session.session_id),
             session.tts.setup(session_id=session.session_id),
             session.data.setup(
@@ -73,9 +109,22 @@ class LunaAgent(AsyncTaskMixin):
                 read_src_channels=user_audio_num_channels,
                 write_src_sr=session.tts.sample_rate,
                 write_dst_sr=session.tts.sample_rate,
+                codec=user_audio_codec,
             ),
         )
         cls.sessions[session.session_id] = session
+        if session.capture_dir:
+            # a resumed session appends to the same file, starting with a new header
+            session.capture = session.data.capture = session.event.capture = CaptureWriter(
+                os.path.join(session.capture_dir, f"{session.session_id}.capture")
+            )
+            session.capture.header(
+                session_id=session.session_id,
+                started_at=time.time(),
+                read_sample_rate=user_audio_sample_rate,
+                read_num_channels=user_audio_num_channels,
+                write_sample_rate=session.tts.sample_rate,
+            )
 
         async def on_flush():
             await session.agent_status_changed(AgentStatus.LISTENING)
@@ -83,86 +132,216 @@ class LunaAgent(AsyncTaskMixin):
         session.data.on_flush = on_flush
         return session
 
-    async def listen(self):
-
-        async def receive_user_audio():
-            while not self.data.ready:
-                await asyncio.sleep(0.1)
+    @classmethod
+    def add_routes(cls, host: AgentHost):
+        router = host.router
+
+        @router.post("/resume_session")
+        async def resume_session(request: Request):
+            body = await request.json()
+            session_id = body.get("session_id")
+            if session_id in cls.sessions:
+                # the client noticed the drop before we did
+                await cls.sessions[session_id].suspend()
+            snapshot = await load_snapshot(cls.store, session_id)
+            if snapshot is None:
+                return JSONResponse({"error": f"session {session_id} cannot be resumed"}, status_code=404)
+            state = snapshot["state"]
             try:
-                async for chunk in self.data.read():
-                    logger.debug(f"Received audio chunk of size {len(chunk)}")
-                    await self.buffer.put(chunk)
-                await self.buffer.put(None)
-            except WebSocketDisconnect:
-                await self.destroy()
-
-        async def detect_speech():
-            while True:
-                chunk = await self.buffer.get()
-                if chunk is None:
-                    break
-                await self.vad(chunk)
-
-        async def response_if_speech():
-            async for user_is_speaking, user_speech in self.vad.results():
-                if self.agent_status != AgentStatus.LISTENING and user_is_speaking:
-                    logger.info(f"User interrupt: {user_is_speaking}")
-                    await self.agent_status_changed(AgentStatus.LISTENING)
-                    await self.cancel_prev_response()
-                if user_speech is not None:
-                    await self.cancel_prev_response()
-                    self.prev_response_task = self.create_task(self.response(user_speech))
+                session = await host.start_session(
+                    user_audio_sample_rate=body.get("sample_rate", state["user_audio_sample_rate"]),
+                    user_audio_num_channels=body.get("num_channels", state["user_audio_num_channels"]),
+                    user_audio_codec=body.get("codec", state.get("user_audio_codec", "pcm")),
+                    snapshot=snapshot,
+                )
+            except AdmissionRejected as e:
+                # the snapshot stays in the store until it expires, the client can retry
+                return rejected(e)
+            await cls.store.delete(f"session/{session_id}")
+            logger.info(f"Resumed session with id: {session.session_id}, {len(session.history)} history messages")
+            return {"session_id": session.session_id, "codec": session.data.codec_name}
+
+        @router.post("/mute")
+        async def mute(request: Request):
+            body = await request.json()
+            session_id = body.get("session_id")
+            await cls.sessions.get(session_id).mute_user()
+            return {"status": "success"}
+
+        @router.get("/playback/{session_id}")
+        async def playback(session_id: str):
+            session = cls.sessions.get(session_id)
+            if session is None:
+                return JSONResponse({"error": f"session {session_id} not found"}, status_code=404)
+            return {"position": session.playback_position()}
+
+        @router.get("/tts_cache")
+        async def tts_cache():
+            return TTSCache.all_stats()
 
-        await asyncio.gather(
-            receive_user_audio(), self.create_task(detect_speech()), self.create_task(response_if_speech())
-        )
+    @classmethod
+    def configure(cls, resume_grace: float = 60):
+        """
+        resume_grace: seconds a dropped session can be resumed
+        """
+        cls.store = MemorySessionStore(ttl=resume_grace)
+
+    @classmethod
+    async def startup(cls, host: AgentHost):
+        config = host.load_config()
+        if config.get("filler") is not None:
+            await config["filler"].load()
+
+    async def listen(self):
+        stages = [Source(self.data, on_disconnect=self.suspend)]
+        if self.streaming_asr is None:
+            stages.append(StreamStage(self.vad, "vad", VADResult))
+        else:
+            stages += [
+                Broadcast("audio", ("vad_audio", "asr_audio")),
+                StreamStage(self.vad, "vad", VADResult, input="vad_audio"),
+                StreamStage(self.streaming_asr, "transcripts", Transcript, input="asr_audio"),
+                Consumer("transcripts", Transcript, self.user_transcript),
+            ]
+        stages.append(Consumer("vad", VADResult, self.response_if_speech))
+        self.pipeline = Pipeline(*stages, channels={"audio": self.audio}, create_task=self.create_task)
+        await self.pipeline.run()
+
+    async def response_if_speech(self, result: VADResult):
+        user_is_speaking, user_speech = result
+        if self.agent_status != AgentStatus.LISTENING and user_is_speaking:
+            logger.info("User interrupt: %s", user_is_speaking)
+            await self.agent_status_changed(AgentStatus.LISTENING)
+            await self.cancel_prev_response()
+        if user_speech is not None:
+            await self.cancel_prev_response()
+            self.prev_response_task = self.create_task(self.response(user_speech))
+
+    async def user_transcript(self, transcript: Transcript):
+        if self.caption_events and transcript.text:
+            await self.event.send_event(
+                event="user_transcript",
+                data={"timestamp": int(time.time() * 1000), "text": transcript.text, "final": transcript.final},
+            )
+
+    def transcribe(self, user_speech: bytes):
+        if self.streaming_asr is not None:
+            return self.streaming_asr.final(user_speech)
+        return self.asr(user_speech)
 
     async def mute_user(self):
         logger.info("User muted")
         chunk = b"0x00" * self.sample_rate
-        await self.buffer.put(chunk)
+        await self.audio.put(chunk)
 
     async def response(self, user_speech: bytes):
         await self.agent_status_changed(AgentStatus.THINKING)
         response_timestamp = int(time.time() * 1000)
-        asr_task = self.create_task(self.asr(user_speech))
-        slm_task = self.create_task(self.slm(history=self.history[:], audio=user_speech))
-        user_transcript = await asr_task
-        logger.info(f"User transcript: {user_transcript}")
-        add_user_message(self.history, audio=user_speech, transcript=user_transcript)
-
-        tts_control_task = self.create_task(
-            self.tts_control(user_transcript) if self.tts_control else asyncio.sleep(0, result={})
-        )
-        diar_control_task = self.create_task(
-            self.diar_control(user_transcript) if self.diar_control else asyncio.sleep(0, result={})
-        )
-        tts_control, diar_control = await asyncio.gather(tts_control_task, diar_control_task)
-        tts_control["speech"] = user_speech
-        tts_control["transcript"] = user_transcript
-
-        if not diar_control.get("response", True):
-            return
+        turn_id_var.set(response_timestamp)  # this task and its subtasks log with the turn
+        downstream = self.usage.downstream
+        history = self.history.view()
+        asr_task = self.create_task(downstream(self.transcribe(user_speech)))
+        slm_task = self.create_task(downstream(self.slm(history=history, audio=user_speech)))
+        subtasks = [asr_task, slm_task]
+        filler_task = None
+        if self.filler is not None:
+            filler_task = self.create_task(self.filler(self.data, voice=self.voice))
+            subtasks.append(filler_task)
+        agent_text: Optional[TokenStream] = None
+        agent_speech_generator = None
 
-        agent_text_generator = await slm_task
-        agent_text_generator1, agent_text_generator2 = tee(agent_text_generator, 2)
-        tts_task = self.create_task(self.tts(text_generateor=agent_text_generator1, control=tts_control))
-        await self.set_avatar(tts_control["timbre"])
-
-        agent_speech_generator = await tts_task
-        await self.agent_status_changed(AgentStatus.SPEAKING)
         try:
+            user_transcript = await asr_task
+            logger.info("User transcript: %s", user_transcript)
+            self.history.append_user(audio=user_speech, transcript=user_transcript)
+
+            if self.control is not None:
+                control_task = self.create_task(downstream(self.control(user_transcript)))
+                subtasks.append(control_task)
+                tts_control = await control_task
+                diar_control = tts_control.copy()
+            else:
+                tts_control_task = self.create_task(
+                    downstream(self.tts_control(user_transcript)) if self.tts_control else asyncio.sleep(0, result={})
+                )
+                diar_control_task = self.create_task(
+                    downstream(self.diar_control(user_transcript)) if self.diar_control else asyncio.sleep(0, result={})
+                )
+                subtasks += [tts_control_task, diar_control_task]
+                tts_control, diar_control = await asyncio.gather(tts_control_task, diar_control_task)
+            timbre = tts_control.get("timbre", "default")
+            if timbre == "reset":
+                self.voice = "default"
+            elif timbre != "default":
+                self.voice = timbre
+            tts_control["speech"] = user_speech
+            tts_control["transcript"] = user_transcript
+
+            if not diar_control.get("response", True):
+                if filler_task is not None:
+                    # no reply follows, neither should a filler
+                    filler_task.cancel()
+                    self.data.stop_filler()
+                return
+            if diar_control.get("diarization", False) and self.slm.lazy_diarization:
+                # the slm request went out with the speakers known so far, redo it once the pending utterances
+                # are diarized
+                speculative, slm_task = slm_task, self.create_task(
+                    downstream(self.slm(history=history, audio=user_speech, diarize=True))
+                )
+                subtasks.append(slm_task)
+                speculative.cancel()
+                if speculative.done() and not speculative.cancelled() and speculative.exception() is None:
+                    await speculative.result().aclose()
+
+            # read by the tts, its text so far goes to the history
+            agent_text = TokenStream(await slm_task)
+            # the slm and tts streams, until the reply is done
+            self.usage.in_flight += 2
+            self.timeline = self.data.timeline = ResponseTimeline(
+                self.data,
+                response_id=response_timestamp,
+                on_segment_start=self.caption if self.caption_events else None,
+            )
+            tts_task = self.create_task(
+                self.tts(
+                    text_generateor=agent_text.reader(),
+                    control=tts_control,
+                    on_segment=self.timeline.add_segment,
+                    buffered_ms=self.data.buffered_ms,
+                )
+            )
+            subtasks.append(tts_task)
+            await self.set_avatar(tts_control.get("timbre", "default"))
+
+            agent_speech_generator = await tts_task
+            await self.agent_status_changed(AgentStatus.SPEAKING)
             async for agent_speech in agent_speech_generator:
-                logger.debug(f"Agent speech chunk of size {len(agent_speech)}")
+                if filler_task is not None:
+                    # too late if it already started, the live stream crossfades it into the reply
+                    filler_task.cancel()
+                    filler_task = None
+                speech_log.debug("Agent speech chunk of size %d", len(agent_speech))
                 await self.data.write(agent_speech, timestamp=response_timestamp)
         except asyncio.CancelledError:
-            logger.info(f"response {response_timestamp} cancelled")
+            logger.info("response %d cancelled", response_timestamp)
         finally:
-            await agent_text_generator.aclose()
-            await agent_speech_generator.aclose()
-            agent_text = "".join([chunk async for chunk in agent_text_generator2])
-            add_agent_message(history=self.history, message=agent_text)
-            self.data.flush()
+            # abort whatever is still in flight upstream: asr / control requests, the slm and tts streams
+            for task in subtasks:
+                task.cancel()
+            slm_done = slm_task.done() and not slm_task.cancelled() and slm_task.exception() is None
+            if agent_text is None and slm_done:
+                await slm_task.result().aclose()
+            if agent_speech_generator is not None:
+                await agent_speech_generator.aclose()
+            if agent_text is not None:
+                self.usage.in_flight -= 2
+                await agent_text.aclose()
+                # the full reply for now, cut back to what was played if the user interrupts playback
+                self.history.append_agent(agent_text.text())
+                self.timeline.finish()
+                self.timeline.history_index = len(self.history) - 1
+                self.data.flush()
 
     async def agent_status_changed(self, status: AgentStatus):
         self.agent_status = status
@@ -175,78 +354,126 @@ class LunaAgent(AsyncTaskMixin):
         if avatar != "default":
             await self.event.send_event(event="set_avatar", data={"avatar": avatar})
 
+    async def caption(self, index: int, text: str):
+        await self.event.send_event(
+            event="segment_started",
+            data={
+                "timestamp": int(time.time() * 1000),
+                "response_id": self.timeline.response_id,
+                "index": index,
+                "text": text,
+            },
+        )
+
+    def playback_position(self) -> Optional[Dict]:
+        return self.timeline.position() if self.timeline else None
+
+    def truncate_history(self):
+        """
+        replace the last reply in history with the part that was played before the interrupt
+        """
+        timeline = self.timeline
+        if timeline is None or timeline.history_index is None or timeline.finished():
+            return
+        spoken = timeline.spoken_text()
+        logger.info(f"Reply interrupted after: {spoken}")
+        self.history.set_text(timeline.history_index, spoken)
+
     async def cancel_prev_response(self):
         if self.prev_response_task and not self.prev_response_task.done():
             self.prev_response_task.cancel()
+            # let it record its reply before cutting it back
+            await asyncio.wait([self.prev_response_task], timeout=1)
+        self.truncate_history()
         self.data.clear()
 
-    async def destroy(self):
-        logger.info(f"Destroying session {self.session_id}")
+    async def suspend(self):
+        """
+        snapshot the session so /resume_session can pick it up within the store's ttl, then tear it down
+        """
+        if self.destroyed:
+            return
+        await save_snapshot(
+            self.store,
+            self.session_id,
+            self.history.messages(),
+            user_audio_sample_rate=self.user_audio_sample_rate,
+            user_audio_num_channels=self.user_audio_num_channels,
+            user_audio_codec=self.user_audio_codec,
+        )
+        await self.destroy()
+
+    async def expire(self):
+        await self.suspend()
+
+    async def close(self):
         await asyncio.gather(
             self.cancel_prev_response(),
             self.vad.close(),
+            self.slm.close(),
+            self.streaming_asr.close() if self.streaming_asr else asyncio.sleep(0),
             self.data.close(),
             self.event.close(),
         )
-        super().destroy()
-        if self.session_id in self.sessions:
-            del self.sessions[self.session_id]
+        self.history.close()
+        if self.capture is not None:
+            self.capture.close()
 
 
 PORT = int(os.getenv("AGENT_PORT", "28001"))
-parser = argparse.ArgumentParser()
-parser.add_argument("--config", type=str, help="Path to the config file", default="config/chat.yaml")
-parser.add_argument("--port", type=int, default=PORT)
-parser.add_argument("--reload", action="store_true", help="Enable auto-reload for development")
-args, _ = parser.parse_known_args()
-
-app = FastAPI()
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],  # or ["*"] for all origins
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
 
 
-@app.post("/start_session")
-async def start_session(request: Request):
-    body = await request.json()
-    sample_rate = body.get("sample_rate", 16000)
-    num_channels = body.get("num_channels", 1)
-    with open(args.config, "r") as f:
-        config = load_hyperpyyaml(f)
-    session = await LunaAgent.create(
-        config,
-        user_audio_sample_rate=sample_rate,
-        user_audio_num_channels=num_channels,
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, help="Path to the config file", default="config/chat.yaml")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--reload", action="store_true", help="Enable auto-reload for development")
+    parser.add_argument("--fast-loop", action="store_true", help="Run the server on uvloop + httptools")
+    parser.add_argument("--resume-grace", type=float, default=60, help="Seconds a dropped session can be resumed")
+    parser.add_argument("--max-sessions", type=int, default=0, help="Sessions per node, 0 for no limit")
+    parser.add_argument(
+        "--max-loop-lag-ms", type=float, default=200, help="Stop admitting sessions above this loop lag"
     )
-    safe_create_task(session.listen())
-    logger.info(f"Started session with id: {session.session_id}")
-    return {"session_id": session.session_id}
-
-
-@app.post("/mute")
-async def mute(request: Request):
-    body = await request.json()
-    session_id = body.get("session_id")
-    await LunaAgent.sessions.get(session_id).mute_user()
-    return {"status": "success"}
-
-
-@app.websocket("/ws/agent/audio/{session_id}")
-async def ws_user_audio(websocket: WebSocket, session_id: str):
-    await LunaAgent.sessions[session_id].data.connect(websocket)
-    await LunaAgent.sessions[session_id].data.closed.wait()
-
-
-@app.websocket("/ws/agent/event/{session_id}")
-async def ws_user_event(websocket: WebSocket, session_id: str):
-    await LunaAgent.sessions[session_id].event.connect(websocket)
-    await LunaAgent.sessions[session_id].event.closed.wait()
+    parser.add_argument("--max-in-flight", type=int, default=0, help="Downstream requests per node, 0 for no limit")
+    parser.add_argument("--admission-queue", type=int, default=0, help="New sessions allowed to wait for capacity")
+    parser.add_argument("--admission-timeout", type=float, default=5, help="Seconds a new session waits for capacity")
+    parser.add_argument(
+        "--idle-timeout", type=float, default=120, help="Seconds without audio before a session expires"
+    )
+    parser.add_argument("--profile", action="store_true", help="Profile the agent, serves /admin/profile")
+    return parser.parse_known_args()[0]
+
+
+def create_app():
+    """
+    the standalone chat agent from the command line, called by uvicorn (again in its worker with --reload).
+    luna_agent.runtime takes the same options from its config
+    """
+    args = parse_args()
+    runtime = Runtime(
+        {
+            "chat": AgentHost(
+                LunaAgent, args.config, idle_timeout=args.idle_timeout, options={"resume_grace": args.resume_grace}
+            )
+        },
+        prefixed=False,
+        max_sessions=args.max_sessions,
+        max_loop_lag_ms=args.max_loop_lag_ms,
+        max_in_flight=args.max_in_flight,
+        max_queue=args.admission_queue,
+        queue_timeout=args.admission_timeout,
+        profile=args.profile,
+    )
+    return runtime.app
 
 
 if __name__ == "__main__":
-    uvicorn.run("chat:app", host="0.0.0.0", port=args.port, reload=args.reload)
+    args = parse_args()
+    uvicorn.run(
+        "chat:create_app",
+        factory=True,
+        host="0.0.0.0",
+        port=args.port,
+        reload=args.reload,
+        **uvicorn_options(args.fast_loop),
+    )
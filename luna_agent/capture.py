@@ -0,0 +1,80 @@
+import os
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import msgpack
+
+from luna_agent.utils import logger
+
+CAPTURE_VERSION = 1
+
+# record kinds
+SESSION = "session"  # header: session id and audio formats
+AUDIO_IN = "audio_in"  # user audio as received, before resampling
+AUDIO_OUT = "audio_out"  # agent audio as written by the agent, before pacing / resampling
+TEXT_OUT = "text_out"
+EVENT = "event"
+
+Record = Tuple[float, str, Any]  # (ms since the capture started, kind, payload)
+
+
+class CaptureWriter:
+    """
+    appends timestamped frames and events of one session to a file, one msgpack array per record.
+    shared by the session's data and event channels, see WebRTCData.capture
+    """
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.file = open(path, "ab")
+        self.start = time.monotonic()
+        self.packer = msgpack.Packer(use_bin_type=True)
+
+    def record(self, kind: str, payload: Any, t: Optional[float] = None):
+        """
+        t: ms since the capture started, defaults to now
+        """
+        if self.file is None:
+            return
+        if t is None:
+            t = (time.monotonic() - self.start) * 1000
+        self.file.write(self.packer.pack((round(t, 3), kind, payload)))
+
+    def header(self, **info):
+        self.record(SESSION, {"version": CAPTURE_VERSION, **info})
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            logger.info(f"Session captured to {self.path}")
+
+
+def read_capture(path: str) -> Iterator[Record]:
+    with open(path, "rb") as f:
+        for t, kind, payload in msgpack.Unpacker(f, raw=False):
+            yield t, kind, payload
+
+
+def capture_turns(records: List[Record]) -> List[Dict]:
+    """
+    split a capture into turns at each agent_status_changed "thinking" event, with the time to the first agent
+    audio (response latency) and the amount of agent audio of each turn
+    """
+    header: Optional[Dict] = next((payload for _, kind, payload in records if kind == SESSION), None)
+    sample_rate = header.get("write_sample_rate", 16000) if header else 16000
+    turns = []
+    for t, kind, payload in records:
+        if kind == EVENT and payload["event"] == "agent_status_changed" and payload["data"]["status"] == "thinking":
+            turns.append({"start": t, "first_audio_ms": None, "audio_ms": 0.0, "events": []})
+        elif not turns:
+            continue
+        elif kind == AUDIO_OUT:
+            turn = turns[-1]
+            if turn["first_audio_ms"] is None:
+                turn["first_audio_ms"] = t - turn["start"]
+            turn["audio_ms"] += len(payload) * 1000 / sample_rate / 2
+        elif kind == EVENT:
+            turns[-1]["events"].append(payload["event"])
+    return turns
@@ -2,10 +2,22 @@ from .llm import LLM
 from .slm import SLM
 from .tts import TTS
 from .vad import VAD
-from .asr import ASR
+from .asr import ASR, StreamingASR
 from .interpret import Interpret
 from .echo import Echo
 
 from .webrtc import WebRTCEvent, WebRTCData, WebRTCDataLiveStream
 
-__all__ = ["VAD", "ASR", "SLM", "LLM", "TTS", "Interpret", "Echo", "WebRTCEvent", "WebRTCData", "WebRTCDataLiveStream"]
+__all__ = [
+    "VAD",
+    "ASR",
+    "StreamingASR",
+    "SLM",
+    "LLM",
+    "TTS",
+    "Interpret",
+    "Echo",
+    "WebRTCEvent",
+    "WebRTCData",
+    "WebRTCDataLiveStream",
+]
@@ -1,16 +1,124 @@
+import asyncio
+from typing import AsyncGenerator, Dict, NamedTuple, Optional
+
 import httpx
-from luna_agent.utils import pcm2wav
+import websockets
+
+from luna_agent.endpoints import EndpointGroup
+from luna_agent.utils import json_codec, logger, pcm2wav
 
 
 class ASR:
-    def __init__(self, base_url: str):
-        self.base_url = base_url
+    def __init__(self, base_url: Optional[str] = None, endpoints: Optional[EndpointGroup] = None):
+        """
+        endpoints: asr replicas, instead of base_url
+        """
+        self.endpoints = endpoints if endpoints is not None else EndpointGroup.single(base_url)
+        self.base_url = self.endpoints.urls[0]
 
     async def __call__(self, audio: bytes) -> str:
         audio_wav = pcm2wav(audio)
         files = {"audio": ("test.wav", audio_wav, "application/octet-stream")}
-        async with httpx.AsyncClient(timeout=5.0) as client:
-            response = await client.post(self.base_url, files=files)
-        response.raise_for_status()
-        transcript = response.json()["transcript"]
-        return transcript
+
+        async def transcribe(url: str) -> str:
+            async with httpx.AsyncClient(timeout=5.0) as client:
+                response = await client.post(url, files=files)
+            response.raise_for_status()
+            return response.json()["transcript"]
+
+        return await self.endpoints.request(transcribe)
+
+
+class Transcript(NamedTuple):
+    text: str
+    final: bool
+
+
+class StreamingASR:
+    """
+    websocket client of a streaming asr server, fed with the user audio as it arrives (in parallel with the vad),
+    so the transcript of a turn is ready right after the vad ends it.
+
+    protocol: binary frames of 16k pcm from the client, {"type": "partial", "text"} from the server while it
+    decodes, {"type": "finalize", "id"} from the client at the end of a turn, answered with
+    {"type": "final", "id", "text"} for all audio since the previous finalize
+    """
+
+    def __init__(self, base_url: str, fallback: Optional[ASR] = None, final_timeout_ms: int = 500):
+        """
+        fallback: batch asr used when the server is unreachable, drops the connection or is late with a final
+        """
+        self.base_url = base_url
+        self.fallback = fallback
+        self.final_timeout = final_timeout_ms / 1000
+        self.ws = None
+        self.partial = ""
+        self.finals: Dict[int, asyncio.Future] = {}
+        self.next_id = 0
+
+    async def setup(self):
+        try:
+            self.ws = await websockets.connect(self.base_url)
+        except (OSError, websockets.exceptions.WebSocketException) as e:
+            logger.warning(f"Streaming ASR unavailable, using batch ASR: {e}")
+
+    async def __call__(self, chunk: bytes):
+        if self.ws is None:
+            return
+        try:
+            await self.ws.send(chunk)
+        except websockets.exceptions.ConnectionClosed:
+            self.lost()
+
+    async def results(self) -> AsyncGenerator[Transcript, None]:
+        if self.ws is None:
+            return
+        try:
+            async for message in self.ws:
+                message = json_codec.loads(message)
+                if message["type"] == "final":
+                    self.partial = ""
+                    future = self.finals.get(message["id"])
+                    if future is not None and not future.done():
+                        future.set_result(message["text"])
+                    yield Transcript(message["text"], True)
+                else:
+                    self.partial = message["text"]
+                    yield Transcript(message["text"], False)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        self.lost()
+
+    def lost(self):
+        if self.ws is not None:
+            logger.warning("Streaming ASR connection lost, using batch ASR")
+        self.ws = None
+
+    async def final(self, audio: bytes) -> str:
+        """
+        transcript of the turn that just ended, audio is only sent to the fallback
+        """
+        if self.ws is not None:
+            request_id, self.next_id = self.next_id, self.next_id + 1
+            future = self.finals[request_id] = asyncio.get_running_loop().create_future()
+            try:
+                await self.ws.send(json_codec.dumps({"type": "finalize", "id": request_id}))
+                return await asyncio.wait_for(future, self.final_timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Streaming ASR final {request_id} late, using batch ASR")
+            except websockets.exceptions.ConnectionClosed:
+                self.lost()
+            finally:
+                del self.finals[request_id]
+        if self.fallback is None:
+            raise RuntimeError("Streaming ASR unavailable and no fallback configured")
+        return await self.fallback(audio)
+
+    async def close(self):
+        ws, self.ws = self.ws, None
+        if ws is None:
+            return
+        try:
+            await ws.close()
+        except Exception as e:
+            logger.error(f"Error closing streaming ASR websocket: {e}")
@@ -0,0 +1,126 @@
+"""
+compressed audio between the client and the agent. a client asks for a codec with the `codec` field of the
+/start_session body and reads the one it got from the response, "pcm" when the codec is not available here
+(opuslib / libopus not installed, a sample rate opus does not support)
+"""
+
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+from luna_agent.utils import logger
+
+
+class OpusCodec:
+    """
+    opus decoder for the user's audio, one binary websocket message per packet, and encoder for the agent's.
+    encoding / decoding runs on a process wide thread pool (libopus releases the gil). the session's encoder calls
+    take turns on a lock so its state stays ordered, packets are decoded one at a time by the read loop
+    """
+
+    name = "opus"
+    SAMPLE_RATES = (8000, 12000, 16000, 24000, 48000)
+    FRAME_MS = (20, 10, 5, 2.5)  # the longest that fit, audio not filling 2.5ms waits for the next write
+    MAX_PACKET_MS = 120
+    workers = int(os.getenv("LUNA_CODEC_WORKERS", str(os.cpu_count() or 1)))
+    pool: Optional[ThreadPoolExecutor] = None
+
+    def __init__(
+        self,
+        read_sample_rate: int,
+        read_num_channels: int,
+        write_sample_rate: int,
+        write_num_channels: int,
+        bitrate: Optional[int] = None,
+    ):
+        import opuslib
+
+        self.decoder = opuslib.Decoder(read_sample_rate, read_num_channels)
+        self.max_frame_size = read_sample_rate * self.MAX_PACKET_MS // 1000
+        self.encoder = opuslib.Encoder(write_sample_rate, write_num_channels, opuslib.APPLICATION_VOIP)
+        if bitrate:
+            self.encoder.bitrate = bitrate
+        self.write_num_channels = write_num_channels
+        self.frame_bytes = [int(write_sample_rate * ms) // 1000 * 2 * write_num_channels for ms in self.FRAME_MS]
+        self.pending = b""  # audio shorter than the shortest frame, sent with the next write or flush()
+        self.lock = asyncio.Lock()
+        self.resets = 0
+
+    @classmethod
+    def run(cls, fn, *args):
+        if cls.workers <= 0:
+            future = asyncio.get_running_loop().create_future()
+            future.set_result(fn(*args))
+            return future
+        if cls.pool is None:
+            cls.pool = ThreadPoolExecutor(max_workers=cls.workers, thread_name_prefix="codec")
+        return asyncio.get_running_loop().run_in_executor(cls.pool, fn, *args)
+
+    async def decode(self, packet: bytes) -> bytes:
+        return await self.run(self.decoder.decode, packet, self.max_frame_size)
+
+    async def encode(self, pcm: bytes) -> List[bytes]:
+        async with self.lock:
+            resets = self.resets
+            packets = await self.run(self.encode_frames, pcm)
+            if self.resets != resets:
+                # reset while encoding, the tail belongs to the audio that was cut
+                self.pending = b""
+            return packets
+
+    async def flush(self) -> List[bytes]:
+        """
+        the end of the agent's audio: what waits for a full frame, padded with silence to the shortest frame
+        """
+        async with self.lock:
+            if not self.pending:
+                return []
+            frame = self.pending + bytes(self.frame_bytes[-1] - len(self.pending))
+            self.pending = b""
+            return await self.run(self.encode_frames, frame)
+
+    def reset(self):
+        """
+        drop what waits for a full frame, the agent's audio was cut (barge-in)
+        """
+        self.pending = b""
+        self.resets += 1
+
+    def encode_frames(self, pcm: bytes) -> List[bytes]:
+        pcm = self.pending + pcm if self.pending else pcm
+        packets, offset = [], 0
+        for frame_bytes in self.frame_bytes:
+            while len(pcm) - offset >= frame_bytes:
+                frame = pcm[offset : offset + frame_bytes]
+                packets.append(self.encoder.encode(frame, frame_bytes // 2 // self.write_num_channels))
+                offset += frame_bytes
+        self.pending = pcm[offset:]
+        return packets
+
+
+def create_codec(
+    name: str,
+    read_sample_rate: int,
+    read_num_channels: int,
+    write_sample_rate: int,
+    write_num_channels: int,
+    bitrate: Optional[int] = None,
+) -> Optional[OpusCodec]:
+    """
+    the codec of a session's data channel, None for raw pcm
+    """
+    if name == "pcm":
+        return None
+    if name != "opus":
+        logger.warning(f"Unknown audio codec {name}, falling back to pcm")
+        return None
+    if read_sample_rate not in OpusCodec.SAMPLE_RATES or write_sample_rate not in OpusCodec.SAMPLE_RATES:
+        logger.warning(f"Opus does not support {read_sample_rate} / {write_sample_rate} Hz, falling back to pcm")
+        return None
+    try:
+        return OpusCodec(read_sample_rate, read_num_channels, write_sample_rate, write_num_channels, bitrate)
+    except Exception as e:
+        # ImportError without opuslib, opuslib raises a plain Exception when libopus is missing
+        logger.warning(f"Opus is not available ({e}), falling back to pcm")
+        return None
@@ -1,36 +1,142 @@
+import asyncio
 import json
 import logging
 import httpx
 import hashlib
-from luna_agent.utils import pcm2wav
+import time
+from typing import Dict, Optional, Set
+from luna_agent.endpoints import Endpoint, EndpointGroup
+from luna_agent.utils import pcm2wav, safe_create_task
 
 logger = logging.getLogger("luna_agent")
 
 
 class Diar:
-    def __init__(self, base_url, min_speaker_num=1, max_speaker_num=2, speaker_num=None):
+    def __init__(
+        self,
+        base_url=None,
+        min_speaker_num=1,
+        max_speaker_num=2,
+        speaker_num=None,
+        incremental: bool = False,
+        lazy: bool = False,
+        endpoints: Optional[EndpointGroup] = None,
+    ):
+        """
+        incremental: upload each utterance once, in the background as soon as it is added, and keep the speaker
+            labels of the session locally, so a turn never waits for the diarization. the labels lag the
+            latest utterance by one upload
+        lazy: only buffer the added utterances, they are diarized in one batch when resolve is called (when the
+            diar_control asks for it), the labels are kept until then
+        endpoints: diarization replicas, instead of base_url. the service keeps the speakers of a session, so a
+            session sticks to one replica (picked in setup, again only if it gets ejected), never hedged or retried
+        """
+        if incremental and lazy:
+            raise ValueError("diarization is either incremental or lazy")
+        if base_url is None and endpoints is None:
+            raise ValueError("Diar needs a base_url or endpoints")
+        if endpoints is not None and endpoints.hedge:
+            raise ValueError(f"endpoint group {endpoints.name}: diarization keeps per session state, it cannot hedge")
         self.sample_rate = 16000
-        self.base_url = base_url
+        self.endpoints = endpoints if endpoints is not None else EndpointGroup.single(base_url)
+        self.endpoint: Optional[Endpoint] = None  # the session's replica
+        self.base_url = self.endpoints.urls[0]
         self.min_speaker_num = min_speaker_num
         self.max_speaker_num = max_speaker_num
         self.speaker_num = speaker_num
+        self.incremental = incremental
+        self.lazy = lazy
+        self.labels: Dict[str, str] = {}  # sent_id -> speaker, from the latest diarization of the session
+        self.added: Set[str] = set()
+        self.uploads = asyncio.Queue()
+        self.worker: Optional[asyncio.Task] = None
+        self.pending: Dict[str, bytes] = {}  # lazy: sent_id -> utterance, not diarized yet
+        self.resolving = asyncio.Lock()
 
     async def setup(self, session_id: str):
         self.session_id = session_id
+        self.endpoint = self.endpoints.pick()
 
-    async def __call__(self, audio: bytes):
-        params = {
-            "session_id": self.session_id,
-            "sent_id": hashlib.md5(audio).hexdigest(),
-            "min_spk": self.min_speaker_num,
-            "max_spk": self.max_speaker_num,
-            "num_spk": self.speaker_num,
-            "suffix": "wav",
-        }
-        files = {"new_audio": pcm2wav(audio, self.sample_rate)}
-        data = {"params": json.dumps(params)}
-
-        async with httpx.AsyncClient(timeout=5.0) as client:
-            response = await client.post(self.base_url, files=files, data=data)
-            response.raise_for_status()
-            return response.json()
+    def session_endpoint(self) -> Endpoint:
+        """
+        the session's replica, another one once it is ejected. that one has not seen the earlier utterances, the
+        labels start over from there
+        """
+        if self.endpoint is None:
+            self.endpoint = self.endpoints.pick()
+        elif self.endpoint.ejected(time.monotonic()):
+            endpoint = self.endpoints.pick(exclude=[self.endpoint])
+            if endpoint is not self.endpoint:
+                logger.warning(f"Diarization replica {self.endpoint.url} ejected, session moved to {endpoint.url}")
+                self.endpoint = endpoint
+        return self.endpoint
+
+    def add(self, audio: bytes):
+        """
+        queue an utterance for the background upload, or buffer it when lazy. once per utterance
+        """
+        sent_id = hashlib.md5(audio).hexdigest()
+        if sent_id in self.added:
+            return
+        self.added.add(sent_id)
+        if self.lazy:
+            self.pending[sent_id] = audio
+            return
+        self.uploads.put_nowait(audio)
+        if self.worker is None:
+            self.worker = safe_create_task(self.upload())
+
+    async def upload(self):
+        while True:
+            audio = await self.uploads.get()
+            try:
+                await self(audio)
+            except Exception as e:
+                logger.warning(f"Diarization of an utterance failed: {e}")
+
+    async def resolve(self) -> Dict[str, str]:
+        """
+        lazy: diarize the pending utterances in one batch, the labels of those already diarized are reused
+        """
+        async with self.resolving:
+            if self.pending:
+                await self.diarize(self.pending)
+                self.pending = {}
+        return self.labels
+
+    async def close(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            self.worker = None
+
+    async def __call__(self, audio: bytes) -> Dict[str, str]:
+        return await self.diarize({hashlib.md5(audio).hexdigest(): audio})
+
+    async def diarize(self, utterances: Dict[str, bytes]) -> Dict[str, str]:
+        """
+        utterances: by sent_id, in order. the service takes one per request, a batch is sent back to back to the
+            session's replica over one connection. returns the labels of all the utterances of the session
+        """
+        requests = []
+        for sent_id, audio in utterances.items():
+            params = {
+                "session_id": self.session_id,
+                "sent_id": sent_id,
+                "min_spk": self.min_speaker_num,
+                "max_spk": self.max_speaker_num,
+                "num_spk": self.speaker_num,
+                "suffix": "wav",
+            }
+            files = {"new_audio": pcm2wav(audio, self.sample_rate)}
+            requests.append((files, {"params": json.dumps(params)}))
+
+        async def diarize(url: str):
+            async with httpx.AsyncClient(timeout=5.0) as client:
+                for files, data in requests:
+                    response = await client.post(url, files=files, data=data)
+                    response.raise_for_status()
+                return response.json()
+
+        labels = await self.endpoints.request_to(self.session_endpoint(), diarize)
+        self.labels = labels
+        return labels
@@ -0,0 +1,186 @@
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+SAMPLES_PER_MS = 16  # the vad server works on 16k audio, positions are sample indices
+
+# (user_is_speaking, (turn start, turn end) when a turn is finished)
+EndpointEvent = Tuple[bool, Optional[Tuple[int, int]]]
+
+
+class Endpointer:
+    """
+    turns the vad server's speech spans into end-of-turn and interrupt decisions.
+
+    a turn ends hold_ms after the server closes a span, if the user speaks again within the hold the spans
+    are merged into one turn. the clock is the server's `current` sample index, so a recorded session
+    replays to the same decisions. fixed thresholds, hold_ms=0 ends the turn as soon as the span closes.
+    """
+
+    def __init__(self, voiced_ms_to_interrupt: int = 1000, hold_ms: int = 0, resume_window_ms: int = 1500):
+        """
+        resume_window_ms: speech starting this soon after a finished turn counts as the user resuming,
+            i.e. the turn was cut too early
+        """
+        self.interrupt_samples = voiced_ms_to_interrupt * SAMPLES_PER_MS
+        self.hold_samples = hold_ms * SAMPLES_PER_MS
+        self.resume_window_samples = resume_window_ms * SAMPLES_PER_MS
+        self.start = self.end = 0
+        self.turn_start: Optional[int] = None  # turn waiting for its hold to pass
+        self.turn_end: Optional[int] = None
+        self.last_turn_end: Optional[int] = None  # finished turn, watched for the user resuming
+
+        self.turns = self.false_cuts = 0
+        self.latency_samples = 0  # from the end of speech to the end of turn decision, summed over turns
+
+    @property
+    def speaking(self) -> bool:
+        return self.start > self.end
+
+    def observe(self, chunk: bytes):
+        """
+        called with every chunk of user audio
+        """
+        pass
+
+    def on_segment(self, start: int, end: int):
+        pass
+
+    def on_pause(self, gap: int):
+        """
+        gap: silence before the user spoke again, 0 if they did not within the resume window
+        """
+        pass
+
+    def step(self, start: int, end: int, current: int) -> List[EndpointEvent]:
+        events = []
+        if start > end:
+            if start != self.start:
+                if self.turn_end is not None:
+                    # spoke again within the hold, same turn
+                    self.on_pause(start - self.turn_end)
+                    self.turn_end = None
+                elif self.last_turn_end is not None:
+                    gap = start - self.last_turn_end
+                    self.false_cuts += gap < self.resume_window_samples
+                    self.on_pause(gap if gap < self.resume_window_samples else 0)
+                    self.last_turn_end = None
+            if end != 0 and current - start > self.interrupt_samples:
+                events.append((True, None))
+        elif (start, end) != (self.start, self.end):
+            self.on_segment(start, end)
+            if self.turn_start is None:
+                self.turn_start = start
+            self.turn_end = end
+
+        # a server that does not report `current` cannot drive the hold
+        if self.turn_end is not None and (
+            self.hold_samples == 0 or current < 0 or current - self.turn_end >= self.hold_samples
+        ):
+            events.append((False, (self.turn_start, self.turn_end)))
+            self.turns += 1
+            self.latency_samples += max(0, current - self.turn_end)
+            self.last_turn_end = self.turn_end
+            self.turn_start = self.turn_end = None
+        if self.last_turn_end is not None and current - self.last_turn_end >= self.resume_window_samples:
+            self.on_pause(0)
+            self.last_turn_end = None
+
+        self.start, self.end = start, end
+        return events
+
+    def stats(self) -> Dict:
+        return {
+            "hold_ms": self.hold_samples // SAMPLES_PER_MS,
+            "interrupt_ms": self.interrupt_samples // SAMPLES_PER_MS,
+            "turns": self.turns,
+            "false_cuts": self.false_cuts,
+            "mean_latency_ms": self.latency_samples / SAMPLES_PER_MS / self.turns if self.turns else 0.0,
+        }
+
+
+class AdaptiveEndpointer(Endpointer):
+    """
+    tunes the thresholds to the session, within the configured bounds:
+    - hold: the `quantile` of the user's pauses, so that fraction of span ends in which the user went on
+      speaking would not have ended the turn. span ends without the user resuming count as a 0 pause,
+      so a user who does not pause mid-turn gets min_hold_ms
+    - interrupt: grows with the background noise floor (noise triggers false barge-ins), capped at half
+      the user's median speech span so short barge-ins are still caught
+    """
+
+    def __init__(
+        self,
+        hold_ms: int = 0,
+        min_hold_ms: int = 0,
+        max_hold_ms: int = 800,
+        min_interrupt_ms: int = 300,
+        max_interrupt_ms: int = 1000,
+        quantile: float = 0.9,
+        margin_ms: int = 100,
+        quiet_db: float = -60.0,
+        noisy_db: float = -30.0,
+        min_observations: int = 5,
+        max_observations: int = 50,
+        resume_window_ms: int = 1500,
+    ):
+        """
+        hold_ms: used until min_observations pauses were seen, 0 ends turns as early as the fixed endpointer
+            until the session shows it pauses mid-turn
+        margin_ms: added to the pause quantile, the server reports speech starts up to a chunk late
+        quiet_db, noisy_db: noise floors (dBFS) mapped to min_interrupt_ms and max_interrupt_ms
+        """
+        super().__init__(min_interrupt_ms, hold_ms, resume_window_ms)
+        self.min_hold_samples = min_hold_ms * SAMPLES_PER_MS
+        self.max_hold_samples = max_hold_ms * SAMPLES_PER_MS
+        self.min_interrupt_samples = min_interrupt_ms * SAMPLES_PER_MS
+        self.max_interrupt_samples = max_interrupt_ms * SAMPLES_PER_MS
+        self.quantile = quantile
+        self.margin_samples = margin_ms * SAMPLES_PER_MS
+        self.quiet_db = quiet_db
+        self.noisy_db = noisy_db
+        self.min_observations = min_observations
+        self.pauses = deque(maxlen=max_observations)
+        self.segments = deque(maxlen=max_observations)
+        self.noise_db = quiet_db
+        self.num_segments = self.voiced_samples = 0
+
+    def observe(self, chunk: bytes):
+        if self.speaking or len(chunk) < 2:
+            return
+        samples = np.frombuffer(chunk[: len(chunk) // 2 * 2], dtype=np.int16).astype(np.float32)
+        rms = np.sqrt(np.mean(samples * samples)) / 32768.0
+        db = 20 * np.log10(max(rms, 1e-6))
+        self.noise_db += 0.05 * (db - self.noise_db)
+        self.tune_interrupt()
+
+    def on_segment(self, start: int, end: int):
+        self.segments.append(end - start)
+        self.num_segments += 1
+        self.voiced_samples += end - start
+        self.tune_interrupt()
+
+    def on_pause(self, gap: int):
+        self.pauses.append(gap)
+        if len(self.pauses) >= self.min_observations:
+            hold = int(np.quantile(self.pauses, self.quantile)) + self.margin_samples
+            self.hold_samples = min(max(hold, self.min_hold_samples), self.max_hold_samples)
+
+    def tune_interrupt(self):
+        noise = (self.noise_db - self.quiet_db) / (self.noisy_db - self.quiet_db)
+        noise = min(max(noise, 0.0), 1.0)
+        interrupt = self.min_interrupt_samples + noise * (self.max_interrupt_samples - self.min_interrupt_samples)
+        if len(self.segments) >= self.min_observations:
+            interrupt = min(interrupt, max(np.median(self.segments) / 2, self.min_interrupt_samples))
+        self.interrupt_samples = int(interrupt)
+
+    def stats(self) -> Dict:
+        voiced_s = self.voiced_samples / SAMPLES_PER_MS / 1000
+        return {
+            **super().stats(),
+            "noise_db": round(float(self.noise_db), 1),
+            "median_segment_ms": float(np.median(self.segments)) / SAMPLES_PER_MS if self.segments else 0.0,
+            # speech spans per voiced second, a rough speech rate
+            "segment_rate": self.num_segments / voiced_s if voiced_s else 0.0,
+        }
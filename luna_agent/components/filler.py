@@ -0,0 +1,86 @@
+import asyncio
+import random
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from luna_agent.components.tts import TTS
+from luna_agent.utils import logger
+
+
+def crossfade(tail: bytes, head: bytes) -> bytes:
+    """
+    mix two int16 pcm clips of the same length, tail fading out while head fades in
+    """
+    tail = np.frombuffer(tail, dtype=np.int16).astype(np.float32)
+    head = np.frombuffer(head, dtype=np.int16).astype(np.float32)
+    ramp = np.linspace(0.0, 1.0, len(head), dtype=np.float32)
+    mixed = tail * (1.0 - ramp) + head * ramp
+    return np.clip(mixed, -32768, 32767).astype(np.int16).tobytes()
+
+
+class Filler:
+    """
+    short backchannel clips ("嗯", "好的") played while the agent is thinking, so the user does not sit in
+    silence when the first tts chunk of a reply is late.
+
+    clips are synthesized once per voice by `load` at server startup and kept in `Filler.clips`, so they
+    survive the per-session config reload. they are never added to the history.
+    """
+
+    clips: Dict[str, List[bytes]] = {}
+
+    def __init__(
+        self,
+        tts: TTS,
+        phrases: Dict[str, List[str]],
+        delay_ms: int = 800,
+        crossfade_ms: int = 40,
+    ):
+        """
+        phrases: voice -> backchannel phrases, voices without phrases fall back to "default"
+        delay_ms: play a filler when the first audio of a reply is not ready this long after the user stopped
+        crossfade_ms: overlap between the end of the filler and the start of the reply
+        """
+        self.tts = tts
+        self.phrases = phrases
+        self.delay_ms = delay_ms
+        self.crossfade_ms = crossfade_ms
+
+    @staticmethod
+    def clip_key(voice: str, sample_rate: int) -> str:
+        return f"{voice}@{sample_rate}"
+
+    async def load(self):
+        await self.tts.setup(session_id="filler")
+        for voice, phrases in self.phrases.items():
+            key = self.clip_key(voice, self.tts.sample_rate)
+            if key in self.clips:
+                continue
+            clips = []
+            for phrase in phrases:
+                try:
+                    clip = b"".join([chunk async for chunk in self.tts.tts(phrase, control={"timbre": voice})])
+                except Exception as e:
+                    logger.error(f"Error synthesizing filler {phrase} for voice {voice}: {e}")
+                    continue
+                if clip:
+                    clips.append(clip)
+            self.clips[key] = clips
+            logger.info(f"Loaded {len(clips)} filler clips for voice {voice}")
+
+    def clip(self, voice: str = "default") -> Optional[bytes]:
+        clips = self.clips.get(self.clip_key(voice, self.tts.sample_rate)) or self.clips.get(
+            self.clip_key("default", self.tts.sample_rate)
+        )
+        return random.choice(clips) if clips else None
+
+    async def __call__(self, data, voice: str = "default"):
+        """
+        run as a task next to the reply and cancel it once the first real audio is ready
+        """
+        await asyncio.sleep(self.delay_ms / 1000)
+        clip = self.clip(voice)
+        if clip is not None:
+            logger.info(f"First audio later than {self.delay_ms}ms, playing filler")
+            await data.write_filler(clip, crossfade_ms=self.crossfade_ms)
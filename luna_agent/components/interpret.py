@@ -1,10 +1,9 @@
 import base64
-import json
 from typing import AsyncGenerator, Tuple
 
 import websockets
 
-from luna_agent.utils import StreamingResampler, logger
+from luna_agent.utils import StreamingResampler, json_codec, logger
 
 
 class Interpret:
@@ -45,11 +44,11 @@ class Interpret:
                 "noise_reduction": self.noise_reduction,
             },
         }
-        await self.ws.send(json.dumps(payload))
+        await self.ws.send(json_codec.dumps(payload))
 
     async def results(self) -> AsyncGenerator[Tuple[bool, bytes], None]:
         async for message in self.ws:
-            message = json.loads(message)
+            message = json_codec.loads(message)
             if message["type"] == "asr":
                 yield message["text"], None, None
             elif message["type"] == "ast":
@@ -1,9 +1,16 @@
+import asyncio
+import hashlib
+import json
 import json_repair
 import logging
-from typing import Dict, List
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
 
 from openai import AsyncOpenAI
 
+from luna_agent.endpoints import EndpointGroup
+
 logger = logging.getLogger("luna_agent")
 
 
@@ -17,6 +24,157 @@ def add_agent_message(history, message):
     return history
 
 
+class CompletionTextStream:
+    """
+    async iterator over the text deltas of a streaming chat completion.
+    aclose() closes the http stream so the server stops generating, also when iteration never started
+    """
+
+    def __init__(self, completion):
+        self.completion = completion
+        self.chunks = completion.__aiter__()
+        self.first: Optional[str] = None
+
+    async def prefetch(self) -> "CompletionTextStream":
+        """
+        wait for the first text delta, endpoint groups hedge on the time to the first token
+        """
+        try:
+            self.first = await self.__anext__()
+        except StopAsyncIteration:
+            self.first = ""
+        return self
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> str:
+        if self.first is not None:
+            first, self.first = self.first, None
+            if not first:
+                raise StopAsyncIteration
+            return first
+        while True:
+            chunk = await self.chunks.__anext__()
+            if chunk.choices and chunk.choices[0].delta.content:
+                return chunk.choices[0].delta.content
+
+    async def aclose(self):
+        await self.completion.close()
+
+
+class OpenAIClients:
+    """
+    an openai client per replica of an endpoint group.
+
+    hyperpyyaml creates one instance per session, the clients (their connection pools) are shared by url and api
+    key like EndpointGroup.pools
+    """
+
+    clients: Dict[Tuple[str, str], AsyncOpenAI] = {}
+
+    def __init__(self, endpoints: EndpointGroup, api_key: str):
+        self.endpoints = endpoints
+        self.api_key = api_key
+        # created up front, building a client (its ssl context) costs more than a first token
+        for url in endpoints.urls:
+            if (url, api_key) not in self.clients:
+                self.clients[(url, api_key)] = AsyncOpenAI(base_url=url, api_key=api_key)
+
+    def __getitem__(self, url: str) -> AsyncOpenAI:
+        return self.clients[(url, self.api_key)]
+
+    async def stream(self, **params) -> CompletionTextStream:
+        """
+        streaming chat completion from the first replica to send a token
+        """
+
+        async def open_stream(url: str) -> CompletionTextStream:
+            stream = CompletionTextStream(await self[url].chat.completions.create(stream=True, **params))
+            try:
+                return await stream.prefetch()
+            except BaseException:
+                await stream.aclose()
+                raise
+
+        return await self.endpoints.request(open_stream, discard=CompletionTextStream.aclose)
+
+    async def complete(self, **params):
+        return await self.endpoints.request(lambda url: self[url].chat.completions.create(stream=False, **params))
+
+
+class ControlQuestion:
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class ControlDispatcher:
+    """
+    process wide, one per control prompt (model and prompts): the sessions asking the same question (transcript)
+    while it is in flight, or within reuse_s of its answer, share one completion. short turns ("嗯", "好的",
+    "继续") repeat across the sessions of a node, distinct questions still go out concurrently
+    """
+
+    dispatchers: Dict[str, "ControlDispatcher"] = {}
+
+    def __init__(self, reuse_s: float = 0, max_answers: int = 1024):
+        self.reuse_s = reuse_s
+        self.max_answers = max_answers
+        self.questions: Dict[str, ControlQuestion] = {}
+        self.answers: "OrderedDict[str, Tuple[float, Dict]]" = OrderedDict()
+        self.requests = self.shared = 0
+
+    @classmethod
+    def of(cls, model: str, prompts: List[Dict], reuse_s: float = 0) -> "ControlDispatcher":
+        key = json.dumps([model, prompts, reuse_s], ensure_ascii=False, sort_keys=True)
+        key = hashlib.md5(key.encode()).hexdigest()
+        dispatcher = cls.dispatchers.get(key)
+        if dispatcher is None:
+            dispatcher = cls.dispatchers[key] = cls(reuse_s)
+        return dispatcher
+
+    async def ask(self, text: str, complete: Callable[[], Awaitable[Dict]]) -> Dict:
+        """
+        complete: the request of this caller, only sent when no other session asked the question. the answer is
+        a copy, the agents add to it
+        """
+        answer = self.answers.get(text)
+        if answer is not None and time.monotonic() - answer[0] < self.reuse_s:
+            self.answers.move_to_end(text)
+            self.shared += 1
+            return dict(answer[1])
+        question = self.questions.get(text)
+        if question is None:
+            question = self.questions[text] = ControlQuestion(asyncio.ensure_future(complete()))
+            question.task.add_done_callback(lambda task: self.answered(text, task))
+            self.requests += 1
+        else:
+            self.shared += 1
+        question.waiters += 1
+        try:
+            # a caller giving up does not cancel the request for the others
+            return dict(await asyncio.shield(question.task))
+        finally:
+            question.waiters -= 1
+            if not question.waiters and not question.task.done():
+                # nobody waits for it anymore, the next asker sends a new request
+                self.questions.pop(text, None)
+                question.task.cancel()
+
+    def answered(self, text: str, task: asyncio.Task):
+        question = self.questions.get(text)
+        if question is not None and question.task is task:
+            del self.questions[text]
+        if self.reuse_s and not task.cancelled() and task.exception() is None:
+            self.answers[text] = (time.monotonic(), task.result())
+            self.answers.move_to_end(text)
+            while len(self.answers) > self.max_answers:
+                self.answers.popitem(last=False)
+
+
 DEFAULT_PROMPTS = [
     {
         "role": "system",
@@ -28,16 +186,25 @@ DEFAULT_PROMPTS = [
 class LLM:
     def __init__(
         self,
-        base_url,
+        base_url=None,
         prompts: List[Dict] = DEFAULT_PROMPTS,
         api_key="token",
         model="Qwen2.5-7B-Instruct",
         is_control: bool = False,
+        endpoints: Optional[EndpointGroup] = None,
+        reuse_s: float = 0,
     ):
-        self.client = AsyncOpenAI(base_url=base_url, api_key=api_key)
+        """
+        endpoints: llm replicas, instead of base_url
+        reuse_s: control mode, seconds the answer to a transcript is reused by every session of the process with
+            the same model and prompts. the same question in flight is always asked once, see ControlDispatcher
+        """
+        self.endpoints = endpoints if endpoints is not None else EndpointGroup.single(base_url)
+        self.clients = OpenAIClients(self.endpoints, api_key)
         self.model = model
         self.prompts = prompts
         self.is_control = is_control
+        self.dispatcher = ControlDispatcher.of(model, prompts, reuse_s) if is_control else None
 
     async def __call__(self, param: List | str):
         """
@@ -46,21 +213,14 @@ class LLM:
         """
         if not self.is_control:
             messages = param
-            completion = await self.client.chat.completions.create(
-                model=self.model,
-                messages=self.prompts + messages,
-                stream=True,
-            )
-            async def generator():
-                async for chunk in completion:
-                    yield chunk.choices[0].delta.content
-            return generator()
-
-        text = param
-        completion = await self.client.chat.completions.create(
+            return await self.clients.stream(model=self.model, messages=self.prompts + messages)
+
+        return await self.dispatcher.ask(param, lambda: self.control(param))
+
+    async def control(self, text: str) -> Dict:
+        completion = await self.clients.complete(
             model=self.model,
             messages=self.prompts + [{"role": "user", "content": text}],
-            stream=False,
         )
         control_params: dict = json_repair.loads(completion.choices[0].message.content)
         control_params = self.fix_control(**control_params)
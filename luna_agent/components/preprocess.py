@@ -0,0 +1,99 @@
+import math
+from typing import Dict
+
+import numpy as np
+
+
+class AudioPreprocessor:
+    """
+    clean up of the user's audio in WebRTCData.read, before the vad: dc offset removal, gain normalization and
+    gating of long digital silence (muted microphones, clients streaming zeros), which is then neither sent to
+    the vad server nor kept. 16 bit mono pcm in and out, vectorized over each chunk, one instance per session
+    """
+
+    def __init__(
+        self,
+        dc_removal: bool = True,
+        agc: bool = True,
+        target_dbfs: float = -26.0,
+        max_gain_db: float = 20.0,
+        voiced_dbfs: float = -50.0,
+        level_ms: float = 500,
+        silence_dbfs: float = -70.0,
+        gate_after_ms: float = 2000,
+        dc_ms: float = 200,
+    ):
+        """
+        target_dbfs: rms level of speech after the gain
+        max_gain_db: the most a quiet microphone is boosted or a loud one attenuated
+        voiced_dbfs: chunks above it update the speech level the gain is computed from, so noise is not boosted
+        level_ms: time constant of the speech level
+        silence_dbfs: chunks below it are digital silence
+        gate_after_ms: silence passed on before the gate closes, longer than the endpointer's hold so a turn
+            still ends. 0 disables the gate
+        dc_ms: time constant of the dc offset estimate
+        """
+        self.dc_removal = dc_removal
+        self.agc = agc
+        self.target_dbfs = target_dbfs
+        self.max_gain_db = max_gain_db
+        self.voiced_dbfs = voiced_dbfs
+        self.level_ms = level_ms
+        self.silence_dbfs = silence_dbfs
+        self.gate_after_ms = gate_after_ms
+        self.dc_ms = dc_ms
+        self.setup()
+
+    def setup(self, sample_rate: int = 16000):
+        self.sample_rate = sample_rate
+        self.dc = 0.0
+        self.level_dbfs = self.target_dbfs  # unity gain until speech was heard
+        self.gain = 1.0
+        self.silent_ms = 0.0
+        self.bytes_in = self.bytes_gated = 0
+
+    def __call__(self, chunk: bytes) -> bytes:
+        """
+        returns the processed chunk, empty while gated
+        """
+        if len(chunk) < 2:
+            return chunk
+        self.bytes_in += len(chunk)
+        x = np.frombuffer(chunk[: len(chunk) // 2 * 2], dtype=np.int16).astype(np.float32)
+        chunk_ms = len(x) * 1000 / self.sample_rate
+
+        # level of the chunk without its own offset, so an offset alone is still silence
+        mean = float(x.mean())
+        dbfs = 10 * math.log10(max(float(np.dot(x, x)) / len(x) - mean * mean, 1e-3) / 32768**2)
+        if self.dc_removal:
+            self.dc += (1 - math.exp(-chunk_ms / self.dc_ms)) * (mean - self.dc)
+            x -= self.dc
+
+        if dbfs < self.silence_dbfs:
+            self.silent_ms += chunk_ms
+            if self.gate_after_ms and self.silent_ms > self.gate_after_ms:
+                self.bytes_gated += len(chunk)
+                return b""
+        else:
+            self.silent_ms = 0.0
+
+        if self.agc:
+            if dbfs > self.voiced_dbfs:
+                self.level_dbfs += (1 - math.exp(-chunk_ms / self.level_ms)) * (dbfs - self.level_dbfs)
+            gain_db = min(max(self.target_dbfs - self.level_dbfs, -self.max_gain_db), self.max_gain_db)
+            gain = 10 ** (gain_db / 20)
+            if abs(gain - self.gain) > 1e-3:
+                # ramped over the chunk, a step would click
+                x *= np.linspace(self.gain, gain, len(x), dtype=np.float32)
+            else:
+                x *= gain
+            self.gain = gain
+
+        return np.clip(x, -32768, 32767).astype(np.int16).tobytes()
+
+    def stats(self) -> Dict:
+        return {
+            "gain_db": round(20 * math.log10(self.gain), 1),
+            "dc": round(self.dc, 1),
+            "gated": round(self.bytes_gated / self.bytes_in, 3) if self.bytes_in else 0.0,
+        }
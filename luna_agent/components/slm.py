@@ -1,9 +1,12 @@
 import logging
 import hashlib
-from typing import List, Dict, Optional
-from openai import AsyncOpenAI
+from typing import List, Dict, Optional, Sequence, Union
 from luna_agent.utils import pcm2base64, format_msg
 from luna_agent.components.diar import Diar
+from luna_agent.components.llm import OpenAIClients
+from luna_agent.endpoints import EndpointGroup
+from luna_agent.history import Turn
+from luna_agent.log import lazy
 
 logger = logging.getLogger("luna_agent")
 
@@ -50,7 +53,7 @@ def add_agent_message(history, message):
 class SLM:
     def __init__(
         self,
-        base_url: str,
+        base_url: Optional[str] = None,
         api_key: str = "token",
         model: str = "Qwen/Qwen2.5-7B-Instruct",
         prompts: List[Dict] = DEFAULT_PROMPTS,
@@ -58,8 +61,13 @@ class SLM:
         completion_params: dict = {},
         diar: Optional[Diar] = None,
         max_messages: int = -1,
+        endpoints: Optional[EndpointGroup] = None,
     ):
-        self.client = AsyncOpenAI(base_url=base_url, api_key=api_key)
+        """
+        endpoints: slm replicas, instead of base_url
+        """
+        self.endpoints = endpoints if endpoints is not None else EndpointGroup.single(base_url)
+        self.clients = OpenAIClients(self.endpoints, api_key)
         self.model = model
         self.sample_rate = 16000
         self.prompts = prompts
@@ -72,11 +80,32 @@ class SLM:
         if self.diar:
             await self.diar.setup(session_id=session_id)
 
-    async def __call__(self, history: List[Dict], audio: bytes):
-        diar: Dict = await self.diar(audio) if self.diar else {}
+    async def close(self):
+        if self.diar:
+            await self.diar.close()
+
+    @property
+    def lazy_diarization(self) -> bool:
+        return self.diar is not None and self.diar.lazy
+
+    async def __call__(self, history: Sequence[Union[Dict, Turn]], audio: bytes, diarize: bool = False):
+        """
+        history: openai messages, or the turns of a luna_agent.history.History (view), encoded here. with
+            use_text_history their audio is never encoded
+        diarize: with a lazy diar, diarize the pending utterances first. otherwise its labels so far are used
+        """
+        if self.diar is None:
+            diar: Dict = {}
+        elif self.diar.incremental or self.diar.lazy:
+            self.diar.add(audio)
+            diar = await self.diar.resolve() if diarize and self.diar.lazy else self.diar.labels
+        else:
+            diar = await self.diar(audio)
 
         messages = []
         for message in history[-self.max_messages :]:
+            if isinstance(message, Turn):
+                message = message.message(audio=not self.use_text_history)
             if message["role"] == "user" and "content" in message:
                 contents_new = []
                 for content in message["content"]:
@@ -92,21 +121,14 @@ class SLM:
                     contents_new.append(content)
             else:
                 contents_new = message["content"]
-            logger.info(f">>> {format_msg(contents_new).strip()}")
+            logger.debug(">>> %s", lazy(format_msg, contents_new))
             messages.append({"role": message["role"], "content": contents_new})
 
         add_user_message(messages, audio=audio)
 
-        completion = await self.client.chat.completions.create(
+        return await self.clients.stream(
             model=self.model,
             messages=self.prompts + messages,
-            stream=True,
             extra_body={"chat_template_kwargs": {"enable_thinking": False}},
             **self.completion_params,
         )
-
-        async def generator():
-            async for chunk in completion:
-                yield chunk.choices[0].delta.content
-
-        return generator()
@@ -1,14 +1,24 @@
+import asyncio
+import hashlib
 import json
 import logging
 import re
-from typing import AsyncGenerator
+import time
+from collections import OrderedDict
+from contextlib import aclosing
+from typing import AsyncGenerator, Callable, Dict, List, Optional, Tuple
+from urllib.parse import urljoin
 from uuid import uuid4
 
 import httpx
 
-from luna_agent.utils import pcm2wav
+from luna_agent.components.tts_cache import TTSCache
+from luna_agent.endpoints import EndpointGroup
+from luna_agent.log import Sampled
+from luna_agent.utils import pcm2wav, safe_create_task
 
 logger = logging.getLogger("luna_agent")
+chunk_log = Sampled(logger, every=100)
 
 
 def extract_tts_text(text):
@@ -20,11 +30,145 @@ def extract_tts_text(text):
     return "", text
 
 
+CLAUSE_END = set("，。！？,.!?:：；;；、\n\t\r•")
+SENTENCE_END = set("。！？.!?\n")
+CJK = re.compile(r"[\u2e80-\u9fff\u3040-\u30ff\uac00-\ud7af]")
+
+
+def last_cut(text: str, ends: set, min_chars: int) -> int:
+    """
+    length of the longest prefix ending with one of `ends` and longer than min_chars, 0 if there is none
+    """
+    for i in range(len(text), min_chars, -1):
+        if text[i - 1] in ends:
+            return i
+    return 0
+
+
+def word_boundary(text: str) -> int:
+    """
+    length of the longest prefix ending at a word boundary. after a cjk character every position is one, the
+    tokens of the slm are at least a character
+    """
+    if not text or text[-1].isspace() or text[-1] in CLAUSE_END or CJK.match(text[-1]):
+        return len(text)
+    for i in range(len(text) - 1, 0, -1):
+        if text[i - 1].isspace() or text[i - 1] in CLAUSE_END:
+            return i
+    return 0
+
+
+class ChunkingPolicy:
+    """
+    where TTS.__call__ cuts the reply into segments, for the time to the first audio. the first segment ends at
+    the first clause boundary after first_min_chars, or at the last word boundary once first_budget_ms passed
+    since the first token, instead of waiting for a clause of more than 10 characters (extract_tts_text). later
+    segments are such clauses while little audio is buffered ahead of playback, and grow toward full sentences
+    of up to max_chars as the buffer fills up to full_buffer_ms
+    """
+
+    def __init__(
+        self,
+        first_min_chars: int = 4,
+        first_budget_ms: float = 250,
+        min_chars: int = 10,
+        max_chars: int = 80,
+        full_buffer_ms: float = 2000,
+    ):
+        self.first_min_chars = first_min_chars
+        self.first_budget_ms = first_budget_ms
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self.full_buffer_ms = full_buffer_ms
+
+    def first(self, text: str, waited_ms: float) -> Tuple[str, str]:
+        for i in range(self.first_min_chars, len(text) + 1):
+            if text[i - 1] in CLAUSE_END:
+                return text[:i], text[i:]
+        if waited_ms >= self.first_budget_ms:
+            i = word_boundary(text)
+            if i >= self.first_min_chars:
+                return text[:i], text[i:]
+        return "", text
+
+    def next(self, text: str, buffered_ms: float) -> Tuple[str, str]:
+        fill = min(buffered_ms / self.full_buffer_ms, 1.0) if self.full_buffer_ms > 0 else 1.0
+        # a clause once the text is longer than the (growing) clause length, a sentence when one is complete
+        i = 0
+        if len(text) > self.min_chars + fill * (self.max_chars - self.min_chars):
+            i = last_cut(text, CLAUSE_END, self.min_chars)
+        if not i:
+            i = last_cut(text, SENTENCE_END, self.min_chars)
+        return text[:i], text[i:]
+
+
+# statuses the tts server answers with when it does not know a registered reference (any more)
+REFERENCE_MISSING = (404, 410, 422)
+
+
+class AudioStream:
+    """
+    audio of one tts request, with its first chunk already received
+    """
+
+    def __init__(self, client: httpx.AsyncClient, response: httpx.Response, chunk_size: int):
+        self.client = client
+        self.response = response
+        self.chunks = response.aiter_bytes(chunk_size=chunk_size)
+        self.first = b""
+
+    async def prefetch(self) -> "AudioStream":
+        async for chunk in self.chunks:
+            if chunk:
+                self.first = chunk
+                break
+        return self
+
+    async def __aiter__(self):
+        if self.first:
+            yield self.first
+        async for chunk in self.chunks:
+            if chunk:
+                yield chunk
+
+    async def aclose(self):
+        await self.response.aclose()
+        await self.client.aclose()
+
+
 class TTS:
-    def __init__(self, base_url, sample_rate: int = 16000, force_default=False):
-        self.base_url = base_url
+    def __init__(
+        self,
+        base_url: Optional[str] = None,
+        sample_rate: int = 16000,
+        force_default=False,
+        cache: Optional[TTSCache] = None,
+        reference_url: Optional[str] = None,
+        endpoints: Optional[EndpointGroup] = None,
+        chunking: Optional[ChunkingPolicy] = None,
+    ):
+        """
+        chunking: how a streamed reply is cut into segments, clauses of more than 10 characters
+            (extract_tts_text) without it
+        reference_url: endpoint to register the user's speech cloned by the "self" voice. the first segment
+            uploads it inline while it is registered in the background, later segments only send its ref_id.
+            without it (or if the server does not support it) the reference is uploaded with every segment, its
+            wav encoding is still cached. relative to each tts replica's url with endpoints
+        endpoints: tts replicas, instead of base_url
+        """
+        self.endpoints = endpoints if endpoints is not None else EndpointGroup.single(base_url)
+        self.base_url = self.endpoints.urls[0]
         self.sample_rate = sample_rate
         self.force_default = force_default
+        self.cache = cache
+        self.reference_url = reference_url
+        self.chunk_size = 4096
+        self.reference_wavs: "OrderedDict[str, bytes]" = OrderedDict()  # md5 of the pcm -> wav
+        self.references: Dict[Tuple[str, str], str] = {}  # (tts url, md5 of the pcm) -> ref_id registered there
+        self.registering: Dict[Tuple[str, str], asyncio.Task] = {}
+        self.max_references = 4
+        self.chunking = chunking
+        self.last_reply: Optional[Dict] = None  # time to first audio and segments of the latest reply
 
     async def setup(self, session_id: str):
         self.session_id = session_id
@@ -33,7 +177,7 @@ class TTS:
         control = {} if control is None else control.copy()
         text = text.strip()
         if not text:
-            raise StopIteration("No text to synthesize")
+            return
 
         control["stream"] = True
         control["text_frontend"] = True
@@ -44,18 +188,200 @@ class TTS:
         control["voice"] = control.pop("timbre", "default")
         ref_audio = control.pop("speech", None)
 
-        files = {} if ref_audio is None else {"ref_audio": pcm2wav(ref_audio)}
+        cache_key = None
+        if self.cache is not None:
+            if ref_audio is not None and control["voice"] == "self":
+                # cloned from the user's own speech, never the same twice
+                self.cache.bypass()
+            else:
+                cache_key = self.cache.key(
+                    text, control["voice"], control.get("speed"), control.get("emotion"), self.sample_rate
+                )
+            cached = self.cache.get(cache_key) if cache_key else None
+            if cached is not None:
+                async for chunk in self.cache.stream(cached, self.chunk_size):
+                    yield chunk
+                return
 
-        data = {"params": json.dumps(control)}
+        ref_hash = ref_wav = None
+        if ref_audio is not None:
+            ref_hash, ref_wav = self.reference_wav(ref_audio)
+        # only a cloned voice is worth registering, the user's speech is new every turn
+        register = ref_wav is not None and control["voice"] == "self"
 
-        async with httpx.AsyncClient(timeout=5.0) as client:
-            response = await client.post(self.base_url, files=files, data=data)
-            async for chunk in response.aiter_bytes(chunk_size=4096):
-                if chunk:
-                    logger.debug(f"Streaming TTS chunk sent {len(chunk)} bytes")
-                    yield chunk
+        async def open_stream(url: str) -> AudioStream:
+            params, files = dict(control), {}
+            ref_id = self.references.get((url, ref_hash)) if register else None
+            if ref_id is not None:
+                params["ref_id"] = ref_id
+            elif ref_wav is not None:
+                files = {"ref_audio": ref_wav}
+                if register:
+                    # off the path to the first audio, for the later segments
+                    self.register_in_background(url, ref_hash, ref_wav, params["ref_text"])
+            client = httpx.AsyncClient(timeout=5.0)
+            try:
+                while True:
+                    request = client.build_request("POST", url, files=files, data={"params": json.dumps(params)})
+                    response = await client.send(request, stream=True)
+                    if "ref_id" in params and response.status_code in REFERENCE_MISSING:
+                        # the server lost the reference, upload it with this segment and register again next time
+                        logger.warning(f"TTS server does not know reference {params.pop('ref_id')}, uploading it")
+                        await response.aclose()
+                        self.references.pop((url, ref_hash), None)
+                        files = {"ref_audio": ref_wav}
+                        continue
+                    if response.status_code >= 500:
+                        response.raise_for_status()
+                    # hedged on the time to the first audio, not to the headers
+                    return await AudioStream(client, response, self.chunk_size).prefetch()
+            except BaseException:
+                await client.aclose()
+                raise
 
-    async def __call__(self, text_generateor: AsyncGenerator[str, None] | str, control={}):
+        # streamed, so closing this generator aborts the request instead of leaving it to the garbage collector
+        chunks = []
+        stream = await self.endpoints.request(open_stream, discard=AudioStream.aclose)
+        try:
+            async for chunk in stream:
+                chunk_log.debug("Streaming TTS chunk sent %d bytes", len(chunk))
+                if cache_key:
+                    chunks.append(chunk)
+                yield chunk
+        finally:
+            await stream.aclose()
+        # only reached when the whole segment was streamed
+        if cache_key and stream.response.status_code == 200:
+            await self.cache.put(cache_key, b"".join(chunks))
+
+    def reference_wav(self, ref_audio: bytes):
+        """
+        the reference is the same for every segment of a reply, encode it once
+        """
+        ref_hash = hashlib.md5(ref_audio).hexdigest()
+        ref_wav = self.reference_wavs.get(ref_hash)
+        if ref_wav is None:
+            ref_wav = self.reference_wavs[ref_hash] = pcm2wav(ref_audio)
+            while len(self.reference_wavs) > self.max_references:
+                evicted = self.reference_wavs.popitem(last=False)[0]
+                for key in [key for key in self.references if key[1] == evicted]:
+                    del self.references[key]
+        return ref_hash, ref_wav
+
+    def register_in_background(self, url: str, ref_hash: str, ref_wav: bytes, ref_text: str):
+        key = (url, ref_hash)
+        if self.reference_url is None or key in self.references or key in self.registering:
+            return
+        task = self.registering[key] = safe_create_task(self.register_reference(url, ref_hash, ref_wav, ref_text))
+        task.add_done_callback(lambda _: self.registering.pop(key, None))
+
+    async def register_reference(self, url: str, ref_hash: str, ref_wav: bytes, ref_text: str) -> Optional[str]:
+        """
+        returns the ref_id to send to the tts replica at url instead of the audio, None to upload the audio with
+        the request. references are registered per replica
+        """
+        if self.reference_url is None:
+            return None
+        if (url, ref_hash) in self.references:
+            return self.references[(url, ref_hash)]
+        params = {"session_id": self.session_id, "ref_id": ref_hash, "ref_text": ref_text}
+        try:
+            async with httpx.AsyncClient(timeout=5.0) as client:
+                response = await client.post(
+                    urljoin(url, self.reference_url), files={"ref_audio": ref_wav}, data={"params": json.dumps(params)}
+                )
+        except httpx.HTTPError as e:
+            logger.warning(f"Error registering TTS reference: {e}")
+            return None
+        if response.status_code == 404:
+            logger.warning(f"TTS server has no reference registration at {self.reference_url}, uploading references")
+            self.reference_url = None
+            return None
+        if response.status_code != 200:
+            logger.warning(f"Error registering TTS reference: {response.status_code}")
+            return None
+        self.references[(url, ref_hash)] = response.json().get("ref_id", ref_hash)
+        return self.references[(url, ref_hash)]
+
+    async def segments(
+        self, text_generator: AsyncGenerator[str, None], buffered_ms: Callable[[], float], reply: Dict
+    ) -> AsyncGenerator[str, None]:
+        """
+        the text of the reply cut into tts segments, sets reply["first_token"]
+        """
+        if self.chunking is None:
+            text = ""
+            async for text_partial in text_generator:
+                reply["first_token"] = reply["first_token"] or time.perf_counter()
+                text += text_partial
+                tts_text, text = extract_tts_text(text)
+                if tts_text:
+                    yield tts_text
+            if text:
+                yield text
+            return
+
+        policy = self.chunking
+        tokens = text_generator.__aiter__()
+        next_token: Optional[asyncio.Future] = None
+        text, ended = "", False
+        try:
+            # the first segment: wake up when its budget runs out, even if no token arrives
+            while True:
+                if next_token is None:
+                    next_token = asyncio.ensure_future(tokens.__anext__())
+                timeout = None
+                if reply["first_token"]:
+                    remaining = policy.first_budget_ms / 1000 - (time.perf_counter() - reply["first_token"])
+                    timeout = remaining if remaining > 0 else None
+                done, _ = await asyncio.wait((next_token,), timeout=timeout)
+                if done:
+                    token, next_token = next_token, None
+                    try:
+                        text += token.result()
+                    except StopAsyncIteration:
+                        ended = True
+                        break
+                    reply["first_token"] = reply["first_token"] or time.perf_counter()
+                tts_text, text = policy.first(text, (time.perf_counter() - reply["first_token"]) * 1000)
+                if tts_text:
+                    yield tts_text
+                    break
+            if next_token is not None:
+                # asked for when the budget ran out
+                try:
+                    text += await next_token
+                except StopAsyncIteration:
+                    ended = True
+                next_token = None
+                if not ended:
+                    tts_text, text = policy.next(text, buffered_ms())
+                    if tts_text:
+                        yield tts_text
+            # the rest as the tokens come, no future per token
+            if not ended:
+                async for token in tokens:
+                    text += token
+                    tts_text, text = policy.next(text, buffered_ms())
+                    if tts_text:
+                        yield tts_text
+            if text:
+                yield text
+        finally:
+            if next_token is not None:
+                next_token.cancel()
+
+    async def __call__(
+        self,
+        text_generateor: AsyncGenerator[str, None] | str,
+        control={},
+        on_segment: Optional[Callable[[str], None]] = None,
+        buffered_ms: Callable[[], float] = lambda: 0,
+    ):
+        """
+        on_segment: called with the text of each segment right before its audio is yielded
+        buffered_ms: audio written but not played yet, later segments grow with it (see ChunkingPolicy)
+        """
         control["response_id"] = str(uuid4())
         if self.force_default:
             control = {
@@ -65,15 +391,31 @@ class TTS:
             }
 
         async def generator():
-            text = ""
-            async for text_partial in text_generateor:
-                text += text_partial
-                tts_text, text = extract_tts_text(text)
-                if tts_text:
-                    async for chunk in self.tts(tts_text, control=control):
-                        yield chunk
-            if text:
-                async for chunk in self.tts(text, control=control):
-                    yield chunk
+            reply = {"first_token": None, "first_audio": None}
+            lengths: List[int] = []
+            try:
+                async with aclosing(self.segments(text_generateor, buffered_ms, reply)) as segments:
+                    async for tts_text in segments:
+                        lengths.append(len(tts_text))
+                        if on_segment:
+                            on_segment(tts_text)
+                        async with aclosing(self.tts(tts_text, control=control)) as speech:
+                            async for chunk in speech:
+                                reply["first_audio"] = reply["first_audio"] or time.perf_counter()
+                                yield chunk
+            finally:
+                self.reply_done(reply, lengths)
 
         return generator()
+
+    def reply_done(self, reply: Dict, lengths: List[int]):
+        first_audio_ms = None
+        if reply["first_audio"] is not None:
+            first_audio_ms = round((reply["first_audio"] - reply["first_token"]) * 1000)
+        self.last_reply = {"first_audio_ms": first_audio_ms, "segments": lengths}
+        logger.info(
+            "TTS reply: first audio %sms after the first token, %d segments of %s characters",
+            first_audio_ms,
+            len(lengths),
+            lengths,
+        )
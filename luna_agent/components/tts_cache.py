@@ -0,0 +1,152 @@
+import asyncio
+import hashlib
+import mmap
+import os
+import re
+import unicodedata
+from collections import OrderedDict
+from typing import AsyncGenerator, Dict, Optional
+
+from luna_agent.utils import logger
+
+
+def normalize_text(text: str) -> str:
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", text)).strip()
+
+
+class TTSCacheStore:
+    """
+    lru of synthesized pcm and hit / miss counters, shared by every TTSCache with the same name
+    """
+
+    def __init__(self, max_memory_bytes: int):
+        self.max_memory_bytes = max_memory_bytes
+        self.items: "OrderedDict[str, bytes]" = OrderedDict()
+        self.memory_bytes = 0
+        self.hits = self.disk_hits = self.misses = self.bypassed = 0
+        self.bytes_served = 0
+
+    def get(self, key: str) -> Optional[bytes]:
+        pcm = self.items.get(key)
+        if pcm is not None:
+            self.items.move_to_end(key)
+        return pcm
+
+    def put(self, key: str, pcm: bytes):
+        if len(pcm) > self.max_memory_bytes:
+            return
+        if key in self.items:
+            self.memory_bytes -= len(self.items.pop(key))
+        self.items[key] = pcm
+        self.memory_bytes += len(pcm)
+        while self.memory_bytes > self.max_memory_bytes:
+            _, evicted = self.items.popitem(last=False)
+            self.memory_bytes -= len(evicted)
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            "bytes_served": self.bytes_served,
+            "memory_entries": len(self.items),
+            "memory_bytes": self.memory_bytes,
+        }
+
+
+class TTSCache:
+    """
+    cache of synthesized audio for short repeated phrases (greetings, fillers, apologies ...),
+    keyed by normalized text, voice, speed, emotion and sample rate.
+
+    the in-memory tier lives in `TTSCache.stores` so it survives the per-session config reload,
+    the optional on-disk tier keeps one raw pcm file per entry under cache_dir, read through mmap,
+    entries are never evicted from disk.
+    """
+
+    stores: Dict[str, TTSCacheStore] = {}
+
+    def __init__(
+        self,
+        name: str = "default",
+        max_memory_bytes: int = 64 * 1024 * 1024,
+        cache_dir: Optional[str] = None,
+        max_text_length: int = 40,
+    ):
+        self.name = name
+        self.store = self.stores.setdefault(name, TTSCacheStore(max_memory_bytes))
+        self.cache_dir = cache_dir
+        self.max_text_length = max_text_length
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, text: str, voice: str, speed: str, emotion: str, sample_rate: int) -> Optional[str]:
+        """
+        None when the text is too long to be worth caching
+        """
+        text = normalize_text(text)
+        if not text or len(text) > self.max_text_length:
+            return None
+        raw = "\x00".join([text, str(voice), str(speed), str(emotion), str(sample_rate)])
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    def bypass(self):
+        self.store.bypassed += 1
+
+    def get(self, key: str) -> Optional[bytes | mmap.mmap]:
+        pcm = self.store.get(key)
+        if pcm is not None:
+            self.store.hits += 1
+            return pcm
+        path = self.path(key)
+        if path and os.path.exists(path):
+            with open(path, "rb") as f:
+                pcm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.store.disk_hits += 1
+            return pcm
+        self.store.misses += 1
+        return None
+
+    async def put(self, key: str, pcm: bytes):
+        if not pcm:
+            return
+        self.store.put(key, pcm)
+        path = self.path(key)
+        if path and not os.path.exists(path):
+            await asyncio.to_thread(self.write_file, path, pcm)
+
+    async def stream(self, pcm: bytes | mmap.mmap, chunk_size: int) -> AsyncGenerator[bytes, None]:
+        """
+        serve cached pcm in the same chunk size as live synthesis
+        """
+        try:
+            for i in range(0, len(pcm), chunk_size):
+                chunk = pcm[i : i + chunk_size]
+                self.store.bytes_served += len(chunk)
+                yield chunk
+        finally:
+            if isinstance(pcm, mmap.mmap):
+                pcm.close()
+
+    def path(self, key: str) -> Optional[str]:
+        return os.path.join(self.cache_dir, f"{key}.pcm") if self.cache_dir else None
+
+    @staticmethod
+    def write_file(path: str, pcm: bytes):
+        tmp = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, "wb") as f:
+                f.write(pcm)
+            os.replace(tmp, path)
+        except OSError as e:
+            logger.error(f"Error writing tts cache file {path}: {e}")
+
+    def stats(self) -> Dict:
+        return self.store.stats()
+
+    @classmethod
+    def all_stats(cls) -> Dict[str, Dict]:
+        return {name: store.stats() for name, store in cls.stores.items()}
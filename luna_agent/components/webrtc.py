@@ -1,23 +1,49 @@
 import asyncio
 import base64
-import json
 import time
-from typing import AsyncGenerator
+from typing import AsyncGenerator, List, Optional
 
 from fastapi import WebSocket, WebSocketDisconnect
 from starlette.websockets import WebSocketState
 
-from luna_agent.utils import ByteQueue, StreamingResampler, logger, safe_create_task
+from luna_agent.capture import AUDIO_IN, AUDIO_OUT, EVENT, TEXT_OUT
+from luna_agent.components.codec import OpusCodec, create_codec
+from luna_agent.components.filler import crossfade
+from luna_agent.components.preprocess import AudioPreprocessor
+from luna_agent.log import Sampled
+from luna_agent.utils import ByteQueue, StreamingResampler, json_codec, logger, safe_create_task
+
+
+chunk_log = Sampled(logger, every=100)
 
 
 class WebRTCData:
     def __init__(
         self,
+        binary_audio: bool = False,
+        preprocess: Optional[AudioPreprocessor] = None,
+        opus_bitrate: Optional[int] = None,
     ):
+        """
+        binary_audio: send audio as raw binary websocket frames instead of base64 inside json,
+            lets debug/middleware.py relay frames without parsing them (--relay)
+        preprocess: cleans up the user's audio after resampling, chunks it gates are not read
+        opus_bitrate: of the agent's audio when the client negotiated opus, the encoder's default if None
+        """
+        self.binary_audio = binary_audio
+        self.preprocess = preprocess
+        self.opus_bitrate = opus_bitrate
+        self.codec: Optional[OpusCodec] = None  # raw pcm when None
         self.ws = None
         self.read_resampler = None
         self.write_resampler = None
         self.closed = asyncio.Event()
+        # positions in the output audio stream (bytes before resampling), bytes_sent is the playback cursor
+        self.bytes_written = 0
+        self.bytes_sent = 0
+        self.timeline = None  # luna_agent.timeline.ResponseTimeline of the response being played
+        self.capture = None  # luna_agent.capture.CaptureWriter when the session is captured
+        self.last_active = 0.0  # monotonic time of the last audio frame in or out, see luna_agent.lifecycle
 
     async def setup(
         self,
@@ -29,7 +55,14 @@ class WebRTCData:
         read_dst_channels: int = 1,
         write_src_channels: int = 1,
         write_dst_channels: int = 1,
+        codec: str = "pcm",
     ):
+        """
+        codec: asked for by the client, see luna_agent.components.codec
+        """
+        self.codec = create_codec(
+            codec, read_src_sr, read_src_channels, write_dst_sr, write_dst_channels, bitrate=self.opus_bitrate
+        )
         if read_src_sr != read_dst_sr or read_src_channels != read_dst_channels:
             self.read_resampler = StreamingResampler(
                 src_rate=read_src_sr,
@@ -37,6 +70,8 @@ class WebRTCData:
                 src_channels=read_src_channels,
                 dst_channels=read_dst_channels,
             )
+        if self.preprocess is not None:
+            self.preprocess.setup(read_dst_sr)
 
         if write_src_sr != write_dst_sr or write_src_channels != write_dst_channels:
             self.write_resampler = StreamingResampler(
@@ -46,6 +81,13 @@ class WebRTCData:
                 dst_channels=write_dst_channels,
             )
 
+        self.ms2bytes = lambda x: x * write_src_sr // 1000 * 2 * write_src_channels
+        self.bytes2ms = lambda x: x * 1000 // write_src_sr // 2 // write_src_channels
+
+    @property
+    def codec_name(self) -> str:
+        return self.codec.name if self.codec is not None else "pcm"
+
     @property
     def ready(self) -> bool:
         return self.ws is not None and self.ws.client_state == WebSocketState.CONNECTED
@@ -59,41 +101,112 @@ class WebRTCData:
             raise RuntimeError("WebSocket connection is not established")
         while True:
             chunk = await self.ws.receive_bytes()
+            self.last_active = time.monotonic()
+            if self.codec is not None:
+                chunk = await self.codec.decode(chunk)
+            if self.capture is not None:
+                self.capture.record(AUDIO_IN, chunk)
             if self.read_resampler:
                 chunk = self.read_resampler(chunk)
+            if self.preprocess is not None:
+                chunk = self.preprocess(chunk)
+                if not chunk:
+                    continue
             yield chunk
 
     async def write(self, data: bytes | str, **params):
+        if isinstance(data, bytes):
+            if self.capture is not None:
+                self.capture.record(AUDIO_OUT, data)
+            self.bytes_written += len(data)
+            return await self.send_audio(data, **params)
         if not self.ready:
             raise RuntimeError("WebSocket connection is not established")
-        data_type = "text"
-        if isinstance(data, bytes):
-            if self.write_resampler:
-                data = self.write_resampler(data)
-            data = base64.b64encode(data).decode("utf-8")
-            data_type = "bytes"
-        payload = {"data": data, "data_type": data_type, **params}
-        await self.ws.send_text(json.dumps(payload))
+        if self.capture is not None:
+            self.capture.record(TEXT_OUT, data)
+        payload = {"data": data, "data_type": "text", **params}
+        await self.ws.send_text(json_codec.dumps(payload))
 
-    def flush(self):
+    async def send_audio(self, data: bytes, **params):
+        self.bytes_sent += len(data)
+        self.last_active = time.monotonic()
+        await self.send_pcm(data, **params)
+        if self.timeline is not None:
+            await self.timeline.advance()
+
+    async def send_pcm(self, data: bytes, **params):
+        """
+        send audio without moving the playback cursor
+        """
+        if not self.ready:
+            raise RuntimeError("WebSocket connection is not established")
+        if self.write_resampler:
+            data = self.write_resampler(data)
+        if self.codec is not None:
+            await self.send_packets(await self.codec.encode(data), **params)
+        elif self.binary_audio:
+            await self.ws.send_bytes(data)
+        else:
+            payload = {"data": base64.b64encode(data).decode("utf-8"), "data_type": "bytes", **params}
+            await self.ws.send_text(json_codec.dumps(payload))
+
+    async def send_packets(self, packets: List[bytes], **params):
+        if self.binary_audio:
+            for packet in packets:
+                await self.ws.send_bytes(packet)
+        elif packets:
+            packets = [base64.b64encode(packet).decode("utf-8") for packet in packets]
+            await self.ws.send_text(json_codec.dumps({"data": packets, "data_type": "opus", **params}))
+
+    async def flush_codec(self):
+        """
+        end of a response, send the audio the encoder holds back until a full frame
+        """
+        if self.codec is not None and self.ready:
+            await self.send_packets(await self.codec.flush())
+
+    async def write_filler(self, data: bytes, crossfade_ms: int = 40):
+        """
+        only the live stream paces its output, so only it can mix a filler into the reply
+        """
         pass
 
-    def clear(self):
+    def stop_filler(self):
         pass
 
+    def flush(self):
+        if self.codec is not None:
+            safe_create_task(self.flush_codec())
+
+    def clear(self):
+        if self.codec is not None:
+            self.codec.reset()
+
+    async def wait_closed(self):
+        """
+        the client going away surfaces in read(), the session tears the channel down from there
+        """
+        await self.closed.wait()
+
     async def close(self):
+        if self.preprocess is not None:
+            logger.info(f"Preprocessing stats: {self.preprocess.stats()}")
         if self.ws and self.ws.client_state == WebSocketState.CONNECTED:
             await self.ws.close()
         self.closed.set()
 
 
 class WebRTCDataLiveStream(WebRTCData):
-    def __init__(self, chunk_ms: int = 100):
-        super().__init__()
+    def __init__(self, chunk_ms: int = 100, **kwargs):
+        super().__init__(**kwargs)
         self.chunk_ms = chunk_ms
         self.on_flush = lambda: None
         self.flushed = False
         self.buffer = ByteQueue()
+        # filler audio is outside the output stream, it never moves bytes_written / bytes_sent
+        self.filler = ByteQueue()
+        self.filler_crossfade_bytes = 0
+        self.livestream_task = None
 
     async def setup(self, write_dst_sr=16000, write_dst_channels=1, **kwargs):
         await super().setup(write_dst_sr=write_dst_sr, **kwargs)
@@ -103,46 +216,92 @@ class WebRTCDataLiveStream(WebRTCData):
         self.chunk_bytes = self.ms2bytes(self.chunk_ms)
 
     async def connect(self, websocket: WebSocket):
-        logger.info(f"Connecting WebRTCDataLiveStream with chunk size {self.chunk_bytes} bytes")
+        logger.info("Connecting WebRTCDataLiveStream with chunk size %d bytes", self.chunk_bytes)
         await super().connect(websocket)
-        safe_create_task(self.livestream())
+        self.livestream_task = safe_create_task(self.livestream())
 
     async def livestream(self):
         while True:
             try:
                 chunk = self.buffer.pop(self.chunk_bytes)
-                if not chunk:
+                if len(self.filler):
+                    await self.send_filler(chunk)
+                elif not chunk:
                     if self.flushed:
                         self.flushed = False
+                        await self.flush_codec()
                         await self.on_flush()
                 else:
-                    logger.debug(f"Sending chunk of size {len(chunk)}")
-                    await super().write(chunk)
+                    chunk_log.debug("Sending chunk of size %d", len(chunk))
+                    await self.send_audio(chunk)
                 await asyncio.sleep(self.chunk_ms / 1000)
-            except WebSocketDisconnect:
+            except (WebSocketDisconnect, RuntimeError):
+                # client gone, the session closes the channel
                 break
 
+    async def send_filler(self, chunk: bytes):
+        if not chunk:
+            await self.send_pcm(self.filler.pop(self.chunk_bytes))
+            return
+        # the reply is ready, fade the rest of the filler out over its first crossfade bytes
+        overlap = min(len(self.filler), self.filler_crossfade_bytes, len(chunk)) // 2 * 2
+        tail = self.filler.pop(overlap)
+        self.filler.clear()
+        await self.send_audio(crossfade(tail, chunk[:overlap]) + chunk[overlap:])
+
+    async def write_filler(self, data: bytes, crossfade_ms: int = 40):
+        if len(self.buffer):
+            return
+        self.filler.clear()
+        self.filler.append(data)
+        self.filler_crossfade_bytes = self.ms2bytes(crossfade_ms)
+
+    def stop_filler(self):
+        """
+        drop what is left of a filler, e.g. when no reply follows it
+        """
+        self.filler.clear()
+
+    def buffered_ms(self) -> float:
+        """
+        audio of the reply written but not sent yet
+        """
+        return self.bytes2ms(len(self.buffer))
+
     def flush(self):
         """
         TODO: change the name
-        indicate end of a response
+        indicate end of a response, the codec is flushed once the buffer is sent
         """
         self.flushed = True
 
     def clear(self):
+        super().clear()
+        self.bytes_written -= len(self.buffer)
         self.buffer.clear()
+        self.filler.clear()
+        self.timeline = None
 
     async def write(self, data: bytes | str, **params):
         if isinstance(data, str):
             return await super().write(data, **params)
+        if self.capture is not None:
+            self.capture.record(AUDIO_OUT, data)
         self.flushed = False
         self.buffer.append(data)
+        self.bytes_written += len(data)
+
+    async def close(self):
+        if self.livestream_task is not None:
+            self.livestream_task.cancel()
+        await super().close()
 
 
 class WebRTCEvent:
     def __init__(self):
         self.ws = None
         self.closed = asyncio.Event()
+        self.capture = None
 
     async def connect(self, websocket: WebSocket):
         self.ws = websocket
@@ -151,7 +310,29 @@ class WebRTCEvent:
     async def send_event(self, event: str, data: dict):
         if not self.ws or self.ws.client_state != WebSocketState.CONNECTED:
             raise RuntimeError("WebSocket connection is not established")
-        await self.ws.send_text(json.dumps({"event": event, "data": data}))
+        if self.capture is not None:
+            self.capture.record(EVENT, {"event": event, "data": data})
+        await self.ws.send_text(json_codec.dumps({"event": event, "data": data}))
+
+    async def wait_closed(self):
+        """
+        nothing is read from the event channel, receive anyway to notice the client going away
+        """
+
+        async def receive_until_disconnect():
+            try:
+                while (await self.ws.receive())["type"] != "websocket.disconnect":
+                    pass
+            except (WebSocketDisconnect, RuntimeError):
+                pass
+
+        receive = asyncio.create_task(receive_until_disconnect())
+        closed = asyncio.create_task(self.closed.wait())
+        try:
+            await asyncio.wait([receive, closed], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            receive.cancel()
+            closed.cancel()
 
     async def close(self):
         if self.ws and self.ws.client_state == WebSocketState.CONNECTED:
@@ -0,0 +1,225 @@
+import asyncio
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, TypeVar
+
+import numpy as np
+
+from luna_agent.utils import logger, safe_create_task
+
+T = TypeVar("T")
+
+
+class Endpoint:
+    def __init__(self, url: str, window: int):
+        self.url = url
+        self.outstanding = 0
+        self.latencies = deque(maxlen=window)  # seconds, successful requests only
+        self.failures = 0  # consecutive
+        self.ejected_until = 0.0
+        self.requests = self.errors = self.ejections = 0
+
+    def ejected(self, now: float) -> bool:
+        return self.ejected_until > now
+
+    def latency(self) -> float:
+        return float(np.mean(self.latencies)) if self.latencies else 0.0
+
+    def stats(self) -> Dict:
+        return {
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "errors": self.errors,
+            "ejected": self.ejected(time.monotonic()),
+            "ejections": self.ejections,
+            "mean_ms": round(self.latency() * 1000, 1),
+        }
+
+
+class EndpointPool:
+    """
+    the process wide state of an EndpointGroup: replicas, outstanding requests, recent latencies
+    """
+
+    def __init__(self, urls: Sequence[str], window: int):
+        self.endpoints = [Endpoint(url, window) for url in urls]
+        self.latencies = deque(maxlen=window)
+        self.hedges = self.hedge_wins = 0
+        self.group: Optional["EndpointGroup"] = None  # the latest instance, for its settings in all_stats
+
+
+class EndpointGroup:
+    """
+    replicas of a model backend (asr, tts, diar, slm, llm). each request goes to the healthy replica with the
+    fewest outstanding requests; a replica failing max_failures times in a row is ejected for eject_s seconds.
+    with hedge, a request still unanswered after the hedge_quantile latency of the group is duplicated to a
+    second replica and the first answer is kept, a failed request is retried once on another replica.
+
+    hyperpyyaml creates one instance per session, the state is shared by name like TTSCache
+    """
+
+    pools: Dict[str, EndpointPool] = {}
+
+    def __init__(
+        self,
+        name: str,
+        urls: List[str],
+        hedge: bool = False,
+        hedge_quantile: float = 0.95,
+        min_hedge_ms: float = 50,
+        min_samples: int = 20,
+        max_failures: int = 3,
+        eject_s: float = 10,
+        retries: int = 1,
+        window: int = 200,
+    ):
+        """
+        min_samples: latencies needed before hedging, until then requests are not hedged
+        window: latencies kept per replica / group
+        """
+        if not urls:
+            raise ValueError(f"endpoint group {name} has no urls")
+        self.name = name
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.min_hedge_s = min_hedge_ms / 1000
+        self.min_samples = min_samples
+        self.max_failures = max_failures
+        self.eject_s = eject_s
+        self.retries = retries
+        pool = self.pools.get(name)
+        if pool is None or [endpoint.url for endpoint in pool.endpoints] != list(urls):
+            pool = self.pools[name] = EndpointPool(urls, window)
+        self.pool = pool
+        pool.group = self
+
+    @classmethod
+    def single(cls, url: str) -> "EndpointGroup":
+        """
+        group of a component configured with a plain base_url
+        """
+        return cls(url, [url], retries=0)
+
+    @property
+    def endpoints(self) -> List[Endpoint]:
+        return self.pool.endpoints
+
+    @property
+    def urls(self) -> List[str]:
+        return [endpoint.url for endpoint in self.pool.endpoints]
+
+    def pick(self, exclude: Sequence[Endpoint] = ()) -> Endpoint:
+        now = time.monotonic()
+        candidates = [endpoint for endpoint in self.endpoints if endpoint not in exclude] or self.endpoints
+        healthy = [endpoint for endpoint in candidates if not endpoint.ejected(now)]
+        if not healthy:
+            # all ejected, better a replica that may have recovered than no answer
+            return min(candidates, key=lambda endpoint: endpoint.ejected_until)
+        return min(healthy, key=lambda endpoint: (endpoint.outstanding, endpoint.latency()))
+
+    def hedge_delay(self) -> Optional[float]:
+        if not self.hedge or len(self.endpoints) < 2 or len(self.pool.latencies) < self.min_samples:
+            return None
+        return max(self.min_hedge_s, float(np.quantile(self.pool.latencies, self.hedge_quantile)))
+
+    async def attempt(self, endpoint: Endpoint, fn: Callable[[str], Awaitable[T]]) -> T:
+        start = time.perf_counter()
+        try:
+            result = await fn(endpoint.url)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            endpoint.errors += 1
+            endpoint.failures += 1
+            if endpoint.failures >= self.max_failures and len(self.endpoints) > 1:
+                logger.warning(f"Ejecting {endpoint.url} from {self.name} for {self.eject_s}s: {e}")
+                endpoint.ejected_until = time.monotonic() + self.eject_s
+                endpoint.ejections += 1
+                endpoint.failures = 0
+            raise
+        latency = time.perf_counter() - start
+        endpoint.failures = 0
+        endpoint.latencies.append(latency)
+        self.pool.latencies.append(latency)
+        return result
+
+    async def request_to(self, endpoint: Endpoint, fn: Callable[[str], Awaitable[T]]) -> T:
+        """
+        fn on one given replica, no hedge or retry. for backends keeping per session state on a replica
+        """
+        endpoint.outstanding += 1
+        endpoint.requests += 1
+        try:
+            return await self.attempt(endpoint, fn)
+        finally:
+            endpoint.outstanding -= 1
+
+    async def request(
+        self,
+        fn: Callable[[str], Awaitable[T]],
+        discard: Optional[Callable[[T], Awaitable[Any]]] = None,
+    ) -> T:
+        """
+        fn: the request to one replica, called with its url
+        discard: releases the answer of a duplicate that finished too (e.g. closes a stream)
+        """
+        if len(self.endpoints) == 1:
+            # a plain base_url, nothing to hedge or retry on: no task per attempt
+            return await self.request_to(self.endpoints[0], fn)
+
+        def release(task: asyncio.Task):
+            if not task.cancelled() and task.exception() is None and discard is not None:
+                safe_create_task(discard(task.result()))
+
+        attempts: Dict[asyncio.Task, Endpoint] = {}
+        tried: List[Endpoint] = []
+
+        def launch():
+            endpoint = self.pick(exclude=tried)
+            tried.append(endpoint)
+            # counted right away, so concurrent requests picking before this one runs see it
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+            task = asyncio.ensure_future(self.attempt(endpoint, fn))
+            task.add_done_callback(lambda _: setattr(endpoint, "outstanding", endpoint.outstanding - 1))
+            attempts[task] = endpoint
+
+        launch()
+        hedged, error = False, None
+        try:
+            while attempts:
+                delay = None if hedged else self.hedge_delay()
+                done, _ = await asyncio.wait(attempts, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedged = True
+                    self.pool.hedges += 1
+                    launch()
+                    continue
+                for task in done:
+                    if task.exception() is None:
+                        if hedged and attempts[task] is not tried[0]:
+                            self.pool.hedge_wins += 1
+                        del attempts[task]
+                        return task.result()
+                    error = task.exception()
+                    del attempts[task]
+                if not attempts and len(tried) <= self.retries and len(tried) < len(self.endpoints):
+                    launch()
+            raise error
+        finally:
+            for task in attempts:
+                task.cancel()
+                task.add_done_callback(release)
+
+    def stats(self) -> Dict:
+        hedge_delay = self.hedge_delay()
+        return {
+            "hedge_delay_ms": round(hedge_delay * 1000, 1) if hedge_delay is not None else None,
+            "hedges": self.pool.hedges,
+            "hedge_wins": self.pool.hedge_wins,
+            "endpoints": {endpoint.url: endpoint.stats() for endpoint in self.endpoints},
+        }
+
+    @classmethod
+    def all_stats(cls) -> Dict:
+        return {name: pool.group.stats() for name, pool in cls.pools.items()}
@@ -0,0 +1,216 @@
+"""
+the conversation history of a chat session. turns are __slots__ records, the user's audio is kept once as raw
+pcm in the session's AudioArena (the oldest spilled to a memory mapped temporary file past spill_bytes) and only
+encoded to the openai message format (base64 wav) when a request needs it. a response works on a view of the
+history as it was when it started, no copy of the list
+"""
+
+import base64
+import hashlib
+import io
+import mmap
+import tempfile
+from collections import deque
+from typing import Dict, Iterator, List, Optional
+
+import numpy as np
+import soundfile as sf
+
+from luna_agent.utils import pcm2base64
+
+
+class AudioRef:
+    """
+    an utterance in an arena, in memory (pcm) or at offset in its spill file
+    """
+
+    __slots__ = ("id", "pcm", "offset", "length", "arena")
+
+    def __init__(self, audio_id: str, pcm: bytes, arena: "AudioArena"):
+        self.id = audio_id
+        self.pcm: Optional[bytes] = pcm
+        self.offset = 0
+        self.length = len(pcm)
+        self.arena = arena
+
+    def read(self) -> bytes:
+        return self.pcm if self.pcm is not None else self.arena.read(self.offset, self.length)
+
+
+class AudioArena:
+    """
+    the pcm of one session's utterances. the newest stay in memory up to spill_bytes, older ones are appended to
+    an unlinked temporary file and read back through mmap, so the pages of a long session's audio belong to the
+    page cache instead of the process
+    """
+
+    def __init__(self, spill_bytes: int = 8 * 1024 * 1024, spill_dir: Optional[str] = None):
+        self.spill_bytes = spill_bytes
+        self.spill_dir = spill_dir
+        self.resident: deque[AudioRef] = deque()
+        self.resident_bytes = 0
+        self.file = None
+        self.file_bytes = 0
+        self.map: Optional[mmap.mmap] = None
+
+    def add(self, pcm: bytes, audio_id: Optional[str] = None) -> AudioRef:
+        ref = AudioRef(audio_id or hashlib.md5(pcm).hexdigest(), pcm, self)
+        self.resident.append(ref)
+        self.resident_bytes += ref.length
+        while self.resident_bytes > self.spill_bytes and len(self.resident) > 1:
+            self.spill(self.resident.popleft())
+        return ref
+
+    def spill(self, ref: AudioRef):
+        if self.file is None:
+            self.file = tempfile.TemporaryFile(dir=self.spill_dir, prefix="luna_history_")
+        self.file.seek(self.file_bytes)
+        self.file.write(ref.pcm)
+        ref.offset, ref.pcm = self.file_bytes, None
+        self.file_bytes += ref.length
+        self.resident_bytes -= ref.length
+
+    def read(self, offset: int, length: int) -> bytes:
+        if self.map is None or len(self.map) < offset + length:
+            # mapped again once the file grew past the mapping
+            self.file.flush()
+            if self.map is not None:
+                self.map.close()
+            self.map = mmap.mmap(self.file.fileno(), self.file_bytes, access=mmap.ACCESS_READ)
+        return self.map[offset : offset + length]
+
+    def stats(self) -> Dict:
+        return {"resident_bytes": self.resident_bytes, "spilled_bytes": self.file_bytes}
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class Turn:
+    """
+    one message, treated as immutable: History.set_text replaces it
+    """
+
+    __slots__ = ("role", "text", "audio", "transcript")
+
+    def __init__(
+        self, role: str, text: Optional[str] = None, audio: Optional[AudioRef] = None, transcript: str = ""
+    ):
+        self.role = role
+        self.text = text
+        self.audio = audio
+        self.transcript = transcript
+
+    def message(self, audio: bool = True) -> Dict:
+        """
+        the openai message, see luna_agent.components.slm.add_user_message. audio=False leaves the wav out of
+        the audio item (its id and transcript stay), for text history
+        """
+        if self.role != "user":
+            return {"role": self.role, "content": self.text}
+        content = []
+        if self.audio is not None:
+            item = {"type": "input_audio"}
+            if audio:
+                item["input_audio"] = {"data": pcm2base64(self.audio.read(), sample_rate=16000), "format": "wav"}
+            item["id"] = self.audio.id
+            item["transcript"] = self.transcript
+            content.append(item)
+        if self.text:
+            content.append({"type": "text", "text": self.text})
+        return {"role": "user", "content": content}
+
+
+class HistoryView:
+    """
+    the first `length` turns of a history, unchanged by what the history does later
+    """
+
+    __slots__ = ("turns", "length")
+
+    def __init__(self, turns: List[Turn], length: int):
+        self.turns = turns
+        self.length = length
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.turns[i] for i in range(self.length)[index]]
+        return self.turns[range(self.length)[index]]
+
+    def __iter__(self) -> Iterator[Turn]:
+        for i in range(self.length):
+            yield self.turns[i]
+
+
+class History:
+    """
+    turns are only appended, except the reply cut back to what was played (set_text), which copies the list
+    first if a view of it is out
+    """
+
+    def __init__(self, spill_bytes: int = 8 * 1024 * 1024, spill_dir: Optional[str] = None):
+        """
+        spill_bytes: user audio kept in memory, older utterances go to a temporary file in spill_dir
+        """
+        self.arena = AudioArena(spill_bytes=spill_bytes, spill_dir=spill_dir)
+        self.turns: List[Turn] = []
+        self.viewed = False
+
+    def __len__(self) -> int:
+        return len(self.turns)
+
+    def __getitem__(self, index):
+        return self.turns[index]
+
+    def view(self) -> HistoryView:
+        self.viewed = True
+        return HistoryView(self.turns, len(self.turns))
+
+    def append_user(self, audio: Optional[bytes] = None, transcript: str = "", text: Optional[str] = None):
+        assert audio or text, "audio or text must be provided"
+        ref = self.arena.add(audio) if audio else None
+        self.turns.append(Turn("user", text=text, audio=ref, transcript=transcript))
+
+    def append_agent(self, text: str):
+        self.turns.append(Turn("assistant", text=text))
+
+    def set_text(self, index: int, text: str):
+        if self.viewed:
+            self.turns, self.viewed = self.turns[:], False
+        turn = self.turns[index]
+        self.turns[index] = Turn(turn.role, text=text, audio=turn.audio, transcript=turn.transcript)
+
+    def messages(self) -> List[Dict]:
+        """
+        the whole history as openai messages, what snapshots store
+        """
+        return [turn.message() for turn in self.turns]
+
+    def load(self, messages: List[Dict]):
+        """
+        append openai messages (a restored snapshot)
+        """
+        for message in messages:
+            if message["role"] != "user" or not isinstance(message["content"], list):
+                self.turns.append(Turn(message["role"], text=message["content"]))
+                continue
+            audio, transcript, text = None, "", None
+            for item in message["content"]:
+                if item.get("type") == "input_audio":
+                    wav = base64.b64decode(item["input_audio"]["data"])
+                    pcm = sf.read(io.BytesIO(wav), dtype="int16")[0].astype(np.int16).tobytes()
+                    audio, transcript = self.arena.add(pcm, item["id"]), item.get("transcript", "")
+                elif item.get("type") == "text":
+                    text = item["text"]
+            self.turns.append(Turn("user", text=text, audio=audio, transcript=transcript))
+
+    def close(self):
+        self.arena.close()
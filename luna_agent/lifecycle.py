@@ -0,0 +1,153 @@
+import asyncio
+import time
+from typing import Dict, Optional
+
+from fastapi import WebSocket
+
+from luna_agent.admission import SessionUsage
+from luna_agent.log import log_context
+from luna_agent.utils import AsyncTaskMixin, logger
+
+
+class Session(AsyncTaskMixin):
+    """
+    base of the agents' sessions: owns every background task of the session (create_task) and tears it down
+    exactly once. subclasses register themselves in their class level `sessions` and release their
+    components in `close`. see luna_agent.runtime for the hooks used to serve them
+    """
+
+    sessions: Dict[str, "Session"] = {}
+
+    def __init__(self):
+        super().__init__()
+        self.usage = SessionUsage()
+        self.session_id: Optional[str] = None
+        self.data = None
+        self.destroyed = False
+        self.destroy_task: Optional[asyncio.Task] = None
+        self.created_at = time.monotonic()
+
+    @classmethod
+    def session_options(cls, body: Dict) -> Dict:
+        """
+        keyword arguments of create from the /start_session request body
+        """
+        return {
+            "user_audio_sample_rate": body.get("sample_rate", 16000),
+            "user_audio_num_channels": body.get("num_channels", 1),
+            "user_audio_codec": body.get("codec", "pcm"),
+        }
+
+    @classmethod
+    def configure(cls, **options):
+        """
+        agent wide options, the `options` of its AgentHost (config/runtime.yaml)
+        """
+        if options:
+            raise TypeError(f"{cls.__module__} takes no options, got {', '.join(options)}")
+
+    @classmethod
+    def add_routes(cls, host):
+        """
+        agent specific endpoints, added to host.router (a luna_agent.runtime.AgentHost)
+        """
+        pass
+
+    @classmethod
+    async def startup(cls, host):
+        pass
+
+    async def listen(self):
+        raise NotImplementedError
+
+    def last_active(self) -> float:
+        """
+        monotonic time of the last audio frame in or out
+        """
+        return max(self.created_at, getattr(self.data, "last_active", 0.0))
+
+    async def close(self):
+        """
+        release the components (websockets, downstream connections), called once by destroy
+        """
+        pass
+
+    async def expire(self):
+        """
+        called by SessionManager when the session was idle for too long
+        """
+        await self.destroy()
+
+    async def destroy(self):
+        # runs in its own task: destroy is often called from one of the session's tasks, which it cancels
+        if self.destroy_task is None:
+            self.destroyed = True
+            self.destroy_task = asyncio.create_task(self._destroy())
+        await asyncio.shield(self.destroy_task)
+
+    async def _destroy(self):
+        logger.info(f"Destroying session {self.session_id}")
+        try:
+            await self.close()
+        except Exception as e:
+            logger.error(f"Error closing session {self.session_id}: {e}")
+        super().destroy()
+        # a resumed session reuses the id
+        if self.sessions.get(self.session_id) is self:
+            del self.sessions[self.session_id]
+
+
+class SessionManager:
+    """
+    reaps sessions of one agent whose audio went quiet for idle_timeout seconds (dead clients, clients that
+    never connected) and reports live session / task counts
+    """
+
+    def __init__(self, sessions: Dict[str, Session], idle_timeout: float = 120, sweep_interval: float = 5):
+        self.sessions = sessions
+        self.idle_timeout = idle_timeout
+        self.sweep_interval = sweep_interval
+        self.reaped = 0
+        self.reaper_task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self.reaper_task is None and self.idle_timeout > 0:
+            self.reaper_task = asyncio.create_task(self.reaper())
+
+    async def reaper(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            await self.reap()
+
+    async def reap(self):
+        now = time.monotonic()
+        idle = [s for s in list(self.sessions.values()) if now - s.last_active() > self.idle_timeout]
+        for session in idle:
+            logger.info(f"Session {session.session_id} idle for {now - session.last_active():.0f}s, expiring it")
+            self.reaped += 1
+            try:
+                await session.expire()
+            except Exception as e:
+                logger.error(f"Error expiring session {session.session_id}: {e}")
+
+    def stats(self) -> Dict:
+        return {
+            "sessions": len(self.sessions),
+            "session_tasks": sum(len(session.tasks) for session in self.sessions.values()),
+            "process_tasks": len(asyncio.all_tasks()),
+            "reaped": self.reaped,
+        }
+
+
+async def serve_channel(sessions: Dict[str, Session], session_id: str, channel: str, websocket: WebSocket):
+    """
+    websocket endpoint body for a session's data / event channel, returns once the channel is closed
+    """
+    session = sessions.get(session_id)
+    if session is None or session.destroyed:
+        await websocket.close(code=1008)
+        return
+    channel = getattr(session, channel)
+    with log_context(session_id=session_id):
+        await channel.connect(websocket)
+        await channel.wait_closed()
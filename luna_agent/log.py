@@ -0,0 +1,188 @@
+"""
+logging of the agents: lazy formatting, the session / turn a record belongs to, sampling of per chunk records
+and a queue handler, so formatting and log I/O run on a background thread instead of the event loop.
+setup_logging() is called by the agent modules, benchmarks/bench_logging.py measures the loop time it saves
+
+    logger.debug("Sending chunk of size %d", len(chunk))  # %-args, only formatted when the level is on
+    logger.info(">>> %s", lazy(format_msg, content))  # expensive arguments too
+    chunk_log = Sampled(logger, every=100)  # one record per 100 calls of a per chunk call site
+"""
+
+import atexit
+import json
+import logging
+import os
+import queue
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Callable, Coroutine, Optional
+
+logger = logging.getLogger("luna_agent")
+
+# set per task: the session's tasks get the session id (luna_agent.utils.AsyncTaskMixin), a response its turn
+session_id_var: ContextVar[Optional[str]] = ContextVar("session_id", default=None)
+turn_id_var: ContextVar[Optional[int]] = ContextVar("turn_id", default=None)
+
+FORMAT = "%(asctime)s.%(msecs)03d - %(name)s - %(levelname)s - %(context)s%(message)s"
+DATEFMT = "%Y-%m-%d %H:%M:%S"
+
+
+class lazy:
+    """
+    a log argument formatted only if the record is emitted, on the thread that emits it
+    """
+
+    __slots__ = ("fn", "args")
+
+    def __init__(self, fn: Callable[..., Any], *args):
+        self.fn = fn
+        self.args = args
+
+    def __str__(self):
+        return str(self.fn(*self.args))
+
+
+class Sampled:
+    """
+    logs the first of every `every` calls of a per chunk call site
+    """
+
+    def __init__(self, logger: logging.Logger, every: int = 100):
+        self.logger = logger
+        self.every = every
+        self.calls = 0
+
+    def log(self, level: int, msg: str, *args):
+        self.calls += 1
+        if self.calls % self.every == 1 or self.every == 1:
+            self.logger.log(level, f"{msg} (1 of every %d)", *args, self.every)
+
+    def debug(self, msg: str, *args):
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.log(logging.DEBUG, msg, *args)
+
+    def info(self, msg: str, *args):
+        if self.logger.isEnabledFor(logging.INFO):
+            self.log(logging.INFO, msg, *args)
+
+
+@contextmanager
+def log_context(session_id: Optional[str] = None, turn_id: Optional[int] = None):
+    pairs = ((session_id_var, session_id), (turn_id_var, turn_id))
+    tokens = [var.set(value) for var, value in pairs if value is not None]
+    try:
+        yield
+    finally:
+        for token in reversed(tokens):
+            token.var.reset(token)
+
+
+async def in_session(coro: Coroutine, session_id: str):
+    """
+    runs coro as the body of a task of the session, its records carry the session id
+    """
+    session_id_var.set(session_id)
+    return await coro
+
+
+def context_of(record: logging.LogRecord):
+    if hasattr(record, "session_id"):  # taken by ContextQueueHandler where it was logged
+        return record.session_id, record.turn_id
+    return session_id_var.get(), turn_id_var.get()
+
+
+class ContextQueueHandler(QueueHandler):
+    """
+    only takes the session / turn of the record where it is logged (the event loop), QueueHandler would format
+    it there as well
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.session_id = session_id_var.get()
+        record.turn_id = turn_id_var.get()
+        return record
+
+
+class ContextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        session_id, turn_id = context_of(record)
+        if session_id is None:
+            record.context = ""
+        else:
+            record.context = f"[{session_id[:8]}/{turn_id}] " if turn_id is not None else f"[{session_id[:8]}] "
+        return super().format(record)
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    one json object per line, for log collectors
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        session_id, turn_id = context_of(record)
+        entry = {
+            "time": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if session_id is not None:
+            entry["session_id"] = session_id
+        if turn_id is not None:
+            entry["turn_id"] = turn_id
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+listener: Optional[QueueListener] = None
+configured = False
+
+
+def lean_records():
+    """
+    skip what the formats here never print: the caller's file / line (a stack walk per record), thread and
+    process names. see "Optimization" in the logging howto. process wide, other libraries' formats lose them too
+    """
+    logging._srcfile = None
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+
+
+def setup_logging(
+    level: int = logging.INFO,
+    fmt: Optional[str] = None,
+    use_queue: Optional[bool] = None,
+    lean: Optional[bool] = None,
+):
+    """
+    once per process, later calls only change the level
+    fmt: "text" or "json", LUNA_LOG_FORMAT by default
+    use_queue: emit from a background thread, LUNA_LOG_QUEUE=0 to emit on the calling thread
+    lean: lean_records(), off unless LUNA_LOG_LEAN=1
+    """
+    global listener, configured
+    logger.setLevel(level)
+    if configured:
+        return
+    configured = True
+    if lean is None:
+        lean = os.getenv("LUNA_LOG_LEAN", "0") == "1"
+    if lean:
+        lean_records()
+    fmt = fmt or os.getenv("LUNA_LOG_FORMAT", "text")
+    if use_queue is None:
+        use_queue = os.getenv("LUNA_LOG_QUEUE", "1") != "0"
+    handler = logging.StreamHandler()
+    handler.setFormatter(JSONFormatter() if fmt == "json" else ContextFormatter(FORMAT, DATEFMT))
+    root = logging.getLogger()
+    if use_queue:
+        records = queue.SimpleQueue()
+        listener = QueueListener(records, handler, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)
+        root.addHandler(ContextQueueHandler(records))
+    else:
+        root.addHandler(handler)
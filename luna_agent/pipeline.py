@@ -0,0 +1,208 @@
+"""
+a session's audio path as a graph of stages (source, vad, asr, slm, tts, sink ...) exchanging typed items over
+async channels. a stage's `inputs` / `outputs` map port names to item types, Pipeline wires every input to the
+output of the same name and checks both sides agree on the type
+"""
+
+import asyncio
+from typing import Awaitable, Callable, Dict, Generic, Optional, Tuple, TypeVar
+
+from fastapi import WebSocketDisconnect
+
+T = TypeVar("T")
+
+VADResult = Tuple[bool, Optional[bytes]]  # (user_is_speaking, user speech of a finished turn)
+InterpretResult = Tuple[Optional[str], Optional[str], Optional[bytes]]  # (asr text, ast text, speech)
+
+CLOSED = object()
+
+
+class Channel(Generic[T]):
+    """
+    single producer / single consumer queue between two stages, closed by the producer when it is done
+    """
+
+    def __init__(self, name: str, kind: type):
+        self.name = name
+        self.kind = kind
+        self.queue = asyncio.Queue()
+        self.buffered_bytes = 0  # audio waiting in the channel
+
+    async def put(self, item: T):
+        if isinstance(item, bytes):
+            self.buffered_bytes += len(item)
+        await self.queue.put(item)
+
+    def close(self):
+        self.queue.put_nowait(CLOSED)
+
+    async def __aiter__(self):
+        while True:
+            item = await self.queue.get()
+            if item is CLOSED:
+                return
+            if isinstance(item, bytes):
+                self.buffered_bytes -= len(item)
+            yield item
+
+    def __len__(self):
+        return self.queue.qsize()
+
+
+class Stage:
+    inputs: Dict[str, type] = {}
+    outputs: Dict[str, type] = {}
+    # set by Pipeline, so the helper tasks of a stage belong to the session as well
+    create_task: Callable[..., asyncio.Task] = staticmethod(asyncio.create_task)
+
+    async def run(self, **channels: Channel):
+        """
+        channels: one per port, by port name. returning closes the outputs
+        """
+        raise NotImplementedError
+
+    def __repr__(self):
+        return type(self).__name__
+
+
+class Pipeline:
+    def __init__(
+        self,
+        *stages: Stage,
+        channels: Optional[Dict[str, Channel]] = None,
+        create_task: Callable[..., asyncio.Task] = asyncio.create_task,
+    ):
+        """
+        channels: created by the caller to put items in from outside or to watch them, the rest are created here
+        create_task: the session's, see luna_agent.lifecycle.Session
+        """
+        self.stages = stages
+        self.channels = dict(channels or {})
+        self.create_task = create_task
+        producers: Dict[str, Stage] = {}
+        consumers: Dict[str, Stage] = {}
+        for stage in stages:
+            for port, kind in stage.outputs.items():
+                if port in producers:
+                    raise ValueError(f"{port} is produced by both {producers[port]} and {stage}")
+                producers[port] = stage
+                channel = self.channels.setdefault(port, Channel(port, kind))
+                if channel.kind != kind:
+                    raise TypeError(f"{stage} produces {kind} on {port}, the channel carries {channel.kind}")
+        for stage in stages:
+            for port, kind in stage.inputs.items():
+                if port not in producers:
+                    raise ValueError(f"no stage produces {port} for {stage}")
+                if port in consumers:
+                    raise ValueError(f"{port} is consumed by both {consumers[port]} and {stage}")
+                consumers[port] = stage
+                produced = self.channels[port].kind
+                if produced != kind:
+                    raise TypeError(f"{stage} expects {kind} on {port}, {producers[port]} produces {produced}")
+            stage.create_task = create_task
+
+    async def run_stage(self, stage: Stage):
+        try:
+            await stage.run(**{port: self.channels[port] for port in (*stage.inputs, *stage.outputs)})
+        finally:
+            for port in stage.outputs:
+                self.channels[port].close()
+
+    async def run(self):
+        await asyncio.gather(*(self.create_task(self.run_stage(stage)) for stage in self.stages))
+
+    def buffered_bytes(self) -> int:
+        return sum(channel.buffered_bytes for channel in self.channels.values())
+
+
+class Source(Stage):
+    """
+    audio frames from the client's data channel
+    """
+
+    outputs = {"audio": bytes}
+
+    def __init__(self, data, on_disconnect: Callable[[], Awaitable]):
+        self.data = data
+        self.on_disconnect = on_disconnect
+
+    async def run(self, audio: Channel[bytes]):
+        while not self.data.ready:
+            await asyncio.sleep(0.1)
+        try:
+            async for chunk in self.data.read():
+                await audio.put(chunk)
+        except WebSocketDisconnect:
+            await self.on_disconnect()
+
+
+class Sink(Stage):
+    """
+    audio frames to the client's data channel
+    """
+
+    inputs = {"audio": bytes}
+
+    def __init__(self, data):
+        self.data = data
+
+    async def run(self, audio: Channel[bytes]):
+        async for chunk in audio:
+            await self.data.write(chunk)
+
+
+class Broadcast(Stage):
+    """
+    copies every item of a port to several, e.g. user audio to the vad and the streaming asr
+    """
+
+    def __init__(self, input: str, outputs: Tuple[str, ...], kind: type = bytes):
+        self.input = input
+        self.inputs = {input: kind}
+        self.outputs = {output: kind for output in outputs}
+
+    async def run(self, **channels: Channel):
+        async for item in channels[self.input]:
+            for output in self.outputs:
+                await channels[output].put(item)
+
+
+class StreamStage(Stage):
+    """
+    a streaming component (VAD, Interpret): frames go in through __call__, results come out of results()
+    """
+
+    def __init__(self, component, output: str, kind: type, input: str = "audio"):
+        self.component = component
+        self.input = input
+        self.output = output
+        self.inputs = {input: bytes}
+        self.outputs = {output: kind}
+
+    async def run(self, **channels: Channel):
+        source, sink = channels[self.input], channels[self.output]
+
+        async def feed():
+            async for chunk in source:
+                await self.component(chunk)
+
+        async def forward():
+            async for result in self.component.results():
+                await sink.put(result)
+
+        await asyncio.gather(self.create_task(feed()), self.create_task(forward()))
+
+
+class Consumer(Stage):
+    """
+    hands each item of a port to the session
+    """
+
+    def __init__(self, port: str, kind: type, handle: Callable[[T], Awaitable]):
+        self.handle = handle
+        self.port = port
+        self.inputs = {port: kind}
+
+    async def run(self, **channels: Channel):
+        async for item in channels[self.port]:
+            await self.handle(item)
@@ -0,0 +1,254 @@
+"""
+opt-in profiling of a running agent (Runtime(profile=True), --profile):
+- the time every event loop callback holds the loop, charged to the task it steps by task name and to the
+  SessionUsage of the session that created the task, and a warning for callbacks over slow_callback_ms
+- per component timers of the VAD, ASR, SLM, LLM, TTS and WebRTCData calls
+- GET /admin/profile?seconds=10 samples the stacks of the event loop thread and returns them folded (one
+  `frame;frame;frame count` line per stack), for flamegraph.pl or speedscope
+- GET /admin/timings returns the task and component timers
+nothing is patched or sampled while profiling is off, the only cost left is naming the tasks in create_task
+"""
+
+import asyncio
+import inspect
+import os
+import re
+import sys
+import threading
+import time
+import weakref
+from collections import Counter
+from contextlib import aclosing
+from functools import partial, wraps
+from typing import Callable, Dict, List, Optional, Tuple
+
+from luna_agent.utils import AsyncTaskMixin, logger
+
+DEFAULT_TASK_NAME = re.compile(r"Task-\d+")
+
+
+def task_name(task: asyncio.Task) -> str:
+    """
+    the name given to create_task, the coroutine's for the default "Task-N" (asyncio's own, the server's)
+    """
+    name = task.get_name()
+    if DEFAULT_TASK_NAME.fullmatch(name):
+        return getattr(task.get_coro(), "__qualname__", name)
+    return name
+
+
+class Timer:
+    """
+    calls of one task / component: count, total and max time, and for async generators the time to the first
+    item
+    """
+
+    __slots__ = ("count", "total_s", "max_s", "cpu_s", "first_s")
+
+    def __init__(self):
+        self.count = 0
+        self.total_s = self.max_s = self.cpu_s = self.first_s = 0.0
+
+    def add(self, seconds: float, cpu_seconds: float = 0.0):
+        self.count += 1
+        self.total_s += seconds
+        self.cpu_s += cpu_seconds
+        if seconds > self.max_s:
+            self.max_s = seconds
+
+    def stats(self) -> Dict:
+        stats = {
+            "count": self.count,
+            "total_ms": round(self.total_s * 1000, 1),
+            "mean_ms": round(self.total_s * 1000 / self.count, 2) if self.count else 0.0,
+            "max_ms": round(self.max_s * 1000, 1),
+        }
+        if self.cpu_s:
+            stats["cpu_ms"] = round(self.cpu_s * 1000, 1)
+        if self.first_s:
+            stats["mean_first_ms"] = round(self.first_s * 1000 / self.count, 2)
+        return stats
+
+
+def timed_coroutine(fn: Callable, timer: Callable[[], Timer]):
+    @wraps(fn)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await fn(*args, **kwargs)
+        finally:
+            timer().add(time.perf_counter() - start)
+
+    return wrapper
+
+
+def timed_generator(fn: Callable, timer: Callable[[], Timer]):
+    @wraps(fn)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        first = True
+        try:
+            async with aclosing(fn(*args, **kwargs)) as items:
+                async for item in items:
+                    if first:
+                        timer().first_s += time.perf_counter() - start
+                        first = False
+                    yield item
+        finally:
+            timer().add(time.perf_counter() - start)
+
+    return wrapper
+
+
+def components() -> List[Tuple[type, str]]:
+    """
+    the (class, method) pairs timed while profiling, imported on enable
+    """
+    from luna_agent.components.asr import ASR, StreamingASR
+    from luna_agent.components.llm import LLM
+    from luna_agent.components.slm import SLM
+    from luna_agent.components.tts import TTS
+    from luna_agent.components.vad import VAD
+    from luna_agent.components.webrtc import WebRTCData
+
+    return [
+        (VAD, "__call__"),
+        (ASR, "__call__"),
+        (StreamingASR, "final"),
+        (SLM, "__call__"),
+        (LLM, "__call__"),
+        (TTS, "tts"),
+        (WebRTCData, "send_pcm"),
+    ]
+
+
+class Profiler:
+    """
+    process wide, like the event loop it instruments
+    """
+
+    enabled = False
+    slow_callback_s = 0.05
+    tasks: Dict[str, Timer] = {}
+    components: Dict[str, Timer] = {}
+    slow_callbacks = 0
+    original_run: Optional[Callable] = None
+    originals: List[Tuple[type, str, Callable]] = []
+
+    @classmethod
+    def enable(cls, slow_callback_ms: float = 50):
+        cls.slow_callback_s = slow_callback_ms / 1000
+        if cls.enabled:
+            return
+        cls.enabled = True
+        cls.original_run = asyncio.events.Handle._run
+        asyncio.events.Handle._run = cls.timed_run
+        AsyncTaskMixin.task_usage = weakref.WeakKeyDictionary()
+        for owner, method in components():
+            fn = owner.__dict__[method]
+            timer = partial(cls.component_timer, f"{owner.__name__}.{method}")
+            wrapper = timed_generator(fn, timer) if inspect.isasyncgenfunction(fn) else timed_coroutine(fn, timer)
+            cls.originals.append((owner, method, fn))
+            setattr(owner, method, wrapper)
+        logger.info(f"Profiling enabled, slow callbacks over {slow_callback_ms}ms are logged")
+
+    @classmethod
+    def disable(cls):
+        if not cls.enabled:
+            return
+        cls.enabled = False
+        asyncio.events.Handle._run = cls.original_run
+        AsyncTaskMixin.task_usage = None
+        for owner, method, fn in cls.originals:
+            setattr(owner, method, fn)
+        cls.originals = []
+
+    @classmethod
+    def component_timer(cls, key: str) -> Timer:
+        timer = cls.components.get(key)
+        if timer is None:
+            timer = cls.components[key] = Timer()
+        return timer
+
+    @classmethod
+    def check_loop(cls):
+        """
+        on the running loop, uvloop runs its callbacks in c and only the component timers work there
+        """
+        if cls.enabled and not isinstance(asyncio.get_running_loop(), asyncio.BaseEventLoop):
+            logger.warning("Profiling cannot time the callbacks of this event loop (uvloop), only the components")
+
+    @staticmethod
+    def timed_run(handle: asyncio.Handle):
+        start, cpu_start = time.perf_counter(), time.thread_time()
+        try:
+            return Profiler.original_run(handle)
+        finally:
+            elapsed, cpu = time.perf_counter() - start, time.thread_time() - cpu_start
+            owner = getattr(handle._callback, "__self__", None)
+            if isinstance(owner, asyncio.Task):
+                name = task_name(owner)
+                usage = AsyncTaskMixin.task_usage.get(owner) if AsyncTaskMixin.task_usage is not None else None
+                if usage is not None:
+                    usage.step(elapsed)
+            else:
+                name = "<callbacks>"
+            timer = Profiler.tasks.get(name)
+            if timer is None:
+                timer = Profiler.tasks[name] = Timer()
+            timer.add(elapsed, cpu)
+            if elapsed > Profiler.slow_callback_s:
+                Profiler.slow_callbacks += 1
+                logger.warning("Slow callback of %s held the event loop for %.1fms", name, elapsed * 1000)
+
+    @classmethod
+    def stats(cls, top: int = 20) -> Dict:
+        tasks = sorted(cls.tasks.items(), key=lambda item: item[1].total_s, reverse=True)[:top]
+        return {
+            "enabled": cls.enabled,
+            "slow_callbacks": cls.slow_callbacks,
+            "tasks": {name: timer.stats() for name, timer in tasks},
+            "components": {name: timer.stats() for name, timer in cls.components.items()},
+        }
+
+    @classmethod
+    def reset(cls):
+        cls.tasks.clear()
+        cls.components.clear()
+        cls.slow_callbacks = 0
+
+
+def frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{getattr(code, 'co_qualname', code.co_name)} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def sample_stacks(thread_id: int, seconds: float, interval_ms: float = 5) -> Tuple[Counter, int]:
+    """
+    samples the stack of a thread every interval_ms, blocking, run it off the sampled thread.
+    returns the count of each stack (root first, joined by ;) and the number of samples
+    """
+    stacks: Counter = Counter()
+    samples = 0
+    interval = interval_ms / 1000
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        frame = sys._current_frames().get(thread_id)
+        if frame is not None:
+            names = []
+            while frame is not None:
+                names.append(frame_name(frame))
+                frame = frame.f_back
+            stacks[";".join(reversed(names))] += 1
+            samples += 1
+        time.sleep(interval)
+    return stacks, samples
+
+
+async def profile_loop(seconds: float, interval_ms: float = 5) -> str:
+    """
+    folded stacks of the running loop's thread over the next `seconds`, most frequent first
+    """
+    stacks, samples = await asyncio.to_thread(sample_stacks, threading.get_ident(), seconds, interval_ms)
+    logger.info(f"Profiled the event loop for {seconds}s, {samples} samples")
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
@@ -0,0 +1,223 @@
+"""
+one process serving any mix of agents (chat, echo, interpret): each agent type is an AgentHost with its
+session class, config and routes, the Runtime puts them on one app with a shared admission controller, health
+and session counts. config/runtime.yaml lists the agents of a node:
+
+    python -m luna_agent.runtime --config config/runtime.yaml --port 28001
+
+the agent modules (luna_agent/agents/*.py) still run standalone, as a runtime with a single unprefixed agent
+"""
+
+import argparse
+from contextlib import nullcontext
+from typing import Dict, Optional, Type
+
+import uvicorn
+from fastapi import APIRouter, FastAPI, Request, WebSocket
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse
+from hyperpyyaml import load_hyperpyyaml
+
+from luna_agent.admission import AdmissionController, AdmissionRejected
+from luna_agent.endpoints import EndpointGroup
+from luna_agent.lifecycle import Session, SessionManager, serve_channel
+from luna_agent.log import setup_logging
+from luna_agent.profiling import Profiler, profile_loop
+from luna_agent.utils import logger, uvicorn_options
+
+
+def rejected(e: AdmissionRejected) -> JSONResponse:
+    return JSONResponse(
+        {"error": f"node at capacity ({e.reason})", "retry_after": e.retry_after},
+        status_code=503,
+        headers={"Retry-After": str(int(e.retry_after))},
+    )
+
+
+class AgentHost:
+    def __init__(self, agent: Type[Session], config: str, idle_timeout: float = 120, options: Optional[Dict] = None):
+        """
+        agent: the session class
+        config: its hyperpyyaml, read once. every session still gets its own components from it
+        idle_timeout: seconds without audio before a session expires, see SessionManager
+        options: agent wide options, passed to agent.configure (e.g. the chat agent's resume_grace)
+        """
+        self.agent = agent
+        agent.configure(**(options or {}))
+        self.config = config
+        with open(config, "r") as f:
+            self.config_text = f.read()
+        self.manager = SessionManager(agent.sessions, idle_timeout=idle_timeout)
+        self.admission: Optional[AdmissionController] = None  # the runtime's
+        self.router = APIRouter()
+        self.add_routes()
+        agent.add_routes(self)
+
+    def load_config(self, overrides: Optional[Dict] = None) -> Dict:
+        return load_hyperpyyaml(self.config_text, overrides)
+
+    def admit(self):
+        return self.admission.slot() if self.admission is not None else nullcontext()
+
+    async def start_session(self, **options) -> Session:
+        """
+        raises AdmissionRejected when the node is at capacity
+        """
+        async with self.admit():
+            session = await self.agent.create(self.load_config(), **options)
+        session.create_task(session.listen())
+        logger.info(f"Started {self.agent.__module__} session with id: {session.session_id}")
+        return session
+
+    def add_routes(self):
+        router = self.router
+
+        @router.post("/start_session")
+        async def start_session(request: Request):
+            body = await request.json()
+            try:
+                session = await self.start_session(**self.agent.session_options(body))
+            except AdmissionRejected as e:
+                return rejected(e)
+            return {"session_id": session.session_id, "codec": session.data.codec_name}
+
+        @router.websocket("/ws/agent/audio/{session_id}")
+        async def ws_user_audio(websocket: WebSocket, session_id: str):
+            await serve_channel(self.agent.sessions, session_id, "data", websocket)
+
+        @router.websocket("/ws/agent/event/{session_id}")
+        async def ws_user_event(websocket: WebSocket, session_id: str):
+            await serve_channel(self.agent.sessions, session_id, "event", websocket)
+
+
+class Runtime:
+    def __init__(
+        self,
+        agents: Dict[str, AgentHost],
+        prefixed: bool = True,
+        max_sessions: int = 0,
+        max_loop_lag_ms: float = 200,
+        max_in_flight: int = 0,
+        max_queue: int = 0,
+        queue_timeout: float = 5.0,
+        profile: bool = False,
+        slow_callback_ms: float = 50,
+    ):
+        """
+        agents: by name, served under /{name} when prefixed
+        max_*, max_queue, queue_timeout: node level admission over the sessions of all agents,
+            see AdmissionController
+        profile: time the event loop callbacks by task and the component calls, and serve /admin/profile and
+            /admin/timings, see luna_agent.profiling
+        slow_callback_ms: callbacks holding the loop longer are logged while profiling
+        """
+        self.agents = agents
+        self.profile = profile
+        if profile:
+            Profiler.enable(slow_callback_ms=slow_callback_ms)
+        self.admission = AdmissionController(
+            lambda: [session.usage for host in agents.values() for session in host.agent.sessions.values()],
+            max_sessions=max_sessions,
+            max_loop_lag_ms=max_loop_lag_ms,
+            max_in_flight=max_in_flight,
+            max_queue=max_queue,
+            queue_timeout=queue_timeout,
+        )
+        self.app = FastAPI()
+        self.app.add_middleware(
+            CORSMiddleware,
+            allow_origins=["*"],  # or ["*"] for all origins
+            allow_credentials=True,
+            allow_methods=["*"],
+            allow_headers=["*"],
+        )
+        self.add_routes()
+        if profile:
+            self.add_admin_routes()
+        for name, host in agents.items():
+            host.admission = self.admission
+            self.app.include_router(host.router, prefix=f"/{name}" if prefixed else "")
+
+    def sessions(self) -> Dict:
+        agents = {name: host.manager.stats() for name, host in self.agents.items()}
+        stats = {key: sum(agent[key] for agent in agents.values()) for key in ("sessions", "session_tasks", "reaped")}
+        return {**stats, "process_tasks": next(iter(agents.values()), {}).get("process_tasks", 0), "agents": agents}
+
+    def add_routes(self):
+        app = self.app
+
+        @app.on_event("startup")
+        async def startup():
+            self.admission.start()
+            Profiler.check_loop()
+            for host in self.agents.values():
+                host.manager.start()
+                await host.agent.startup(host)
+
+        @app.get("/health")
+        async def health(sessions: bool = False):
+            """
+            capacity of the node for the load balancer, 503 while new sessions would be rejected.
+            sessions=true adds the resource usage of every session
+            """
+            capacity = self.admission.capacity()
+            if sessions:
+                capacity["usage"] = {
+                    session_id: session.usage.stats()
+                    for host in self.agents.values()
+                    for session_id, session in host.agent.sessions.items()
+                }
+            return JSONResponse(capacity, status_code=200 if capacity["accepting"] else 503)
+
+        @app.get("/sessions")
+        async def sessions():
+            """
+            live session / task counts, flat under a soak test when nothing leaks
+            """
+            return self.sessions()
+
+        @app.get("/endpoints")
+        async def endpoints():
+            """
+            outstanding requests, latency, ejections and hedges of the model backend replicas
+            """
+            return EndpointGroup.all_stats()
+
+    def add_admin_routes(self):
+        app = self.app
+
+        @app.get("/admin/profile")
+        async def profile(seconds: float = 10, interval_ms: float = 5):
+            """
+            sampled stacks of the event loop over the next `seconds`, folded
+            """
+            seconds = min(max(seconds, 0.1), 60)
+            return PlainTextResponse(await profile_loop(seconds, max(interval_ms, 1)))
+
+        @app.get("/admin/timings")
+        async def timings(reset: bool = False):
+            """
+            loop time by task, slow callbacks and component call times since the start (or the last reset)
+            """
+            stats = Profiler.stats()
+            if reset:
+                Profiler.reset()
+            return stats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, help="Path to the runtime config", default="config/runtime.yaml")
+    parser.add_argument("--port", type=int, default=28001)
+    parser.add_argument("--fast-loop", action="store_true", help="Run the server on uvloop + httptools")
+    parser.add_argument("--profile", action="store_true", help="Profile the agents, serves /admin/profile")
+    args, _ = parser.parse_known_args()
+    setup_logging()
+    with open(args.config, "r") as f:
+        runtime: Runtime = load_hyperpyyaml(f, {"profile": True} if args.profile else None)["runtime"]
+    logger.info(f"Serving agents: {', '.join(runtime.agents)}")
+    uvicorn.run(runtime.app, host="0.0.0.0", port=args.port, **uvicorn_options(args.fast_loop))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+import base64
+import time
+from typing import Dict, List, Optional, Tuple
+
+import msgpack
+
+SNAPSHOT_VERSION = 1
+
+
+class MemorySessionStore:
+    """
+    in process key-value store for session snapshots, entries expire ttl seconds after they are written.
+    the agent only uses put / get / delete, a shared store (redis ...) would provide the same three
+    """
+
+    def __init__(self, ttl: float = 60):
+        self.ttl = ttl
+        self.items: Dict[str, Tuple[float, bytes]] = {}
+        self.next_sweep = 0.0
+
+    async def put(self, key: str, value: bytes, ttl: Optional[float] = None):
+        now = time.monotonic()
+        if now >= self.next_sweep:
+            self.items = {k: v for k, v in self.items.items() if v[0] > now}
+            self.next_sweep = now + self.ttl / 10
+        self.items[key] = (now + (self.ttl if ttl is None else ttl), value)
+
+    async def get(self, key: str) -> Optional[bytes]:
+        item = self.items.get(key)
+        if item is None:
+            return None
+        if item[0] <= time.monotonic():
+            del self.items[key]
+            return None
+        return item[1]
+
+    async def delete(self, key: str):
+        self.items.pop(key, None)
+
+
+def pack_history(history: List[Dict]) -> Tuple[List[Dict], Dict[str, bytes]]:
+    """
+    split history into audio-free entries and wav blobs keyed by the audio id (md5 of the pcm)
+    """
+    entries, blobs = [], {}
+    for message in history:
+        content = message["content"]
+        if isinstance(content, list):
+            items = []
+            for item in content:
+                if item.get("type") == "input_audio":
+                    blobs[item["id"]] = base64.b64decode(item["input_audio"]["data"])
+                    item = {**item, "input_audio": {"format": item["input_audio"]["format"]}}
+                items.append(item)
+            content = items
+        entries.append({**message, "content": content})
+    return entries, blobs
+
+
+def unpack_history(entries: List[Dict], blobs: Dict[str, bytes]) -> List[Dict]:
+    history = []
+    for message in entries:
+        content = message["content"]
+        if isinstance(content, list):
+            items = []
+            for item in content:
+                if item.get("type") == "input_audio":
+                    data = base64.b64encode(blobs[item["id"]]).decode("utf-8")
+                    item = {**item, "input_audio": {**item["input_audio"], "data": data}}
+                items.append(item)
+            content = items
+        history.append({**message, "content": content})
+    return history
+
+
+async def save_snapshot(store: MemorySessionStore, session_id: str, history: List[Dict], **state):
+    """
+    state: small msgpack-able values (sample rates, flags ...) restored alongside the history
+    """
+    entries, blobs = pack_history(history)
+    for audio_id, wav in blobs.items():
+        # keyed by content hash, so audio shared between snapshots is stored once
+        await store.put(f"audio/{audio_id}", wav)
+    snapshot = {
+        "version": SNAPSHOT_VERSION,
+        "session_id": session_id,
+        "created_at": time.time(),
+        "history": entries,
+        "audio": list(blobs),
+        "state": state,
+    }
+    await store.put(f"session/{session_id}", msgpack.packb(snapshot, use_bin_type=True))
+
+
+async def load_snapshot(store: MemorySessionStore, session_id: str) -> Optional[Dict]:
+    """
+    returns None when there is no snapshot, it expired, or any of its audio expired
+    """
+    packed = await store.get(f"session/{session_id}")
+    if packed is None:
+        return None
+    snapshot = msgpack.unpackb(packed, raw=False)
+    if snapshot.get("version") != SNAPSHOT_VERSION:
+        return None
+    blobs = {}
+    for audio_id in snapshot["audio"]:
+        blobs[audio_id] = await store.get(f"audio/{audio_id}")
+        if blobs[audio_id] is None:
+            return None
+    snapshot["history"] = unpack_history(snapshot["history"], blobs)
+    return snapshot
@@ -0,0 +1,234 @@
+"""
+stand-in servers for the model services (vad, asr, diarization, openai compatible llm / slm, tts), with
+deterministic outputs and configurable latencies. used by tests, benchmarks and the session replayer,
+see config/replay.yaml for an agent config pointing at them.
+"""
+
+import asyncio
+import hashlib
+import json
+import re
+from contextlib import asynccontextmanager
+from urllib.parse import parse_qs
+
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
+
+from luna_agent.utils import json_codec
+
+
+class EnergyVAD:
+    """
+    energy based vad with the vad server's protocol: sample indices (16k) of the last speech span
+    start / end and of the current position
+    """
+
+    def __init__(self, threshold_db: float = -40.0, silence_ms: int = 200, frame_ms: int = 20):
+        self.threshold_db = threshold_db
+        self.silence_samples = silence_ms * 16
+        self.frame_samples = frame_ms * 16
+        self.pending = np.zeros(0, dtype=np.float32)
+        self.start = self.end = self.current = 0
+        self.speaking = False
+        self.last_voiced = 0
+
+    def __call__(self, chunk: bytes) -> dict:
+        samples = np.frombuffer(chunk[: len(chunk) // 2 * 2], dtype=np.int16).astype(np.float32) / 32768.0
+        self.pending = np.concatenate([self.pending, samples])
+        while len(self.pending) >= self.frame_samples:
+            frame, self.pending = self.pending[: self.frame_samples], self.pending[self.frame_samples :]
+            rms = np.sqrt(np.mean(frame * frame))
+            position, self.current = self.current, self.current + self.frame_samples
+            if 20 * np.log10(max(rms, 1e-6)) > self.threshold_db:
+                self.last_voiced = self.current
+                if not self.speaking:
+                    self.speaking, self.start = True, position
+            elif self.speaking and self.current - self.last_voiced >= self.silence_samples:
+                self.speaking, self.end = False, self.last_voiced
+        return {"start": self.start, "end": self.end, "current": self.current}
+
+
+def form_params(body: bytes) -> dict:
+    """
+    the json `params` field of a multipart or urlencoded form
+    """
+    match = re.search(rb'name="params"\r\n\r\n(.*?)\r\n--', body, re.S)
+    if match:
+        return json.loads(match.group(1))
+    return json.loads(parse_qs(body.decode("utf-8")).get("params", ["{}"])[0])
+
+
+def completion_chunk(model: str, content: str = None, finish_reason: str = None) -> str:
+    delta = {} if content is None else {"content": content}
+    chunk = {
+        "id": "standin",
+        "object": "chat.completion.chunk",
+        "created": 0,
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+    return f"data: {json_codec.dumps(chunk)}\n\n"
+
+
+def create_app(
+    sample_rate: int = 24000,
+    transcript: str = "今天天气怎么样",
+    reply: str = "今天天气晴朗，气温二十度左右，很适合出去走走。",
+    control: str = "{}",
+    asr_ms: float = 100,
+    asr_final_ms: float = 10,
+    asr_char_ms: float = 150,
+    diar_ms: float = 200,
+    control_ms: float = 100,
+    first_token_ms: float = 300,
+    token_ms: float = 20,
+    tts_first_chunk_ms: float = 150,
+    tts_char_ms: float = 150,
+    vad_threshold_db: float = -40.0,
+    vad_silence_ms: int = 200,
+    speed: float = 1.0,
+) -> FastAPI:
+    """
+    *_ms: latencies of the services, divided by speed
+    asr_final_ms: latency of the streaming asr's final transcript, the utterance is decoded by then
+    asr_char_ms: voiced audio per character of the streaming asr's partial transcripts
+    tts_char_ms: duration of the synthesized audio per character of text
+    """
+    app = FastAPI()
+    app.state.diar_sessions = {}  # session_id -> sent_ids
+    app.state.requests = {"vad": 0, "asr": 0, "asr_stream": 0, "diar": 0, "control": 0, "chat": 0, "tts": 0, "tts_reference": 0}
+
+    async def delay(ms: float):
+        await asyncio.sleep(ms / 1000 / speed)
+
+    @app.websocket("/vad")
+    async def vad(websocket: WebSocket):
+        await websocket.accept()
+        app.state.requests["vad"] += 1
+        energy_vad = EnergyVAD(vad_threshold_db, vad_silence_ms)
+        try:
+            while True:
+                chunk = await websocket.receive_bytes()
+                await websocket.send_text(json_codec.dumps(energy_vad(chunk)))
+        except WebSocketDisconnect:
+            pass
+
+    @app.post("/asr")
+    async def asr(request: Request):
+        await request.body()
+        app.state.requests["asr"] += 1
+        await delay(asr_ms)
+        return {"transcript": transcript}
+
+    @app.websocket("/asr/stream")
+    async def asr_stream(websocket: WebSocket):
+        await websocket.accept()
+        app.state.requests["asr_stream"] += 1
+        threshold = 10 ** (vad_threshold_db / 20)
+        voiced_ms, partial = 0.0, ""
+        try:
+            while True:
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+                if message.get("bytes") is not None:
+                    chunk = message["bytes"]
+                    samples = np.frombuffer(chunk[: len(chunk) // 2 * 2], dtype=np.int16).astype(np.float32) / 32768
+                    if len(samples) and np.sqrt(np.mean(samples * samples)) > threshold:
+                        voiced_ms += len(samples) / 16
+                    text = transcript[: int(voiced_ms // asr_char_ms)]
+                    if text != partial:
+                        partial = text
+                        await websocket.send_text(json_codec.dumps({"type": "partial", "text": text}))
+                    continue
+                request = json_codec.loads(message["text"])
+                await delay(asr_final_ms)
+                text = transcript if voiced_ms > 0 else ""
+                await websocket.send_text(json_codec.dumps({"type": "final", "id": request["id"], "text": text}))
+                voiced_ms, partial = 0.0, ""
+        except WebSocketDisconnect:
+            pass
+
+    @app.post("/diarization/")
+    async def diarization(request: Request):
+        params = form_params(await request.body())
+        app.state.requests["diar"] += 1
+        await delay(diar_ms)
+        sent_ids = app.state.diar_sessions.setdefault(params["session_id"], [])
+        if params["sent_id"] not in sent_ids:
+            sent_ids.append(params["sent_id"])
+        # speakers of all the utterances of the session so far, deterministic per utterance
+        speakers = params.get("max_spk") or 2
+        return {sent_id: str(int(sent_id[:8], 16) % speakers) for sent_id in sent_ids}
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        model = body.get("model", "standin")
+        if not body.get("stream"):
+            app.state.requests["control"] += 1
+            await delay(control_ms)
+            message = {"role": "assistant", "content": control}
+            return {
+                "id": "standin",
+                "object": "chat.completion",
+                "created": 0,
+                "model": model,
+                "choices": [{"index": 0, "message": message, "finish_reason": "stop"}],
+            }
+
+        app.state.requests["chat"] += 1
+
+        async def stream():
+            await delay(first_token_ms)
+            for i in range(0, len(reply), 2):
+                yield completion_chunk(model, reply[i : i + 2])
+                await delay(token_ms)
+            yield completion_chunk(model, finish_reason="stop")
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    @app.post("/cosyvoice/")
+    async def tts(request: Request):
+        params = form_params(await request.body())
+        app.state.requests["tts"] += 1
+        num_samples = int(len(params.get("gen_text", "")) * tts_char_ms * sample_rate / 1000)
+        t = np.arange(num_samples) / sample_rate
+        pcm = (np.sin(2 * np.pi * 220 * t) * 8000).astype(np.int16).tobytes()
+
+        async def stream():
+            await delay(tts_first_chunk_ms)
+            for i in range(0, len(pcm), 4096):
+                yield pcm[i : i + 4096]
+                await asyncio.sleep(0)
+
+        return StreamingResponse(stream(), media_type="application/octet-stream")
+
+    @app.post("/cosyvoice/reference/")
+    async def tts_reference(request: Request):
+        app.state.requests["tts_reference"] += 1
+        return {"ref_id": hashlib.md5(await request.body()).hexdigest()}
+
+    return app
+
+
+@asynccontextmanager
+async def serve(app: FastAPI, port: int):
+    """
+    run app on localhost:port in the current event loop
+    """
+    config = uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", loop="asyncio", lifespan="off")
+    server = uvicorn.Server(config)
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        if task.done():
+            await task
+        await asyncio.sleep(0.01)
+    try:
+        yield server
+    finally:
+        server.should_exit = server.force_exit = True
+        await task
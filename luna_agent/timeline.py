@@ -0,0 +1,86 @@
+import math
+from typing import Awaitable, Callable, Dict, Iterator, List, Optional, Tuple
+
+
+class ResponseTimeline:
+    """
+    maps the tts text segments of one response to their byte range in the output audio stream of `data`,
+    so the text that was actually played can be recovered from `data.bytes_sent` (the playback cursor).
+    byte offsets are positions in data's output stream, see WebRTCData.bytes_written / bytes_sent
+    """
+
+    def __init__(
+        self,
+        data,
+        response_id,
+        on_segment_start: Optional[Callable[[int, str], Awaitable[None]]] = None,
+    ):
+        self.data = data
+        self.response_id = response_id
+        self.on_segment_start = on_segment_start
+        self.start = data.bytes_written
+        self.end: Optional[int] = None
+        self.segments: List[Tuple[str, int]] = []  # (text, start offset)
+        self.num_started = 0
+        self.history_index: Optional[int] = None
+
+    def add_segment(self, text: str):
+        """
+        call right before the segment's audio is written
+        """
+        self.segments.append((text, self.data.bytes_written))
+
+    def finish(self):
+        """
+        call once no more audio of this response will be written
+        """
+        self.end = self.data.bytes_written
+
+    def segment_ranges(self) -> Iterator[Tuple[str, int, int]]:
+        for i, (text, start) in enumerate(self.segments):
+            if i + 1 < len(self.segments):
+                end = self.segments[i + 1][1]
+            else:
+                end = self.data.bytes_written if self.end is None else self.end
+            yield text, start, end
+
+    def spoken_text(self) -> str:
+        played = self.data.bytes_sent
+        spoken = ""
+        for text, start, end in self.segment_ranges():
+            if played <= start:
+                break
+            if played >= end:
+                spoken += text
+            else:
+                spoken += text[: math.ceil(len(text) * (played - start) / (end - start))]
+                break
+        return spoken
+
+    def finished(self) -> bool:
+        return self.end is not None and self.data.bytes_sent >= self.end
+
+    def position(self) -> Dict:
+        played = self.data.bytes_sent
+        segment = -1
+        for i, (_, start, _) in enumerate(self.segment_ranges()):
+            if played > start:
+                segment = i
+        return {
+            "response_id": self.response_id,
+            "played_ms": self.data.bytes2ms(max(0, min(played, self.data.bytes_written) - self.start)),
+            "segment": segment,
+            "spoken_text": self.spoken_text(),
+            "finished": self.finished(),
+        }
+
+    async def advance(self):
+        """
+        called by data after sending audio, fires on_segment_start for segments that started playing
+        """
+        played = self.data.bytes_sent
+        while self.num_started < len(self.segments) and self.segments[self.num_started][1] < played:
+            index = self.num_started
+            self.num_started += 1
+            if self.on_segment_start is not None:
+                await self.on_segment_start(index, self.segments[index][0])
@@ -1,14 +1,81 @@
 import asyncio
 import base64
+import inspect
 import io
-import logging
+import json
+import os
+import weakref
 from collections import deque
+from typing import AsyncGenerator, AsyncIterator, List, Optional
 
 import numpy as np
 import soundfile as sf
 import soxr
 
-logger = logging.getLogger("luna_agent")
+from luna_agent.log import in_session, logger
+
+
+class JSONCodec:
+    """
+    json dumps / loads with a pluggable backend.
+    "auto" prefers orjson, then msgspec, and falls back to stdlib json,
+    the backend can be forced with the LUNA_JSON_BACKEND environment variable.
+    dumps always returns str so the result can go straight into send_text,
+    decode failures of any backend can be caught with `json_codec.DecodeError`.
+    """
+
+    BACKENDS = ("orjson", "msgspec", "json")
+
+    def __init__(self, backend: str = None):
+        self.use(backend or os.getenv("LUNA_JSON_BACKEND", "auto"))
+
+    def use(self, backend: str = "auto"):
+        if backend != "auto" and backend not in self.BACKENDS:
+            raise ValueError(f"Unknown json backend: {backend}, expected one of {self.BACKENDS}")
+        for name in self.BACKENDS if backend == "auto" else (backend,):
+            try:
+                self.dumps, self.loads, self.DecodeError = getattr(self, f"_{name}")()
+            except ImportError:
+                if backend != "auto":
+                    raise
+                continue
+            self.backend = name
+            return self
+
+    @staticmethod
+    def _orjson():
+        import orjson
+
+        return (lambda obj: orjson.dumps(obj).decode("utf-8")), orjson.loads, orjson.JSONDecodeError
+
+    @staticmethod
+    def _msgspec():
+        import msgspec
+
+        encoder, decoder = msgspec.json.Encoder(), msgspec.json.Decoder()
+        return (lambda obj: encoder.encode(obj).decode("utf-8")), decoder.decode, msgspec.DecodeError
+
+    @staticmethod
+    def _json():
+        return json.dumps, json.loads, json.JSONDecodeError
+
+
+json_codec = JSONCodec()
+
+
+def uvicorn_options(fast_loop: bool = False) -> dict:
+    """
+    event loop / http parser options for uvicorn.run. by default uvicorn's "auto" picks uvloop and httptools
+    when they are installed, fast_loop requires them and fails loudly if they are missing
+    """
+    if not fast_loop:
+        return {}
+    for module in ("uvloop", "httptools"):
+        try:
+            __import__(module)
+        except ImportError as e:
+            raise RuntimeError(f"--fast-loop requires {module}, install with `pip install luna_agent[fast]`") from e
+    return {"loop": "uvloop", "http": "httptools"}
 
 
 def pcm2base64(audio: bytes, sample_rate: int = 16000):
@@ -37,18 +104,29 @@ def safe_create_task(coro, *, name=None):
             if exc is not None:
                 logger.exception("Unhandled exception in background task", exc_info=exc)
         except asyncio.CancelledError:
-            logger.info("Background task was cancelled")
+            logger.debug("Background task %s was cancelled", task.get_name())
 
     task.add_done_callback(_handle_result)
     return task
 
 
 class AsyncTaskMixin:
+    # task -> SessionUsage of the session that created it, kept while the profiler charges loop time to sessions
+    task_usage: Optional["weakref.WeakKeyDictionary"] = None
+
     def __init__(self):
         self.tasks = {}
+        self.usage = None  # luna_agent.admission.SessionUsage
 
     def create_task(self, coro, *, name=None):
+        # named after the coroutine before it is wrapped, the profiler charges loop time by task name
+        name = name or getattr(coro, "__qualname__", None)
+        session_id = getattr(self, "session_id", None)
+        if session_id is not None:
+            coro = in_session(coro, session_id)
         task = safe_create_task(coro, name=name)
+        if self.usage is not None and AsyncTaskMixin.task_usage is not None:
+            AsyncTaskMixin.task_usage[task] = self.usage
         self.tasks[id(task)] = task
         task.add_done_callback(lambda t: self.tasks.pop(id(t), None))
         return task
@@ -60,6 +138,93 @@ class AsyncTaskMixin:
         self.tasks.clear()
 
 
+class TokenStream:
+    """
+    fans one text stream (the slm's reply) out to any number of readers without a queue per reader: the tokens
+    go into one shared list and every reader iterates it from its own cursor. the reader at the end reads the
+    next token from the source in its own task, readers arriving meanwhile wait for that read. text() is the
+    text so far
+    """
+
+    def __init__(self, source: AsyncIterator[str]):
+        self.source = source
+        self.chunks: List[str] = []
+        self.done = False
+        self.closed = False
+        self.close_after_read = False
+        self.error: Optional[Exception] = None
+        self.reading = False
+        self.read_done: Optional[asyncio.Future] = None  # only created when a second reader waits
+        self.joined = ""
+        self.num_joined = 0
+
+    async def pull(self):
+        if self.reading:
+            if self.read_done is None:
+                self.read_done = asyncio.get_running_loop().create_future()
+            await asyncio.shield(self.read_done)
+            return
+        self.reading = True
+        try:
+            self.chunks.append(await self.source.__anext__())
+        except StopAsyncIteration:
+            self.done = True
+        except Exception as e:
+            self.done = True
+            if not self.closed:  # closing the source fails the read in flight
+                self.error = e
+        except BaseException:
+            # the reader was cancelled in the middle of the read, the source cannot go on
+            self.done = True
+            raise
+        finally:
+            self.reading = False
+            if self.read_done is not None:
+                self.read_done.set_result(None)
+                self.read_done = None
+            if self.close_after_read:
+                self.close_after_read = False
+                await self.source.aclose()
+
+    async def reader(self, cursor: int = 0) -> AsyncGenerator[str, None]:
+        """
+        the tokens from the cursor-th on, a reader created late still gets the whole text
+        """
+        while True:
+            if cursor < len(self.chunks):
+                cursor += 1
+                yield self.chunks[cursor - 1]
+            elif self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            else:
+                await self.pull()
+
+    def text(self) -> str:
+        """
+        everything read from the source so far, joined once per call for the tokens added since the last one
+        """
+        if self.num_joined < len(self.chunks):
+            self.joined += "".join(self.chunks[self.num_joined :])
+            self.num_joined = len(self.chunks)
+        return self.joined
+
+    async def aclose(self):
+        """
+        ends every reader and closes the source, which aborts its request
+        """
+        self.done = True
+        if self.closed:
+            return
+        self.closed = True
+        if self.reading and inspect.isasyncgen(self.source):
+            # a generator cannot be closed while it runs, the reader closes it once its read returns
+            self.close_after_read = True
+            return
+        await self.source.aclose()
+
+
 def format_msg(content):
     fmt = ""
     for c in content:
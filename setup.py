@@ -11,6 +11,12 @@ setup(
     description="Luna Agent Service",
     packages=find_packages(),
     install_requires=requirements,
+    extras_require={
+        # faster json codec and event loop, picked up automatically when installed
+        "fast": ["orjson", "uvloop", "httptools"],
+        # opus audio between client and agent, also needs libopus (apt install libopus0)
+        "opus": ["opuslib"],
+    },
     python_requires=">=3.9",  # adjust as needed
 )
 
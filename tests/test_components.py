@@ -1,9 +1,33 @@
 import asyncio
+import time
+import pytest
 from luna_agent.utils import StreamingResampler
-from asyncstdlib.itertools import tee
 import soundfile as sf
 import numpy as np
-from luna_agent.utils import pcm2wav, safe_create_task
+from luna_agent.utils import AsyncTaskMixin, TokenStream, pcm2wav, safe_create_task
+from luna_agent.history import History
+from luna_agent.session import MemorySessionStore, load_snapshot, save_snapshot
+from luna_agent.components.slm import SLM, add_agent_message, add_user_message
+from luna_agent.components.diar import Diar
+from luna_agent.components.llm import LLM
+from luna_agent.components.preprocess import AudioPreprocessor
+from luna_agent.components.codec import create_codec
+from luna_agent.log import ContextQueueHandler, JSONFormatter, Sampled, lazy, log_context
+from luna_agent.profiling import Profiler, profile_loop
+from luna_agent.components import WebRTCDataLiveStream
+from luna_agent.timeline import ResponseTimeline
+from luna_agent.components.tts import TTS, ChunkingPolicy
+from luna_agent.components.tts_cache import TTSCache
+from luna_agent.components.filler import crossfade
+from luna_agent.components.endpointing import AdaptiveEndpointer, Endpointer
+from luna_agent.admission import AdmissionController, AdmissionRejected, SessionUsage
+from luna_agent.lifecycle import Session, SessionManager
+from luna_agent.components.asr import ASR, StreamingASR
+from luna_agent.standin import create_app, serve
+from luna_agent.endpoints import EndpointGroup
+from luna_agent.pipeline import Channel, Consumer, Pipeline, Stage, StreamStage, VADResult
+from luna_agent.capture import AUDIO_OUT, EVENT, CaptureWriter, capture_turns, read_capture
+from starlette.websockets import WebSocketState
 
 from hyperpyyaml import load_hyperpyyaml
 
@@ -109,16 +133,15 @@ def test_slm():
         slm = config["slm"]
         await slm.setup(session_id="debug")
         history = []
-        text_generator = await safe_create_task(slm(history, audio))
-        t1, t2 = tee(text_generator, 2)  # Ensure the iterator can be reused
+        text_generator = TokenStream(await safe_create_task(slm(history, audio)))
         i = 0
-        async for chunk in t1:
+        async for chunk in text_generator.reader():
             i += 1
             if i >= 3:
                 await text_generator.aclose()
                 break
             print(chunk, end="")
-        response = "".join([chunk async for chunk in t2])
+        response = "".join([chunk async for chunk in text_generator.reader()])
         print(response)
 
     asyncio.run(fun())
@@ -158,3 +181,702 @@ def test_resample():
     resampled = resampler(audio)
     with open("./tests/resampled.wav", "wb") as f:
         f.write(pcm2wav(resampled, 24000))
+
+
+def test_session_snapshot():
+    async def fun():
+        store = MemorySessionStore(ttl=60)
+        history = []
+        add_user_message(history, audio=audio[:32000], transcript="hello")
+        add_agent_message(history, "hi")
+        await save_snapshot(store, "debug", history, user_audio_sample_rate=16000)
+        snapshot = await load_snapshot(store, "debug")
+        assert snapshot["history"] == history
+        assert snapshot["state"]["user_audio_sample_rate"] == 16000
+
+        await store.put(f"audio/{history[0]['content'][0]['id']}", b"", ttl=0)
+        assert await load_snapshot(store, "debug") is None
+
+    asyncio.run(fun())
+
+
+def test_history():
+    async def fun():
+        history = History(spill_bytes=40000)
+        history.append_user(audio=audio[:32000], transcript="hello")
+        history.append_agent("hi there")
+        view = history.view()
+        history.append_user(audio=audio[32000:64000], transcript="again")
+        history.set_text(1, "hi")
+        assert len(view) == 2 and view[-1].text == "hi there"
+        assert [turn.text for turn in history[1:2]] == ["hi"]
+        # the first utterance went to the spill file
+        assert history.arena.stats() == {"resident_bytes": 32000, "spilled_bytes": 32000}
+        assert history[0].audio.read() == audio[:32000]
+
+        expected = []
+        add_user_message(expected, audio=audio[:32000], transcript="hello")
+        add_agent_message(expected, "hi")
+        add_user_message(expected, audio=audio[32000:64000], transcript="again")
+        assert history.messages() == expected
+        assert "input_audio" not in history[0].message(audio=False)["content"][0]
+
+        store = MemorySessionStore(ttl=60)
+        await save_snapshot(store, "debug", history.messages())
+        restored = History()
+        restored.load((await load_snapshot(store, "debug"))["history"])
+        assert restored.messages() == expected
+        history.close()
+        restored.close()
+
+    asyncio.run(fun())
+
+
+def test_response_timeline():
+    async def fun():
+        data = WebRTCDataLiveStream()
+        await data.setup()
+        started = []
+
+        async def on_segment_start(index, text):
+            started.append(text)
+
+        timeline = data.timeline = ResponseTimeline(data, response_id=0, on_segment_start=on_segment_start)
+        for text in ["今天天气真不错，", "适合出去玩。"]:
+            timeline.add_segment(text)
+            await data.write(b"\x00" * 3200)
+        timeline.finish()
+
+        data.bytes_sent += 3200 + 1600
+        await timeline.advance()
+        assert started == ["今天天气真不错，", "适合出去玩。"]
+        assert timeline.spoken_text() == "今天天气真不错，适合出"
+        assert timeline.position()["played_ms"] == 150
+        assert not timeline.finished()
+
+    asyncio.run(fun())
+
+
+def test_tts_cache(tmp_path):
+    async def fun():
+        cache = TTSCache(name="test", max_memory_bytes=len(audio), cache_dir=str(tmp_path))
+        key = cache.key(" 好的， ", "default", "default", "default", 16000)
+        assert key == cache.key("好的,", "default", "default", "default", 16000)
+        assert cache.get(key) is None
+        await cache.put(key, audio)
+        assert b"".join([chunk async for chunk in cache.stream(cache.get(key), 4096)]) == audio
+
+        # evicted from memory, still on disk
+        await cache.put(cache.key("你好", "default", "default", "default", 16000), audio)
+        assert b"".join([chunk async for chunk in cache.stream(cache.get(key), 4096)]) == audio
+        stats = cache.stats()
+        assert (stats["hits"], stats["disk_hits"], stats["misses"]) == (1, 1, 1)
+        assert stats["bytes_served"] == 2 * len(audio)
+
+    asyncio.run(fun())
+
+
+def test_filler_crossfade():
+    class Socket:
+        client_state = WebSocketState.CONNECTED
+
+        def __init__(self):
+            self.sent = []
+
+        async def send_bytes(self, data):
+            self.sent.append(data)
+
+    tail, head = np.full(100, 1000, dtype=np.int16), np.zeros(100, dtype=np.int16)
+    mixed = np.frombuffer(crossfade(tail.tobytes(), head.tobytes()), dtype=np.int16)
+    assert mixed[0] == 1000 and mixed[-1] == 0 and (np.diff(mixed) <= 0).all()
+
+    async def fun():
+        data = WebRTCDataLiveStream(binary_audio=True)
+        await data.setup()
+        data.ws = Socket()
+        filler = np.full(data.chunk_bytes, 1000, dtype=np.int16).tobytes() * 2
+        await data.write_filler(filler, crossfade_ms=10)
+
+        await data.send_filler(data.buffer.pop(data.chunk_bytes))
+        assert data.ws.sent[-1] == filler[: data.chunk_bytes]
+        await data.write(np.zeros(data.chunk_bytes // 2, dtype=np.int16).tobytes())
+        await data.send_filler(data.buffer.pop(data.chunk_bytes))
+        mixed = np.frombuffer(data.ws.sent[-1], dtype=np.int16)
+        assert mixed[0] == 1000 and mixed[data.ms2bytes(10) // 2 - 1] == 0 and not mixed[data.ms2bytes(10) // 2 :].any()
+        assert len(data.filler) == 0
+        # filler audio is not part of the output stream
+        assert data.bytes_sent == data.bytes_written == data.chunk_bytes
+
+        # dropped when no reply follows
+        data.buffer.clear()
+        await data.write_filler(filler)
+        data.stop_filler()
+        assert len(data.filler) == 0
+
+    asyncio.run(fun())
+
+
+def test_endpointing():
+    def run(endpointer, spans, length):
+        # vad server messages every 100ms for speech spans given in ms
+        events = []
+        start = end = 0
+        for current in range(1600, length * 16 + 1, 1600):
+            for span_start, span_end in spans:
+                if span_start * 16 < current:
+                    start = span_start * 16
+                if span_end * 16 < current:
+                    end = span_end * 16
+            events += [(current, event) for event in endpointer.step(start, end, current)]
+        return events
+
+    # the user pauses 300ms mid-turn
+    spans = [(1000, 2000), (2300, 3000), (5000, 6000), (6300, 7000)]
+    events = run(Endpointer(voiced_ms_to_interrupt=500), spans, 9000)
+    turns = [turn for _, (_, turn) in events if turn]
+    assert turns == [(16000, 32000), (36800, 48000), (80000, 96000), (100800, 112000)]
+
+    endpointer = AdaptiveEndpointer(hold_ms=400, quantile=1.0, min_observations=1)
+    events = run(endpointer, spans, 9000)
+    assert [turn for _, (_, turn) in events if turn] == [(16000, 48000), (80000, 112000)]
+    assert endpointer.false_cuts == 0 and endpointer.stats()["hold_ms"] == 400
+
+    # from no hold: the first turns are cut at the pause, the hold then grows past it
+    endpointer = AdaptiveEndpointer(quantile=1.0, min_observations=1)
+    events = run(endpointer, spans, 9000)
+    assert [turn for _, (_, turn) in events if turn][:2] == [(16000, 32000), (36800, 48000)]
+    assert endpointer.false_cuts == 1 and endpointer.stats()["hold_ms"] == 400
+
+
+def test_capture(tmp_path):
+    path = str(tmp_path / "session.capture")
+    capture = CaptureWriter(path)
+    capture.header(session_id="debug", write_sample_rate=16000)
+    for status in ["thinking", "speaking"]:
+        capture.record(EVENT, {"event": "agent_status_changed", "data": {"status": status}}, t=100)
+    capture.record(AUDIO_OUT, audio[:3200], t=350)
+    capture.record(AUDIO_OUT, audio[3200:6400], t=400)
+    capture.close()
+
+    records = list(read_capture(path))
+    assert len(records) == 5 and records[3] == (350, AUDIO_OUT, audio[:3200])
+    turns = capture_turns(records)
+    assert turns == [{"start": 100, "first_audio_ms": 250, "audio_ms": 200.0, "events": ["agent_status_changed"]}]
+
+
+def test_admission():
+    async def fun():
+        async def busy():
+            time.sleep(0.01)
+            await asyncio.sleep(0)
+            return 1
+
+        # the loop time of a session's tasks is charged to it while profiling, not measured otherwise
+        session = AsyncTaskMixin()
+        session.usage = SessionUsage(slow_step_ms=5)
+        assert await session.create_task(busy()) == 1
+        assert session.usage.busy_s == 0
+        Profiler.enable()
+        try:
+            assert await session.create_task(busy()) == 1
+        finally:
+            Profiler.disable()
+        assert session.usage.slow_steps == 1 and session.usage.busy_s >= 0.01
+
+        usages = []
+        admission = AdmissionController(lambda: usages, max_sessions=1, max_queue=1, queue_timeout=0.2)
+
+        async def start_session():
+            async with admission.slot():
+                usages.append(SessionUsage())
+
+        await start_session()
+        with pytest.raises(AdmissionRejected):
+            # queued, no session ends within the timeout
+            await start_session()
+        queued = asyncio.create_task(start_session())
+        await asyncio.sleep(0.1)
+        usages.pop()
+        await queued
+        assert len(usages) == 1 and admission.capacity()["rejected"] == 1
+
+    asyncio.run(fun())
+
+
+def test_lifecycle():
+    async def fun():
+        class Agent(Session):
+            sessions = {}
+
+            def __init__(self, session_id):
+                super().__init__()
+                self.session_id = session_id
+                self.data = WebRTCDataLiveStream()
+                self.closed = 0
+                self.sessions[session_id] = self
+
+            async def listen(self):
+                async def receive():
+                    await asyncio.sleep(0.05)
+                    # the client went away, torn down from one of the session's own tasks
+                    await self.destroy()
+
+                await asyncio.gather(self.create_task(receive()), self.create_task(asyncio.sleep(10)))
+
+            async def close(self):
+                self.closed += 1
+                await self.data.close()
+
+        manager = SessionManager(Agent.sessions, idle_timeout=0.1)
+        baseline = manager.stats()["process_tasks"]
+        disconnected, idle = Agent("disconnected"), Agent("idle")
+        disconnected.create_task(disconnected.listen())
+        idle.create_task(asyncio.sleep(10))
+        await asyncio.sleep(0)
+        assert manager.stats()["session_tasks"] == 4
+
+        await asyncio.sleep(0.1)
+        assert list(Agent.sessions) == ["idle"] and disconnected.closed == 1 and not disconnected.tasks
+        idle.data.last_active = time.monotonic()
+        await manager.reap()
+        assert manager.reaped == 0
+        await asyncio.sleep(0.15)
+        await manager.reap()
+        await idle.destroy()
+        await asyncio.sleep(0)
+        assert manager.reaped == 1 and idle.closed == 1 and idle.data.closed.is_set()
+        assert manager.stats()["sessions"] == 0 and manager.stats()["process_tasks"] == baseline
+
+    asyncio.run(fun())
+
+
+def test_pipeline():
+    async def fun():
+        class Frames(Stage):
+            outputs = {"audio": bytes}
+
+            async def run(self, audio):
+                for i in range(3):
+                    await audio.put(bytes([i]) * 320)
+
+        class Component:
+            def __init__(self):
+                self.frames = asyncio.Queue()
+
+            async def __call__(self, chunk):
+                await self.frames.put(chunk)
+
+            async def results(self):
+                for _ in range(3):
+                    chunk = await self.frames.get()
+                    yield chunk[0] == 2, chunk
+
+        results = []
+
+        async def handle(result):
+            results.append(result)
+
+        audio = Channel("audio", bytes)
+        pipeline = Pipeline(
+            Frames(),
+            StreamStage(Component(), "vad", VADResult),
+            Consumer("vad", VADResult, handle),
+            channels={"audio": audio},
+        )
+        await pipeline.run()
+        assert [flag for flag, _ in results] == [False, False, True] and audio.buffered_bytes == 0
+
+        with pytest.raises(TypeError):
+            Pipeline(Frames(), Consumer("audio", str, handle))
+        with pytest.raises(ValueError):
+            Pipeline(Consumer("vad", VADResult, handle))
+
+    asyncio.run(fun())
+
+
+def test_streaming_asr():
+    async def fun():
+        async with serve(create_app(asr_ms=300, asr_final_ms=10), 29139):
+            batch = ASR("http://127.0.0.1:29139/asr")
+            asr = StreamingASR("ws://127.0.0.1:29139/asr/stream", fallback=batch, final_timeout_ms=200)
+            await asr.setup()
+            transcripts = []
+
+            async def receive():
+                async for transcript in asr.results():
+                    transcripts.append(transcript)
+
+            receiving = asyncio.create_task(receive())
+            for i in range(0, len(audio), 3200):
+                await asr(audio[i : i + 3200])
+            start = time.perf_counter()
+            assert await asr.final(audio) == "今天天气怎么样"
+            assert time.perf_counter() - start < 0.2
+            assert transcripts[-1].final and any(not transcript.final for transcript in transcripts)
+            await asr.close()
+            await receiving
+
+            # unreachable server: batch asr
+            asr = StreamingASR("ws://127.0.0.1:1/asr/stream", fallback=batch)
+            await asr.setup()
+            assert asr.ws is None and await asr.final(audio) == "今天天气怎么样"
+
+    asyncio.run(fun())
+
+
+def test_endpoints():
+    async def fun():
+        async with serve(create_app(asr_ms=400), 29140), serve(create_app(asr_ms=20), 29141):
+            slow, fast, dead = "http://127.0.0.1:29140/asr", "http://127.0.0.1:29141/asr", "http://127.0.0.1:1/asr"
+
+            # least outstanding requests
+            group = EndpointGroup("test_balance", [slow, fast])
+            await asyncio.gather(*[ASR(endpoints=group)(audio) for _ in range(4)])
+            assert [endpoint.requests for endpoint in group.endpoints] == [2, 2]
+
+            # hedged after the p95 latency of the group, the first answer wins
+            group = EndpointGroup("test_hedge", [slow, fast], hedge=True, min_samples=5)
+            group.pool.latencies.extend([0.05] * 5)
+            start = time.perf_counter()
+            assert await ASR(endpoints=group)(audio) == "今天天气怎么样"
+            assert time.perf_counter() - start < 0.3 and group.pool.hedge_wins == 1
+            await asyncio.sleep(0.1)  # the cancelled duplicate winds down
+            assert group.endpoints[0].outstanding == 0
+
+            # retried on another replica, ejected after max_failures
+            group = EndpointGroup("test_eject", [dead, fast], max_failures=1)
+            assert await ASR(endpoints=group)(audio) == "今天天气怎么样"
+            assert group.endpoints[0].ejected(time.monotonic()) and group.pick().url == fast
+            assert EndpointGroup.all_stats()["test_eject"]["endpoints"][dead]["ejections"] == 1
+
+    asyncio.run(fun())
+
+
+def test_incremental_diar():
+    async def fun():
+        async with serve(create_app(diar_ms=300, first_token_ms=10), 29142):
+            diar = Diar(base_url="http://127.0.0.1:29142/diarization/", incremental=True)
+            slm = SLM(base_url="http://127.0.0.1:29142/v1", model="standin", diar=diar)
+            await slm.setup(session_id="test_incremental_diar")
+            history = add_user_message([], audio=audio)
+            await (await SLM(base_url="http://127.0.0.1:29142/v1", model="standin")([], audio)).aclose()  # warm up
+
+            # the turn does not wait for the diarization, it runs in the background
+            start = time.perf_counter()
+            stream = await slm(history, audio)
+            assert time.perf_counter() - start < 0.2
+            await stream.aclose()
+            assert diar.labels == {}
+            await asyncio.sleep(0.5)
+            sent_id = history[0]["content"][0]["id"]
+            assert sent_id in diar.labels
+
+            # each utterance is uploaded once
+            await slm(history, audio)
+            assert diar.uploads.empty() and len(diar.added) == 1
+            await slm.close()
+            assert diar.worker is None
+
+    asyncio.run(fun())
+
+
+def test_lazy_diar():
+    async def fun():
+        app = create_app(diar_ms=50, first_token_ms=10)
+        async with serve(app, 29143):
+            diar = Diar(base_url="http://127.0.0.1:29143/diarization/", lazy=True)
+            slm = SLM(base_url="http://127.0.0.1:29143/v1", model="standin", diar=diar)
+            await slm.setup(session_id="test_lazy_diar")
+            first, second = audio[: len(audio) // 2], audio[len(audio) // 2 :]
+
+            # buffered, no diarization until it is asked for
+            await (await slm([], first)).aclose()
+            await (await slm(add_user_message([], audio=first), second)).aclose()
+            assert app.state.requests["diar"] == 0 and len(diar.pending) == 2
+
+            # the pending utterances in one batch, memoized after
+            await (await slm(add_user_message([], audio=first), second, diarize=True)).aclose()
+            assert app.state.requests["diar"] == 2 and not diar.pending and len(diar.labels) == 2
+            await (await slm(add_user_message([], audio=first), second, diarize=True)).aclose()
+            assert app.state.requests["diar"] == 2
+
+    asyncio.run(fun())
+
+
+def test_agent_options():
+    from luna_agent.agents import chat, echo
+    from luna_agent.runtime import AgentHost
+
+    # importing an agent (as config/runtime.yaml does) builds no app of its own
+    assert not hasattr(chat, "app") and not hasattr(chat, "runtime")
+    AgentHost(chat.LunaAgent, "config/chat.yaml", options={"resume_grace": 5})
+    assert chat.LunaAgent.store.ttl == 5
+    with pytest.raises(TypeError):
+        AgentHost(echo.LunaAgent, "config/echo.yaml", options={"resume_grace": 5})
+    chat.LunaAgent.configure()
+
+
+def test_diar_endpoint():
+    async def fun():
+        first, second = create_app(diar_ms=20), create_app(diar_ms=20)
+        async with serve(first, 29147), serve(second, 29148):
+            urls = ["http://127.0.0.1:29147/diarization/", "http://127.0.0.1:29148/diarization/"]
+            group = EndpointGroup("test_diar", urls, max_failures=1)
+            a, b = Diar(endpoints=group), Diar(endpoints=group)
+            await a.setup(session_id="test_diar_a")
+            await b.setup(session_id="test_diar_b")
+
+            # each session stays on its replica, whatever the load of the others
+            for chunk in [audio[:16000], audio[16000:32000], audio[32000:48000]]:
+                await asyncio.gather(a(chunk), b(chunk))
+            assert a.endpoint is b.endpoint is group.endpoints[0]
+            assert first.state.requests["diar"] == 6 and second.state.requests["diar"] == 0
+
+            # moved only once its replica is ejected
+            group.endpoints[0].ejected_until = time.monotonic() + 10
+            await a(audio[48000:64000])
+            assert a.endpoint is group.endpoints[1] and second.state.requests["diar"] == 1
+
+        with pytest.raises(ValueError):
+            Diar()
+        with pytest.raises(ValueError):
+            Diar(endpoints=EndpointGroup("test_diar_hedge", urls, hedge=True))
+
+    asyncio.run(fun())
+
+
+def test_preprocess():
+    preprocess = AudioPreprocessor(target_dbfs=-26, gate_after_ms=200)
+    rng = np.random.default_rng(0)
+    # 2s of quiet speech-like noise (-40 dBFS) on a dc offset, in 20ms chunks
+    quiet = np.clip(rng.normal(0, 32768 * 0.01, 32000) + 500, -32768, 32767).astype(np.int16)
+    out = np.frombuffer(b"".join(preprocess(chunk.tobytes()) for chunk in np.split(quiet, 100)), dtype=np.int16)
+    tail = out[-8000:].astype(np.float32)
+    assert abs(tail.mean()) < 50
+    assert -30 < 20 * np.log10(tail.std() / 32768) < -22
+
+    # digital silence passes for gate_after_ms, then is gated until the user speaks again
+    silence = np.zeros(320, dtype=np.int16).tobytes()
+    assert [len(preprocess(silence)) for _ in range(12)] == [640] * 10 + [0] * 2
+    assert len(preprocess(quiet[:320].tobytes())) == 640
+    assert preprocess.stats()["gated"] > 0
+
+
+def test_codec():
+    # raw pcm unless opus was asked for and can be used
+    assert create_codec("pcm", 16000, 1, 24000, 1) is None
+    assert create_codec("flac", 16000, 1, 24000, 1) is None
+    assert create_codec("opus", 44100, 1, 24000, 1) is None
+    pytest.importorskip("opuslib")
+
+    async def fun():
+        codec = create_codec("opus", 16000, 1, 16000, 1)
+        assert codec is not None
+        # 101ms: five 20ms packets, the last millisecond waits for more audio
+        packets = await codec.encode(audio[: 16 * 101 * 2])
+        assert len(packets) == 5 and len(codec.pending) == 32
+        assert len(await codec.decode(packets[0])) == 20 * 16 * 2
+        # end of the reply: the millisecond padded to one 2.5ms packet
+        packets = await codec.flush()
+        assert len(packets) == 1 and codec.pending == b""
+        assert len(await codec.decode(packets[0])) == 40 * 2
+        assert await codec.flush() == []
+        # barge-in: the tail of the cut reply is dropped
+        await codec.encode(audio[: 16 * 21 * 2])
+        codec.reset()
+        assert codec.pending == b"" and await codec.flush() == []
+
+    asyncio.run(fun())
+
+
+def test_logging():
+    import json
+    import logging
+    import queue
+
+    records = queue.SimpleQueue()
+    logger = logging.getLogger("luna_agent.test_logging")
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    logger.addHandler(ContextQueueHandler(records))
+
+    # lazy arguments are only formatted for records that are emitted
+    formatted = []
+    logger.debug("%s", lazy(formatted.append, "debug"))
+    with log_context(session_id="abc", turn_id=1):
+        logger.info("turn %s", lazy(lambda: "started"))
+    record = records.get_nowait()
+    assert formatted == [] and record.session_id == "abc" and record.turn_id == 1
+    entry = json.loads(JSONFormatter().format(record))
+    assert entry["message"] == "turn started" and entry["session_id"] == "abc" and entry["turn_id"] == 1
+
+    # one record per `every` calls
+    sampled = Sampled(logger, every=3)
+    for i in range(7):
+        sampled.info("chunk %d", i)
+    messages = []
+    while not records.empty():
+        messages.append(records.get_nowait().getMessage())
+    assert messages == ["chunk 0 (1 of every 3)", "chunk 3 (1 of every 3)", "chunk 6 (1 of every 3)"]
+
+
+def test_profiling():
+    async def fun():
+        def blocking():
+            time.sleep(0.06)
+
+        async def busy():
+            blocking()
+            await asyncio.sleep(0)
+
+        original_run = asyncio.events.Handle._run
+        Profiler.reset()
+        Profiler.enable(slow_callback_ms=50)
+        try:
+            async with serve(create_app(asr_ms=20), 29144):
+                await AsyncTaskMixin().create_task(busy())
+                assert await ASR("http://127.0.0.1:29144/asr")(audio)
+                # the loop's stack is sampled while it is blocked
+                profile = asyncio.create_task(profile_loop(0.3, interval_ms=2))
+                await asyncio.sleep(0.05)
+                blocking()
+                folded = await profile
+        finally:
+            Profiler.disable()
+
+        stats = Profiler.stats()
+        assert stats["slow_callbacks"] >= 1
+        assert stats["tasks"]["test_profiling.<locals>.fun.<locals>.busy"]["max_ms"] >= 50
+        assert stats["components"]["ASR.__call__"]["count"] == 1
+        assert any("blocking (test_components.py" in line for line in folded.splitlines())
+        assert asyncio.events.Handle._run is original_run and "__wrapped__" not in vars(ASR.__call__)
+
+    asyncio.run(fun())
+
+
+def test_control_dispatcher():
+    async def fun():
+        app = create_app(control='{"speed": "fast", "diarization": true}', control_ms=100)
+        async with serve(app, 29145):
+            prompts = [{"role": "system", "content": "test_control_dispatcher"}]
+            # the control llms of two sessions
+            first, second = [
+                LLM(base_url="http://127.0.0.1:29145/v1", model="standin", prompts=prompts, is_control=True, reuse_s=5)
+                for _ in range(2)
+            ]
+            assert first.dispatcher is second.dispatcher
+            assert first.clients["http://127.0.0.1:29145/v1"] is second.clients["http://127.0.0.1:29145/v1"]
+            await first("你好") and await second("你好呀")  # warm up
+
+            # the same question in flight is asked once, a distinct one goes out concurrently
+            start = time.perf_counter()
+            answers = await asyncio.gather(first("好的"), second("好的"), second("总结一下"))
+            assert time.perf_counter() - start < 0.18 and app.state.requests["control"] == 4
+            assert answers[0] == answers[1] and answers[0] is not answers[1]
+            assert answers[0]["speed"] == "fast" and answers[0]["diarization"] is True
+
+            # reused within reuse_s
+            assert await first("总结一下") == answers[2] and app.state.requests["control"] == 4
+
+            # a session giving up does not cancel the request of the other
+            asking = asyncio.create_task(first("继续"))
+            await asyncio.sleep(0.02)
+            waiting = asyncio.create_task(second("继续"))
+            await asyncio.sleep(0.02)
+            asking.cancel()
+            assert (await waiting)["speed"] == "fast" and app.state.requests["control"] == 5
+
+    asyncio.run(fun())
+
+
+def test_tts_reference():
+    async def fun():
+        app = create_app(tts_first_chunk_ms=10)
+        async with serve(app, 29149):
+            tts = TTS(base_url="http://127.0.0.1:29149/cosyvoice/", reference_url="reference/")
+            await tts.setup(session_id="test_tts_reference")
+            control = {"speech": audio[:32000], "transcript": "hello"}
+
+            # other voices upload the speech inline and never register it
+            [_ async for _ in tts.tts("今天天气真不错", control={**control, "timbre": "default"})]
+            assert app.state.requests["tts_reference"] == 0
+
+            # the first segment does not wait for the registration, the later ones send its ref_id
+            [_ async for _ in tts.tts("今天天气真不错", control={**control, "timbre": "self"})]
+            await asyncio.sleep(0.1)
+            assert app.state.requests["tts_reference"] == 1 and len(tts.references) == 1
+            [_ async for _ in tts.tts("适合出去玩", control={**control, "timbre": "self"})]
+            assert app.state.requests["tts_reference"] == 1 and not tts.registering
+
+    asyncio.run(fun())
+
+
+def test_chunking():
+    policy = ChunkingPolicy(first_min_chars=4, first_budget_ms=250, min_chars=10, max_chars=40, full_buffer_ms=2000)
+    # the first segment ends at the first clause, or at a word boundary once the budget is spent
+    assert policy.first("今天天气晴朗，气温", 0) == ("今天天气晴朗，", "气温")
+    assert policy.first("好，今天天气", 0) == ("", "好，今天天气")
+    assert policy.first("今天天气晴朗", 300) == ("今天天气晴朗", "")
+    assert policy.first("The weather is gre", 300) == ("The weather is ", "gre")
+    # later segments: clauses while nothing is buffered, sentences once the buffer is full
+    text = "气温二十度左右，很适合出去走走。我们去公园吧，那里"
+    assert policy.next(text, 0) == ("气温二十度左右，很适合出去走走。我们去公园吧，", "那里")
+    assert policy.next(text, 2000) == ("气温二十度左右，很适合出去走走。", "我们去公园吧，那里")
+    assert policy.next("气温二十度左右，很适合出去走走，我们去公园吧，", 2000) == ("", "气温二十度左右，很适合出去走走，我们去公园吧，")
+
+    async def fun():
+        async with serve(create_app(tts_first_chunk_ms=20, tts_char_ms=10), 29146):
+            tts = TTS("http://127.0.0.1:29146/cosyvoice/", sample_rate=24000, chunking=policy)
+            await tts.setup("test_chunking")
+
+            async def tokens():
+                yield "今天天气"
+                await asyncio.sleep(0.5)  # the slm stalls before the first clause is complete
+                yield "晴朗，气温二十度。"
+
+            segments = []
+            start = time.perf_counter()
+            first_audio = None
+            async for _ in await tts(tokens(), control={}, on_segment=segments.append):
+                first_audio = first_audio or time.perf_counter() - start
+            assert segments == ["今天天气", "晴朗，气温二十度。"] and first_audio < 0.45
+            assert tts.last_reply["segments"] == [4, 9] and tts.last_reply["first_audio_ms"] < 450
+
+    asyncio.run(fun())
+
+
+def test_token_stream():
+    async def fun():
+        async def tokens(n, closed):
+            try:
+                for i in range(n):
+                    await asyncio.sleep(0.001)
+                    yield f"{i},"
+            finally:
+                closed.append(True)
+
+        # every reader gets every token, the source is read once
+        closed = []
+        stream = TokenStream(tokens(5, closed))
+        first, second = await asyncio.gather(
+            *[asyncio.create_task(collect(stream.reader())) for _ in range(2)]
+        )
+        assert first == second == ["0,", "1,", "2,", "3,", "4,"] and stream.text() == "0,1,2,3,4,"
+        assert [token async for token in stream.reader(cursor=3)] == ["3,", "4,"]
+
+        # closing ends the readers and the source in the middle of a read, the text so far stays
+        closed = []
+        stream = TokenStream(tokens(100, closed))
+        reader = stream.reader()
+        assert [await reader.__anext__() for _ in range(2)] == ["0,", "1,"] and stream.text() == "0,1,"
+        reading = asyncio.create_task(collect(stream.reader()))
+        await asyncio.sleep(0.02)
+        await stream.aclose()
+        read = await reading
+        assert closed and 2 < len(read) < 100 and stream.text() == "".join(read)
+        assert [token async for token in reader] == read[2:]
+
+    async def collect(reader):
+        return [token async for token in reader]
+
+    asyncio.run(fun())